@@ -0,0 +1,507 @@
+"""Construct compressed archives by streaming files directly into the output, without
+first copying them to a staging directory.
+"""
+
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+import io
+from pathlib import Path, PurePosixPath
+import tarfile
+import time
+import zipfile
+
+from .compress import (
+    CompressionPolicy,
+    ParallelZipWriter,
+    SegmentedStreamWriter,
+    resolve_threads,
+)
+from .control import RuntimeClosure, RuntimeOutput
+from .snapshot import TreeSnapshot
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import BinaryIO, Callable, Final, Iterable, Optional
+    from .utils import IgnoreFunction
+
+
+ARCHIVE_SUFFIXES: Final = {
+    "tar": ".tar",
+    "gztar": ".tar.gz",
+    "bztar": ".tar.bz2",
+    "xztar": ".tar.xz",
+    "zstdtar": ".tar.zst",
+    "zip": ".zip",
+}
+
+
+@dataclass(frozen=True)
+class ArchiveEntry:
+    """A file or directory in an archive. The contents of a file are either read from
+    the path `source`, or are given directly as `data`.
+    """
+
+    arcname: PurePosixPath
+    source: Optional[Path] = None
+    data: Optional[bytes] = None
+    is_dir: bool = False
+    mode: int = 0o644
+    mtime: float = 0.0
+    file_size: Optional[int] = None
+
+    @classmethod
+    def from_path(cls, arcname: PurePosixPath, path: Path) -> ArchiveEntry:
+        st = path.stat()
+        return cls(
+            arcname,
+            source=path,
+            is_dir=path.is_dir(),
+            mode=st.st_mode & 0o777,
+            mtime=st.st_mtime,
+        )
+
+    @classmethod
+    def from_bytes(cls, arcname: PurePosixPath, data: bytes) -> ArchiveEntry:
+        return cls(arcname, data=data, mtime=time.time())
+
+    @classmethod
+    def directory(cls, arcname: PurePosixPath) -> ArchiveEntry:
+        return cls(arcname, is_dir=True, mode=0o755, mtime=time.time())
+
+    def size(self) -> int:
+        if self.file_size is not None:
+            return self.file_size
+        if self.data is not None:
+            return len(self.data)
+        if self.source is not None and not self.is_dir:
+            return self.source.stat().st_size
+        return 0
+
+    def open(self) -> BinaryIO:
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        if self.source is not None:
+            return open(self.source, "rb")
+        return io.BytesIO(b"")
+
+
+def iter_snapshot(snapshot: TreeSnapshot) -> Iterable[ArchiveEntry]:
+    """Yield an entry for each file or directory in the snapshot which is not ignored.
+    Directories are always yielded before their contents.
+    """
+    entries = snapshot.entries()
+    for (rel, st), data in zip(entries, snapshot.contents(rel for rel, _ in entries)):
+        yield ArchiveEntry(
+            rel,
+            source=snapshot.root / rel if data is None else None,
+            data=data,
+            is_dir=st.is_dir,
+            mode=st.mode,
+            mtime=st.mtime,
+            file_size=st.size,
+        )
+
+
+def iter_tree(
+    root: Path, ignore: IgnoreFunction, skip: Optional[Path] = None
+) -> Iterable[ArchiveEntry]:
+    """Walk the files below `root` once, yielding an entry for each file or directory
+    which is not ignored. Directories are always yielded before their contents.
+    """
+    return iter_snapshot(TreeSnapshot(root, ignore, skip))
+
+
+class ExportOverlay:
+    """In-memory modifications applied on top of the files of an export: renamed
+    directories, removed paths, files which are added or replaced, and rewrites of the
+    contents of files. All paths refer to names in the resulting export, after renaming.
+    """
+
+    def __init__(self) -> None:
+        self.renames: dict[PurePosixPath, PurePosixPath] = {}
+        self.removals: set[PurePosixPath] = set()
+        self.files: dict[PurePosixPath, ArchiveEntry] = {}
+        self.rewrites: dict[PurePosixPath, list[Callable[[str], str]]] = {}
+
+    def rename(self, source: PurePosixPath, target: PurePosixPath) -> RuntimeClosure:
+        def _callable() -> RuntimeOutput:
+            self.renames[source] = target
+            return RuntimeOutput(True)
+
+        return RuntimeClosure(FORMAT_MESSAGE.rename(source, target), True, _callable)
+
+    def remove(self, arcname: PurePosixPath) -> RuntimeClosure:
+        def _callable() -> RuntimeOutput:
+            self.removals.add(arcname)
+            self.files.pop(arcname, None)
+            return RuntimeOutput(True)
+
+        return RuntimeClosure(FORMAT_MESSAGE.remove(arcname), True, _callable)
+
+    def add_text(
+        self,
+        arcname: PurePosixPath,
+        get_text: Callable[[], str],
+        message: Optional[str] = None,
+    ) -> RuntimeClosure:
+        def _callable() -> RuntimeOutput:
+            self.removals.discard(arcname)
+            self.rewrites.pop(arcname, None)
+            self.files[arcname] = ArchiveEntry.from_bytes(
+                arcname, get_text().encode("utf-8", "surrogateescape")
+            )
+            return RuntimeOutput(True)
+
+        return RuntimeClosure(
+            message or FORMAT_MESSAGE.info(f"Write '{arcname}' to export"),
+            True,
+            _callable,
+        )
+
+    def add_path(self, arcname: PurePosixPath, source: Path) -> RuntimeClosure:
+        def _callable() -> RuntimeOutput:
+            if not source.exists():
+                return RuntimeOutput(False, f"Missing file '{source}'")
+            self.removals.discard(arcname)
+            self.rewrites.pop(arcname, None)
+            self.files[arcname] = ArchiveEntry.from_path(arcname, source)
+            return RuntimeOutput(True)
+
+        return RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Add '{source}' to export as '{arcname}'"),
+            True,
+            _callable,
+        )
+
+    def rewrite(
+        self,
+        arcname: PurePosixPath,
+        transform: Callable[[str], str],
+        message: Optional[str] = None,
+    ) -> RuntimeClosure:
+        """Transform the text of a file when it is written to the export. The file is
+        only read once, while streaming the export. Adding the file again replaces
+        the transforms registered so far."""
+
+        def _callable() -> RuntimeOutput:
+            self.rewrites.setdefault(arcname, []).append(transform)
+            return RuntimeOutput(True)
+
+        return RuntimeClosure(
+            message or FORMAT_MESSAGE.info(f"Rewrite '{arcname}' in export"),
+            True,
+            _callable,
+        )
+
+    def _rewritten(self, entry: ArchiveEntry) -> ArchiveEntry:
+        transforms = self.rewrites.get(entry.arcname, [])
+        if len(transforms) == 0 or entry.is_dir:
+            return entry
+        with entry.open() as fileobj:
+            text = fileobj.read().decode("utf-8", "surrogateescape")
+        for transform in transforms:
+            text = transform(text)
+        return replace(
+            entry,
+            source=None,
+            data=text.encode("utf-8", "surrogateescape"),
+            file_size=None,
+        )
+
+    def _renamed(self, arcname: PurePosixPath) -> PurePosixPath:
+        for source, target in self.renames.items():
+            if arcname == source or source in arcname.parents:
+                return target / arcname.relative_to(source)
+        return arcname
+
+    def _removed(self, arcname: PurePosixPath) -> bool:
+        return arcname in self.removals or any(
+            parent in self.removals for parent in arcname.parents
+        )
+
+    def _original(self, arcname: PurePosixPath) -> PurePosixPath:
+        for source, target in self.renames.items():
+            if arcname == target or target in arcname.parents:
+                return source / arcname.relative_to(target)
+        return arcname
+
+    def read_text(
+        self,
+        arcname: PurePosixPath,
+        read_source: Callable[[PurePosixPath], Optional[str]],
+    ) -> Optional[str]:
+        """The text of the file `arcname` in the export, with the modifications applied,
+        or None if there is no such file. Files which are not added to the export are
+        read with `read_source` from their path before renaming."""
+        if self._removed(arcname):
+            return None
+        if arcname in self.files:
+            with self.files[arcname].open() as fileobj:
+                text: Optional[str] = fileobj.read().decode("utf-8", "surrogateescape")
+        else:
+            text = read_source(self._original(arcname))
+        if text is None:
+            return None
+        for transform in self.rewrites.get(arcname, []):
+            text = transform(text)
+        return text
+
+    def apply(self, entries: Iterable[ArchiveEntry]) -> Iterable[ArchiveEntry]:
+        """Apply the modifications to a stream of entries."""
+        pending = dict(self.files)
+        directories: set[PurePosixPath] = set()
+
+        for entry in entries:
+            arcname = self._renamed(entry.arcname)
+            if self._removed(arcname):
+                continue
+            if arcname in pending:
+                entry = pending.pop(arcname)
+            else:
+                entry = replace(entry, arcname=arcname)
+            if entry.is_dir:
+                directories.add(arcname)
+            yield self._rewritten(entry)
+
+        # new files, with any missing parent directories
+        for arcname, entry in pending.items():
+            for parent in reversed(arcname.parents[:-1]):
+                if parent not in directories:
+                    directories.add(parent)
+                    yield ArchiveEntry.directory(parent)
+            yield self._rewritten(entry)
+
+
+@dataclass
+class ArchiveStats:
+    """Statistics about a written archive."""
+
+    path: Path
+    entries: int = 0
+    input_size: int = 0
+    stored_entries: int = 0
+    stored_size: int = 0
+    output_size: int = 0
+    seconds: float = 0.0
+
+    @property
+    def saved_size(self) -> int:
+        """The size of the files minus the size of the archive, which is negative if
+        the archive is larger."""
+        return self.input_size - self.output_size
+
+    def summary(self) -> str:
+        saved = (
+            f"saved {format_size(self.saved_size)}"
+            if self.saved_size >= 0
+            else f"added {format_size(-self.saved_size)}"
+        )
+        return (
+            f"Wrote {format_size(self.output_size)} from"
+            f" {format_size(self.input_size)} in {self.entries} entries, {saved}"
+            f" ({self.seconds:.2f}s); {self.stored_entries} entries"
+            f" ({format_size(self.stored_size)}) were stored without compression"
+        )
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+_SIZE_UNITS: Final = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_size(text: str) -> int:
+    """The size in bytes written as a number with an optional unit, such as '50M',
+    '1.5 GiB' or '800kB'. Units are binary."""
+    value = text.strip().lower().removesuffix("b").removesuffix("i")
+    number = value.rstrip("kmg")
+    unit = value[len(number) :]
+    try:
+        return round(float(number) * _SIZE_UNITS[unit])
+    except (KeyError, ValueError):
+        raise ValueError(f"invalid size '{text}'")
+
+
+def _classify(
+    entries: Iterable[ArchiveEntry], policy: CompressionPolicy, stats: ArchiveStats
+) -> Iterable[tuple[ArchiveEntry, bool]]:
+    """Decide for every entry whether it is stored, and record statistics."""
+    for entry in entries:
+        size = entry.size()
+        store = policy.store(entry)
+        stats.entries += 1
+        stats.input_size += size
+        if store:
+            stats.stored_entries += 1
+            stats.stored_size += size
+        yield entry, store
+
+
+def _add_to_tar(
+    entries: Iterable[tuple[ArchiveEntry, bool]],
+    tf: tarfile.TarFile,
+    stream: Optional[SegmentedStreamWriter] = None,
+) -> None:
+    for entry, store in entries:
+        # symbolic links are followed, and the contents of the target are added
+        info = tarfile.TarInfo(str(entry.arcname))
+        info.size = entry.size()
+        info.type = tarfile.DIRTYPE if entry.is_dir else tarfile.REGTYPE
+        info.mode = entry.mode
+        info.mtime = int(entry.mtime)
+
+        if stream is not None:
+            stream.set_store(store)
+        if entry.is_dir:
+            tf.addfile(info)
+        else:
+            with entry.open() as fileobj:
+                tf.addfile(info, fileobj)
+
+
+def _add_to_zip(
+    entries: Iterable[tuple[ArchiveEntry, bool]], zf: zipfile.ZipFile
+) -> None:
+    for entry, store in entries:
+        compress_type = zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED
+        if entry.source is not None:
+            zf.write(
+                entry.source, arcname=str(entry.arcname), compress_type=compress_type
+            )
+        else:
+            name = str(entry.arcname) + ("/" if entry.is_dir else "")
+            info = zipfile.ZipInfo(name, date_time=time.localtime(entry.mtime)[:6])
+            info.external_attr = entry.mode << 16
+            info.compress_type = compress_type
+            zf.writestr(info, entry.data or b"")
+
+
+def _write(
+    entries: Iterable[tuple[ArchiveEntry, bool]],
+    fileobj: BinaryIO,
+    compression: str,
+    level: Optional[int],
+    pool: Optional[ThreadPoolExecutor],
+    max_pending: int,
+) -> None:
+    if compression == "zip":
+        if pool is None:
+            with zipfile.ZipFile(fileobj, "w", compresslevel=level) as zf:
+                _add_to_zip(entries, zf)
+        else:
+            writer = ParallelZipWriter(fileobj, pool, level, max_pending)
+            for entry, store in entries:
+                writer.add(entry, compress=not store)
+            writer.close()
+
+    elif compression == "tar":
+        with tarfile.open(fileobj=fileobj, mode="w", dereference=True) as tf:
+            _add_to_tar(entries, tf)
+
+    else:
+        with (
+            SegmentedStreamWriter(
+                fileobj, compression, level, pool, max_pending
+            ) as stream,
+            tarfile.open(
+                fileobj=stream, mode="w", dereference=True  # type: ignore
+            ) as tf,
+        ):
+            _add_to_tar(entries, tf, stream)
+
+
+def write_archive(
+    entries: Iterable[ArchiveEntry],
+    base_name: Path,
+    compression: str,
+    threads: int = 1,
+    level: Optional[int] = None,
+    policy: Optional[CompressionPolicy] = None,
+) -> ArchiveStats:
+    """Write the entries to an archive in a single pass. As with `shutil.make_archive`,
+    the suffix corresponding to the compression format is appended to `base_name`.
+
+    If more than one thread is requested, compression is performed in parallel;
+    `threads=0` uses one thread per available core. Entries selected by `policy` are
+    stored without compression.
+    """
+    start = time.perf_counter()
+    stats = ArchiveStats(
+        base_name.parent / (base_name.name + ARCHIVE_SUFFIXES[compression])
+    )
+    classified = _classify(entries, policy or CompressionPolicy([]), stats)
+    threads = resolve_threads(threads)
+
+    with open(stats.path, "wb") as fileobj:
+        if threads == 1:
+            _write(classified, fileobj, compression, level, None, 0)
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                _write(classified, fileobj, compression, level, pool, 4 * threads)
+
+    stats.output_size = stats.path.stat().st_size
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+def make_archive(
+    get_entries: Callable[[], Iterable[ArchiveEntry]],
+    target_file: Path,
+    compression: str,
+    threads: int = 1,
+    level: Optional[int] = None,
+    policy: Optional[CompressionPolicy] = None,
+    max_size: Optional[int] = None,
+) -> RuntimeClosure:
+    """Write the entries to an archive. The closure fails if the archive is larger than
+    `max_size` bytes, although the archive is still written."""
+
+    def _callable() -> RuntimeOutput:
+        stats = write_archive(
+            get_entries(), target_file, compression, threads, level, policy
+        )
+        if max_size is not None and stats.output_size > max_size:
+            return RuntimeOutput(
+                False,
+                stats.summary()
+                + "\n"
+                + FORMAT_MESSAGE.error(
+                    f"The archive exceeds the maximum size of {format_size(max_size)}"
+                ),
+            )
+        return RuntimeOutput(True, stats.summary())
+
+    return RuntimeClosure(
+        FORMAT_MESSAGE.archive(target_file, compression),
+        True,
+        _callable,
+    )
+
+
+def extract_entries(
+    get_entries: Callable[[], Iterable[ArchiveEntry]], source: Path, target_dir: Path
+) -> RuntimeClosure:
+    """Write the entries into the directory `target_dir`, for instance to compile
+    them."""
+
+    def _callable() -> RuntimeOutput:
+        for entry in get_entries():
+            path = target_dir / entry.arcname
+            if entry.is_dir:
+                path.mkdir(parents=True, exist_ok=True)
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with entry.open() as fsrc, open(path, "wb") as fdst:
+                    while chunk := fsrc.read(1024 * 1024):
+                        fdst.write(chunk)
+        return RuntimeOutput(True)
+
+    return RuntimeClosure(FORMAT_MESSAGE.copy(source, target_dir), True, _callable)
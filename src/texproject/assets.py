@@ -0,0 +1,181 @@
+"""Convert figures which cannot be included by pdflatex, such as SVG and EPS files, to
+PDF files with local tools. The converted files are stored in the user cache directory
+by the contents of their source, and are only added to build directories and exports,
+so the working tree is never modified.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+from .compress import resolve_threads
+from .control import RuntimeClosure, RuntimeOutput
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Final, Mapping, Optional, Sequence
+    from pathlib import PurePosixPath
+    from .snapshot import TreeSnapshot
+
+
+# changed whenever the conversion changes
+_VERSION: Final = b"texproject-asset-1"
+
+
+def asset_sources(
+    snapshot: TreeSnapshot, suffixes: Sequence[str]
+) -> dict[PurePosixPath, PurePosixPath]:
+    """The converted files, by the files with one of the `suffixes` from which they are
+    converted. Files matched by the ignore patterns are included, since figure sources
+    such as SVG files are usually ignored, but files for which there is already a PDF
+    file in the snapshot are not converted."""
+    files = {rel for rel, st in snapshot.entries() if not st.is_dir}
+    sources: dict[PurePosixPath, PurePosixPath] = {}
+    for rel in sorted(files.union(snapshot.ignored())):
+        target = rel.with_suffix(".pdf")
+        if (
+            rel.suffix[1:].lower() in suffixes
+            and target not in files
+            and target not in sources.values()
+        ):
+            sources[rel] = target
+    return sources
+
+
+class AssetCache:
+    """The converted files, stored in `cache_dir` by their key."""
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = cache_dir
+
+    def lookup(self, key: str) -> Optional[Path]:
+        path = self.cache_dir / (key + ".pdf")
+        return path if path.exists() else None
+
+    def store(self, key: str, source: Path) -> Path:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_dir / (key + ".pdf")
+        temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        shutil.copyfile(source, temp)
+        temp.replace(path)
+        return path
+
+
+class AssetConverter:
+    """Convert the figures in `snapshot` with the commands in `commands`, by file suffix,
+    with up to `jobs` conversions at once. In the commands, '{input}' and '{output}' are
+    replaced by the names of the source and the converted file."""
+
+    def __init__(
+        self,
+        snapshot: TreeSnapshot,
+        cache: AssetCache,
+        commands: Mapping[str, Sequence[str]],
+        jobs: int = 0,
+    ) -> None:
+        self.snapshot = snapshot
+        self.cache = cache
+        self.commands = {suffix.lower(): list(cmd) for suffix, cmd in commands.items()}
+        self.jobs = resolve_threads(jobs)
+        # the converted files, by their name in the project
+        self.converted: dict[PurePosixPath, Path] = {}
+
+    def _command(self, rel: PurePosixPath) -> list[str]:
+        return self.commands[rel.suffix[1:].lower()]
+
+    def _key(self, rel: PurePosixPath, data: bytes) -> str:
+        digest = hashlib.sha256(_VERSION)
+        digest.update("\0".join(self._command(rel)).encode() + b"\0")
+        digest.update(hashlib.sha256(data).digest())
+        return digest.hexdigest()
+
+    def _convert(self, key: str, rel: PurePosixPath, data: bytes) -> Optional[str]:
+        """Convert the file, and return an error message if the conversion fails."""
+        with tempfile.TemporaryDirectory() as temp:
+            source = os.path.join(temp, "source" + rel.suffix)
+            output = os.path.join(temp, "output.pdf")
+            with open(source, "wb") as fileobj:
+                fileobj.write(data)
+            command = [
+                arg.format(input=source, output=output) for arg in self._command(rel)
+            ]
+            try:
+                proc = subprocess.run(command, capture_output=True)
+            except FileNotFoundError:
+                return f"Could not convert '{rel}': '{command[0]}' is not installed"
+            if proc.returncode != 0 or not os.path.exists(output):
+                stderr = proc.stderr.decode(errors="replace").strip()
+                return f"Could not convert '{rel}' with '{command[0]}'" + (
+                    f": {stderr.splitlines()[-1]}" if stderr else ""
+                )
+            self.cache.store(key, Path(output))
+        return None
+
+    def run(self) -> RuntimeOutput:
+        sources = asset_sources(self.snapshot, list(self.commands))
+        keys: dict[PurePosixPath, str] = {}
+        # the sources to convert, by key, so that identical files are converted once
+        pending: dict[str, tuple[PurePosixPath, bytes]] = {}
+        for rel, data in zip(sources, self.snapshot.contents(sources)):
+            if data is None:
+                data = (self.snapshot.root / rel).read_bytes()
+            keys[rel] = self._key(rel, data)
+            if self.cache.lookup(keys[rel]) is None:
+                pending.setdefault(keys[rel], (rel, data))
+        cached = sum(1 for key in keys.values() if key not in pending)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            errors = [
+                error
+                for error in pool.map(
+                    self._convert,
+                    pending.keys(),
+                    [rel for rel, _ in pending.values()],
+                    [data for _, data in pending.values()],
+                )
+                if error is not None
+            ]
+
+        for rel, target in sources.items():
+            path = self.cache.lookup(keys[rel])
+            if path is not None:
+                self.converted[target] = path
+        # sources which are not used by the document should not stop the build
+        return RuntimeOutput(
+            True,
+            "\n".join(
+                [
+                    f"Converted {len(self.converted)} of {len(sources)} figures,"
+                    f" {cached} from the cache"
+                ]
+                + [FORMAT_MESSAGE.error(error) for error in errors]
+            ),
+        )
+
+    def convert(self) -> RuntimeClosure:
+        return RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Convert figures in '{self.snapshot.root}' to PDF"),
+            True,
+            self.run,
+        )
+
+    def copy_to(self, build_dir: Path) -> RuntimeClosure:
+        """Copy the converted files to the corresponding paths in `build_dir`."""
+
+        def _callable() -> RuntimeOutput:
+            for rel, path in self.converted.items():
+                (build_dir / rel).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(path, build_dir / rel)
+            return RuntimeOutput(True)
+
+        return RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Add converted figures to '{build_dir}'"),
+            True,
+            _callable,
+        )
@@ -6,6 +6,8 @@ from enum import Enum, StrEnum, auto
 from pathlib import Path
 import shutil
 
+from .compress import ZSTD_AVAILABLE
+
 if TYPE_CHECKING:
     from typing import Final, Iterable, Callable, TypeVar
 
@@ -81,9 +83,12 @@ __suffix_map_helper = {
     ".tar.bz": "bztar",
     ".tar.gz": "gztar",
     ".tar.xz": "xztar",
+    ".tar.zst": "zstdtar",
     ".zip": "zip",
 }
 SHUTIL_ARCHIVE_FORMATS: Final = [ar[0] for ar in shutil.get_archive_formats()]
+if ZSTD_AVAILABLE and "zstdtar" not in SHUTIL_ARCHIVE_FORMATS:
+    SHUTIL_ARCHIVE_FORMATS.append("zstdtar")
 SHUTIL_ARCHIVE_SUFFIX_MAP: Final = {
     k: v for k, v in __suffix_map_helper.items() if v in SHUTIL_ARCHIVE_FORMATS
 }
@@ -139,9 +144,12 @@ class _Naming:
             raise Exception("Invalid template file path!")
 
     def existing_template_files(
-        self, working_dir: Path, mode: LinkMode
+        self,
+        working_dir: Path,
+        mode: LinkMode,
+        glob: Callable[[Path, str], Iterable[Path]] = Path.glob,
     ) -> Iterable[tuple[Path, str]]:
-        for path in (working_dir / NAMES.resource_subdir(mode)).glob("local-*"):
+        for path in glob(working_dir / NAMES.resource_subdir(mode), "local-*"):
             yield (path, NAMES.get_name(path))
 
     def rel_data_path(self, name: str, mode: LinkMode) -> Path:
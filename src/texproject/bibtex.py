@@ -0,0 +1,501 @@
+"""Scan BibTeX databases, prune them to the entries which are cited by the document,
+and cache the .bbl files generated from them.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+import hashlib
+import os
+import re
+import shutil
+
+from .control import RuntimeClosure, RuntimeOutput
+from .deps import project_relative
+from .flatten import Flattener
+from .tex import TokenKind, iter_commands, split_list, tokenize
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Callable, Final, Iterable, Optional
+    from .snapshot import TreeSnapshot
+
+
+# entries which are always kept, since they may be used by any other entry
+_KEPT_TYPES: Final = frozenset({"string", "preamble"})
+
+_ENTRY_RE: Final = re.compile(r"@[ \t]*([A-Za-z]+)[ \t\n]*([{(])")
+
+_DEPENDENCY_RE: Final = re.compile(
+    r"\b(crossref|xref|xdata)\s*=\s*(?:\{([^{}]*)\}|\"([^\"]*)\"|([^,\s{}\"]+))",
+    re.IGNORECASE,
+)
+
+CITE_COMMANDS: Final = {
+    name: "oom"
+    for name in (
+        "cite",
+        "citep",
+        "citet",
+        "citealp",
+        "citealt",
+        "citeauthor",
+        "citeyear",
+        "citeyearpar",
+        "citenum",
+        "citetitle",
+        "nocite",
+        "parencite",
+        "textcite",
+        "autocite",
+        "footcite",
+        "smartcite",
+        "supercite",
+        "fullcite",
+        "Cite",
+        "Citep",
+        "Citet",
+        "Citeauthor",
+        "Parencite",
+        "Textcite",
+        "Autocite",
+    )
+}
+
+# commands whose name contains 'cite', but which do not cite
+_NON_CITING_COMMANDS: Final = frozenset(
+    {"citestyle", "setcitestyle", "citeindextrue", "citeindexfalse"}
+)
+
+_AUX_CITE_RE: Final = re.compile(
+    r"\\(?:citation|abx@aux@cite(?:\{[^{}]*\})?)\{([^{}]*)\}"
+)
+_AUX_INPUT_RE: Final = re.compile(r"\\@input\{([^{}]*)\}")
+
+
+@dataclass(frozen=True)
+class BibEntry:
+    """An entry in a BibTeX database, which spans `source[start:end]`."""
+
+    entry_type: str
+    key: str
+    start: int
+    end: int
+
+    def dependencies(self, source: str) -> list[str]:
+        """The keys of the entries referenced with 'crossref', 'xref' or 'xdata'."""
+        keys = []
+        for match in _DEPENDENCY_RE.finditer(source, self.start, self.end):
+            value = next(group for group in match.groups()[1:] if group is not None)
+            keys.extend(split_list(value))
+        return keys
+
+
+def _entry_end(source: str, pos: int, close: str) -> int:
+    """The position after the delimiter `close` which ends the entry body at `pos`."""
+    depth = 0
+    for idx in range(pos, len(source)):
+        char = source[idx]
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            if depth == 0 and close == "}":
+                return idx + 1
+            depth -= 1
+        elif char == close and depth == 0:
+            return idx + 1
+    return len(source)
+
+
+def iter_entries(source: str) -> Iterable[BibEntry]:
+    """The entries in a BibTeX database. Text outside of entries, which BibTeX treats
+    as a comment, is skipped, as are '@comment' entries."""
+    pos = 0
+    while True:
+        match = _ENTRY_RE.search(source, pos)
+        if match is None:
+            return
+        entry_type = match.group(1).lower()
+        end = _entry_end(source, match.end(), "}" if match.group(2) == "{" else ")")
+        pos = end
+        if entry_type == "comment":
+            continue
+        if entry_type in _KEPT_TYPES:
+            key = ""
+        else:
+            key = source[match.end() : end].split(",", 1)[0].strip()
+        yield BibEntry(entry_type, key, match.start(), end)
+
+
+_FIELD_RE: Final = re.compile(r"[\s,]*([A-Za-z][\w:.+-]*)\s*=\s*")
+_BARE_VALUE_RE: Final = re.compile(r"[^\s,#{}\"()]+")
+
+
+def _delimited(source: str, pos: int, end: int) -> tuple[str, int]:
+    """The contents of the braced or quoted value at `pos`, and the position after it.
+    Braces are balanced inside both kinds of delimiters."""
+    close = "}" if source[pos] == "{" else '"'
+    depth = 0
+    for idx in range(pos + 1, end):
+        char = source[idx]
+        if char == close and depth == 0:
+            return source[pos + 1 : idx], idx + 1
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+    return source[pos + 1 : end], end
+
+
+def entry_fields(source: str, entry: BibEntry) -> dict[str, str]:
+    """The fields of an entry, by lowercase name, with the delimiters of the values
+    removed. Concatenated values are joined, and abbreviations are kept as written."""
+    fields: dict[str, str] = {}
+    pos = source.find(",", entry.start, entry.end)
+    end = entry.end - 1
+    if pos < 0:
+        return fields
+    while True:
+        match = _FIELD_RE.match(source, pos, end)
+        if match is None:
+            return fields
+        pos = match.end()
+        parts = []
+        while pos < end:
+            if source[pos] in '{"':
+                part, pos = _delimited(source, pos, end)
+            else:
+                bare = _BARE_VALUE_RE.match(source, pos, end)
+                if bare is None:
+                    break
+                part, pos = bare.group(), bare.end()
+            parts.append(part)
+            while pos < end and source[pos].isspace():
+                pos += 1
+            if pos < end and source[pos] == "#":
+                pos += 1
+                while pos < end and source[pos].isspace():
+                    pos += 1
+            else:
+                break
+        fields[match.group(1).lower()] = "".join(parts)
+
+
+def scan_citations(source: str) -> set[str]:
+    """The keys cited in a LaTeX source. The key '*' is included for '\\nocite{*}'."""
+    return {
+        key
+        for cmd in iter_commands(source, CITE_COMMANDS)
+        for arg in cmd.arguments
+        for key in split_list(arg)
+    }
+
+
+def unscanned_citations(source: str) -> set[str]:
+    """The citations in a LaTeX source which `scan_citations` does not understand:
+    commands whose name contains 'cite' but which are not known, such as '\\cites' or
+    wrappers of '\\cite', and citations of macro parameters such as '#1'. The
+    bibliography cannot be pruned safely if there are such citations."""
+    found = {
+        "\\" + tok.name
+        for tok in tokenize(source)
+        if tok.kind == TokenKind.command
+        and "cite" in tok.name.lower()
+        and tok.name not in CITE_COMMANDS
+        and tok.name not in _NON_CITING_COMMANDS
+    }
+    for cmd in iter_commands(source, CITE_COMMANDS):
+        for arg in cmd.arguments:
+            if "#" in arg:
+                found.add(f"\\{cmd.name}{{{arg}}}")
+    return found
+
+
+def read_aux(aux_path: Path) -> set[str]:
+    """The keys cited in an .aux file of a previous build, including the .aux files of
+    included files."""
+    keys: set[str] = set()
+    stack = [aux_path]
+    seen: set[Path] = set()
+    while len(stack) > 0:
+        path = stack.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            text = path.read_text(errors="replace")
+        except FileNotFoundError:
+            continue
+        for match in _AUX_CITE_RE.finditer(text):
+            keys.update(split_list(match.group(1)))
+        stack.extend(aux_path.parent / name for name in _AUX_INPUT_RE.findall(text))
+    return keys
+
+
+class BibliographyPruner:
+    """Prune BibTeX databases to the cited entries, along with the entries they depend
+    on through 'crossref', 'xref' or 'xdata'. Keys are compared without case, as BibTeX
+    does. If '*' is cited, nothing is pruned.
+
+    Since dependencies may refer to entries in other databases, all of the databases are
+    first scanned with `add_database`, and then pruned one at a time with `prune`.
+    """
+
+    def __init__(self) -> None:
+        self.cited: set[str] = set()
+        self.entries = 0
+        self._dependencies: dict[str, list[str]] = {}
+        self._needed: Optional[set[str]] = None
+
+    def add_citations(self, keys: Iterable[str]) -> None:
+        self.cited.update(key.lower() for key in keys)
+        self._needed = None
+
+    def add_database(self, source: str) -> None:
+        for entry in iter_entries(source):
+            if entry.key != "":
+                self.entries += 1
+                self._dependencies[entry.key.lower()] = [
+                    key.lower() for key in entry.dependencies(source)
+                ]
+        self._needed = None
+
+    def needed(self) -> Optional[set[str]]:
+        """The keys of the entries which are kept, or None if all entries are kept."""
+        if "*" in self.cited:
+            return None
+        if self._needed is None:
+            needed: set[str] = set()
+            stack = list(self.cited)
+            while len(stack) > 0:
+                key = stack.pop()
+                if key not in needed:
+                    needed.add(key)
+                    stack.extend(self._dependencies.get(key, []))
+            self._needed = needed
+        return self._needed
+
+    def summary(self, databases: int) -> str:
+        needed = self.needed()
+        kept = (
+            self.entries if needed is None else len(needed & self._dependencies.keys())
+        )
+        return (
+            f"Kept {kept} of {self.entries} entries in {databases} bibliography files"
+        )
+
+    def prune(self, source: str) -> str:
+        needed = self.needed()
+        if needed is None:
+            return source
+        return "\n\n".join(
+            source[entry.start : entry.end]
+            for entry in iter_entries(source)
+            if entry.key == "" or entry.key.lower() in needed
+        ) + ("\n" if source.endswith("\n") else "")
+
+
+def unscanned_message(unscanned: dict[str, PurePosixPath]) -> str:
+    """The message reported when the bibliography is not pruned, given the citations
+    which are not understood and the files which contain them."""
+    return "Not pruning the bibliography, since the citations are not understood:\n" + (
+        "\n".join(f"  {cite} in '{rel}'" for cite, rel in sorted(unscanned.items()))
+    )
+
+
+# files which are scanned for citations
+CITING_SUFFIXES: Final = frozenset({".tex", ".sty", ".cls"})
+
+
+def prune_bibliography_files(
+    snapshot: TreeSnapshot, build_dir: Path, aux_path: Path
+) -> RuntimeClosure:
+    """Prune the .bib files of `snapshot` which are copied to `build_dir`, using the
+    citations in the sources of the snapshot and in the .aux file of a previous build
+    at `aux_path`. Nothing is pruned if the sources contain citations which the scanner
+    does not understand."""
+
+    def _callable() -> RuntimeOutput:
+        pruner = BibliographyPruner()
+        pruner.add_citations(read_aux(aux_path))
+        bib_files = []
+        unscanned: dict[str, PurePosixPath] = {}
+        for rel, st in snapshot.entries():
+            if st.is_dir:
+                continue
+            if rel.suffix in CITING_SUFFIXES:
+                source = snapshot.read_text(snapshot.root / rel)
+                pruner.add_citations(scan_citations(source))
+                unscanned.update(dict.fromkeys(unscanned_citations(source), rel))
+            elif rel.suffix == ".bib":
+                bib_files.append(build_dir / rel)
+
+        if len(unscanned) > 0:
+            return RuntimeOutput(True, unscanned_message(unscanned))
+
+        texts = [
+            path.read_text(encoding="utf-8", errors="surrogateescape")
+            for path in bib_files
+        ]
+        for text in texts:
+            pruner.add_database(text)
+        for path, text in zip(bib_files, texts):
+            path.write_text(
+                pruner.prune(text), encoding="utf-8", errors="surrogateescape"
+            )
+        return RuntimeOutput(True, pruner.summary(len(bib_files)))
+
+    return RuntimeClosure(
+        FORMAT_MESSAGE.info(f"Prune bibliography files in '{build_dir}'"),
+        True,
+        _callable,
+    )
+
+
+_BIBLIOGRAPHY_COMMANDS: Final = {
+    "bibliography": 1,
+    "addbibresource": 1,
+    "bibliographystyle": 1,
+    "usepackage": 1,
+}
+
+# changed whenever the contents of the key change
+_KEY_VERSION: Final = b"texproject-bbl-1"
+
+
+def bibliography_key(
+    read_text: Callable[[PurePosixPath], Optional[str]],
+    main: PurePosixPath,
+    aux_path: Path,
+) -> Optional[str]:
+    """The cache key of the .bbl file of the document, or None if the document has no
+    bibliography or has citations which are not understood, in which case the .bbl file
+    is not cached. The .bbl file is determined by the cited keys, in the order of the
+    document since unsorted styles number the entries in this order, the bibliography
+    style or the options of 'biblatex', and the contents of the databases. Keys cited in
+    the .aux file at `aux_path`, but not in the sources, are included as well."""
+    source = "".join(Flattener(read_text).flatten(main))
+    if len(unscanned_citations(source)) > 0:
+        return None
+    cited: dict[str, None] = {}
+    databases: list[str] = []
+    style: list[str] = []
+    for cmd in iter_commands(source, {**CITE_COMMANDS, **_BIBLIOGRAPHY_COMMANDS}):
+        if len(cmd.arguments) == 0:
+            continue
+        arg = cmd.arguments[0].strip()
+        match cmd.name:
+            case "bibliography":
+                databases.extend(
+                    name if name.endswith(".bib") else name + ".bib"
+                    for name in split_list(arg)
+                )
+            case "addbibresource":
+                databases.append(arg)
+            case "bibliographystyle":
+                style.extend(["bst", arg, read_text(PurePosixPath(arg + ".bst")) or ""])
+            case "usepackage":
+                if "biblatex" in split_list(arg):
+                    style.extend(["biblatex", *cmd.options])
+            case _:
+                cited.update(dict.fromkeys(split_list(arg)))
+    if len(databases) == 0:
+        return None
+    cited.update(dict.fromkeys(sorted(read_aux(aux_path) - cited.keys())))
+
+    digest = hashlib.sha256(_KEY_VERSION)
+    for part in [*cited, "\0", *style, "\0"]:
+        digest.update(part.encode("utf-8", errors="surrogateescape") + b"\0")
+    for name in databases:
+        rel = project_relative(name)
+        text = read_text(rel) if rel is not None else None
+        digest.update(name.encode("utf-8", errors="surrogateescape") + b"\0")
+        digest.update(
+            hashlib.sha256(
+                (text or "").encode("utf-8", errors="surrogateescape")
+            ).digest()
+        )
+    return digest.hexdigest()
+
+
+class BibliographyCache:
+    """Generated .bbl files, stored in `cache_dir` by the key of `bibliography_key`."""
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = cache_dir
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / (key + ".bbl")
+
+    def restore(self, key: str, target: Path) -> bool:
+        """Copy the cached .bbl file to `target`, and return whether it exists."""
+        source = self._path(key)
+        if not source.exists():
+            return False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(source, target)
+        return True
+
+    def store(self, key: str, source: Path) -> bool:
+        """Add the .bbl file at `source` to the cache, if it exists."""
+        if not source.exists():
+            return False
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file, so that concurrent builds never read partial files
+        temp = self._path(key).with_suffix(f".{os.getpid()}.tmp")
+        shutil.copyfile(source, temp)
+        temp.replace(self._path(key))
+        return True
+
+
+@dataclass
+class CachedBibliography:
+    """The .bbl file of a single build, which is restored from the cache before
+    compiling, or stored in the cache after compiling."""
+
+    cache: BibliographyCache
+    key: Optional[str] = None
+    restored: bool = False
+
+    def restore(
+        self,
+        read_text: Callable[[PurePosixPath], Optional[str]],
+        main: PurePosixPath,
+        aux_path: Path,
+        target: Path,
+    ) -> RuntimeClosure:
+        def _callable() -> RuntimeOutput:
+            self.key = bibliography_key(read_text, main, aux_path)
+            if self.key is None:
+                return RuntimeOutput(True, "The document has no bibliography")
+            self.restored = self.cache.restore(self.key, target)
+            return RuntimeOutput(
+                True,
+                (
+                    "Using the cached bibliography"
+                    if self.restored
+                    else "The bibliography is not cached"
+                ),
+            )
+
+        return RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Look up cached bibliography '{target.name}'"),
+            True,
+            _callable,
+        )
+
+    def store(self, source: Path, compiled: Callable[[], bool]) -> RuntimeClosure:
+        """Store the .bbl file at `source`, if `compiled` reports that the compilation
+        which generated it succeeded."""
+
+        def _callable() -> RuntimeOutput:
+            if self.key is not None and compiled():
+                self.cache.store(self.key, source)
+            return RuntimeOutput(True)
+
+        return RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Cache bibliography '{source.name}'"),
+            True,
+            _callable,
+        )
@@ -0,0 +1,324 @@
+"""Check the labels, references and citations of the document without compiling it."""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from bisect import bisect_right
+from dataclasses import asdict, dataclass, field
+from fnmatch import fnmatchcase
+from pathlib import PurePosixPath
+import hashlib
+import json
+
+from .bibtex import CITE_COMMANDS, iter_entries
+from .control import AtomicIterable, RuntimeClosure, RuntimeOutput, SUCCESS
+from .deps import input_candidates, project_relative
+from .flatten import snapshot_reader
+from .snapshot import tree_snapshot
+from .tex import iter_commands, split_list
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Callable, Final, Iterable, Optional, Sequence
+    from pathlib import Path
+    from .control import TempDir
+    from .filesystem import ProjectPath, TemplateDict
+
+
+# changed whenever the contents of the cache change
+_VERSION: Final = 1
+
+_REF_COMMANDS: Final = (
+    "ref",
+    "eqref",
+    "pageref",
+    "autoref",
+    "nameref",
+    "vref",
+    "cref",
+    "Cref",
+    "cpageref",
+    "Cpageref",
+    "labelcref",
+)
+
+_SIGNATURES: Final[dict[str, int | str]] = {
+    **CITE_COMMANDS,
+    **{name: 1 for name in _REF_COMMANDS},
+    "label": 1,
+    "bibitem": "om",
+    "input": 1,
+    "include": 1,
+    "subfile": 1,
+    "bibliography": 1,
+    "addbibresource": 1,
+}
+
+# a location in the project, as a file and a line number
+Location = tuple[str, int]
+
+
+@dataclass
+class FileScan:
+    """The labels, references, citations and inputs of a single .tex file, along with
+    the line on which they occur."""
+
+    labels: list[tuple[str, int]] = field(default_factory=list)
+    refs: list[tuple[str, int]] = field(default_factory=list)
+    cites: list[tuple[str, int]] = field(default_factory=list)
+    inputs: list[tuple[str, str]] = field(default_factory=list)
+    databases: list[str] = field(default_factory=list)
+
+
+@dataclass
+class DatabaseScan:
+    """The keys of the entries of a .bib file, along with the line on which they occur,
+    and the keys they depend on through 'crossref', 'xref' or 'xdata'."""
+
+    entries: list[tuple[str, int]] = field(default_factory=list)
+    dependencies: list[str] = field(default_factory=list)
+
+
+def _line_numbers(source: str) -> Callable[[int], int]:
+    newlines = [idx for idx, char in enumerate(source) if char == "\n"]
+    return lambda pos: bisect_right(newlines, pos - 1) + 1
+
+
+def scan_file(source: str) -> FileScan:
+    scan = FileScan()
+    line_of = _line_numbers(source)
+    for cmd in iter_commands(source, _SIGNATURES):
+        if len(cmd.arguments) == 0:
+            continue
+        arg = cmd.arguments[0].strip()
+        line = line_of(cmd.start)
+        # arguments of macro definitions, such as '\\label{#1}', are skipped
+        names = [name for name in split_list(arg) if "#" not in name]
+        match cmd.name:
+            case "label" | "bibitem":
+                scan.labels.extend((f"{cmd.name}:{name}", line) for name in names[:1])
+            case "input" | "include" | "subfile":
+                scan.inputs.append((cmd.name, arg.strip('"')))
+            case "bibliography":
+                scan.databases.extend(
+                    name if name.endswith(".bib") else name + ".bib" for name in names
+                )
+            case "addbibresource":
+                scan.databases.append(arg)
+            case _ if cmd.name in CITE_COMMANDS:
+                scan.cites.extend((name, line) for name in names)
+            case _:
+                scan.refs.extend((name, line) for name in names)
+    return scan
+
+
+def scan_database(source: str) -> DatabaseScan:
+    scan = DatabaseScan()
+    line_of = _line_numbers(source)
+    for entry in iter_entries(source):
+        if entry.key != "":
+            scan.entries.append((entry.key, line_of(entry.start)))
+            scan.dependencies.extend(entry.dependencies(source))
+    return scan
+
+
+class ScanCache:
+    """The results of `scan_file` and `scan_database`, by the hash of the contents of the
+    file, which are stored in `path` between runs."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        try:
+            data = json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            data = {}
+        self._stored: dict[str, dict] = (
+            data.get("scans", {}) if data.get("version") == _VERSION else {}
+        )
+        self._used: dict[str, dict] = {}
+
+    def _lookup(
+        self, kind: str, source: str, scan: Callable[[str], FileScan | DatabaseScan]
+    ) -> dict:
+        digest = hashlib.sha256(
+            source.encode("utf-8", errors="surrogateescape")
+        ).hexdigest()
+        key = f"{kind}:{digest}"
+        if key not in self._used:
+            self._used[key] = self._stored.get(key) or asdict(scan(source))
+        return self._used[key]
+
+    def file(self, source: str) -> FileScan:
+        data = self._lookup("tex", source, scan_file)
+        return FileScan(
+            labels=[(name, line) for name, line in data["labels"]],
+            refs=[(name, line) for name, line in data["refs"]],
+            cites=[(name, line) for name, line in data["cites"]],
+            inputs=[(cmd, name) for cmd, name in data["inputs"]],
+            databases=data["databases"],
+        )
+
+    def database(self, source: str) -> DatabaseScan:
+        data = self._lookup("bib", source, scan_database)
+        return DatabaseScan(
+            entries=[(key, line) for key, line in data["entries"]],
+            dependencies=data["dependencies"],
+        )
+
+    def save(self) -> None:
+        """Store the scans of the files which were used, which drops the scans of files
+        which no longer exist."""
+        if self._used != self._stored:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps({"version": _VERSION, "scans": self._used}))
+
+
+@dataclass
+class CheckReport:
+    """The problems found by `check_document`. The errors are undefined or duplicate
+    labels and keys, and the warnings are unused bibliography entries."""
+
+    files: int = 0
+    errors: list[str] = field(default_factory=list)
+    warnings: list[str] = field(default_factory=list)
+
+
+def _sorted_where(
+    index: dict[str, list[Location]], keep: Callable[[str, list[Location]], bool]
+) -> Iterable[tuple[str, str]]:
+    """The names in `index` for which `keep` holds, in order, along with their sorted
+    locations formatted as 'path:line'."""
+    for name, locations in sorted(item for item in index.items() if keep(*item)):
+        yield name, ", ".join(f"{path}:{line}" for path, line in sorted(locations))
+
+
+def check_document(
+    read_text: Callable[[PurePosixPath], Optional[str]],
+    main: PurePosixPath,
+    cache: ScanCache,
+    external_labels: Sequence[str] = (),
+) -> CheckReport:
+    """Check the document starting at `main`, following '\\input' and '\\include'.
+    References to labels matching one of the patterns `external_labels` are not
+    reported, since they are defined elsewhere, such as by packages or by macros.
+    Citations are compared without case, as BibTeX does."""
+    report = CheckReport()
+    labels: dict[str, list[Location]] = {}
+    refs: dict[str, list[Location]] = {}
+    cites: dict[str, list[Location]] = {}
+    databases: list[str] = []
+
+    main_text = read_text(main)
+    queue = [] if main_text is None else [(main, main_text)]
+    seen = {main}
+    while len(queue) > 0:
+        rel, text = queue.pop()
+        report.files += 1
+        scan = cache.file(text)
+        path = str(rel)
+        for index, items in [(labels, scan.labels), (refs, scan.refs)]:
+            for name, line in items:
+                index.setdefault(name, []).append((path, line))
+        for key, line in scan.cites:
+            cites.setdefault(key.casefold(), []).append((path, line))
+        databases.extend(scan.databases)
+        for command, name in scan.inputs:
+            for candidate in input_candidates(command, name):
+                child = project_relative(candidate)
+                if child is None or child in seen:
+                    continue
+                child_text = read_text(child)
+                if child_text is not None:
+                    seen.add(child)
+                    queue.append((child, child_text))
+                    break
+
+    # only the problems are sorted, since there may be many labels and citations
+    for name, locations in _sorted_where(labels, lambda name, locs: len(locs) > 1):
+        kind, _, label = name.partition(":")
+        report.errors.append(f"Duplicate {kind} '{label}' in {locations}")
+
+    def _undefined(name: str, _: list[Location]) -> bool:
+        return f"label:{name}" not in labels and not any(
+            fnmatchcase(name, pattern) for pattern in external_labels
+        )
+
+    for name, locations in _sorted_where(refs, _undefined):
+        report.errors.append(f"Undefined reference '{name}' in {locations}")
+
+    entries: dict[str, list[Location]] = {
+        name.removeprefix("bibitem:").casefold(): locations
+        for name, locations in labels.items()
+        if name.startswith("bibitem:")
+    }
+    dependencies: set[str] = set()
+    for name in dict.fromkeys(databases):
+        bib_rel = project_relative(name)
+        bib_text = read_text(bib_rel) if bib_rel is not None else None
+        if bib_text is None:
+            report.errors.append(f"Missing bibliography file '{name}'")
+            continue
+        bib_scan = cache.database(bib_text)
+        for key, line in bib_scan.entries:
+            entries.setdefault(key.casefold(), []).append((name, line))
+        dependencies.update(key.casefold() for key in bib_scan.dependencies)
+
+    for key, locations in _sorted_where(entries, lambda key, locs: len(locs) > 1):
+        report.errors.append(f"Duplicate bibliography entry '{key}' in {locations}")
+    for key, locations in _sorted_where(
+        cites, lambda key, _: key != "*" and key not in entries
+    ):
+        report.errors.append(f"Undefined citation '{key}' in {locations}")
+    if "*" not in cites:
+        for key, locations in _sorted_where(
+            entries, lambda key, _: key not in cites and key not in dependencies
+        ):
+            report.warnings.append(f"Unused bibliography entry '{key}' in {locations}")
+    return report
+
+
+@dataclass
+class DocumentChecker(AtomicIterable):
+    """Check the labels, references and citations of the document. The scans of the
+    files are cached by their contents in the temporary directory of the project."""
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        main = PurePosixPath(proj_path.main.name)
+        read_text = snapshot_reader(tree_snapshot(proj_path, state))
+        reports: list[CheckReport] = []
+
+        def _callable() -> RuntimeOutput:
+            cache = ScanCache(proj_path.temp_dir / "check.json")
+            reports.append(
+                check_document(
+                    read_text,
+                    main,
+                    cache,
+                    proj_path.config.process["check_external_labels"],
+                )
+            )
+            cache.save()
+            return RuntimeOutput(
+                True,
+                f"Checked {reports[0].files} files: {len(reports[0].errors)} errors,"
+                f" {len(reports[0].warnings)} warnings",
+            )
+
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Check references and citations of '{main}'"),
+            True,
+            _callable,
+        )
+
+        if len(reports) > 0:
+            for warning in reports[0].warnings:
+                yield RuntimeClosure(FORMAT_MESSAGE.info(warning), *SUCCESS)
+            for error in reports[0].errors:
+                yield RuntimeClosure(
+                    FORMAT_MESSAGE.error(error), False, lambda: RuntimeOutput(False)
+                )
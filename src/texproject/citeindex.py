@@ -0,0 +1,277 @@
+"""A persistent index of the citation files in the data directory, which finds entries
+by key, or by the words of their authors, title and year.
+
+The index is stored in sorted text files, which are searched in place through mmap:
+'keys.idx' has one line per entry, sorted by the key without case, and 'terms.idx' maps
+each word to the positions of the lines in 'keys.idx' of the entries containing it.
+The entries of each citation file are also stored separately, so that only the
+citation files which changed since the last update are parsed again.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass
+import json
+import mmap
+import os
+import re
+
+from .bibtex import entry_fields, iter_entries
+from .filesystem import DATA_PATH, citation_linker
+
+if TYPE_CHECKING:
+    from typing import Final, Iterable, Optional
+    from pathlib import Path
+
+
+# changed whenever the format of the index changes
+_VERSION: Final = 1
+
+_TEX_COMMAND_RE: Final = re.compile(r"\\(?:([A-Za-z]+)|.)")
+_WORD_RE: Final = re.compile(r"\w+")
+
+
+def _clean(value: str) -> str:
+    """The text of a field without braces or repeated whitespace. Commands with an
+    argument, such as accents, are removed, and other commands are replaced by their
+    name, so that '{\\"o}' becomes 'o' and '{\\TeX}book' becomes 'TeXbook'."""
+
+    def _replace(match: re.Match) -> str:
+        name = match.group(1)
+        if name is None or value.startswith("{", match.end()):
+            return ""
+        return name
+
+    text = _TEX_COMMAND_RE.sub(_replace, value).replace("{", "").replace("}", "")
+    return " ".join(text.split())
+
+
+def _words(text: str) -> list[str]:
+    return _WORD_RE.findall(text.casefold())
+
+
+@dataclass(frozen=True)
+class IndexedEntry:
+    """An entry of the citation file `name`, which starts at byte `offset`."""
+
+    key: str
+    name: str
+    offset: int
+    year: str
+    author: str
+    title: str
+
+    @classmethod
+    def from_line(cls, line: bytes) -> IndexedEntry:
+        _, key, name, offset, year, author, title = line.decode(
+            "utf-8", errors="surrogateescape"
+        ).split("\t")
+        return cls(key, name, int(offset), year, author, title)
+
+    def __str__(self) -> str:
+        return f"{self.name}:{self.key}\t{self.author} ({self.year}). {self.title}"
+
+
+def _lower_bound(lines: mmap.mmap, target: bytes) -> int:
+    """The position of the first line of the sorted `lines` whose first field is not
+    less than `target`."""
+    lo, hi = 0, len(lines)
+    while lo < hi:
+        start = lines.rfind(b"\n", 0, (lo + hi) // 2) + 1
+        end = lines.find(b"\n", start)
+        if lines[start : lines.find(b"\t", start, end)] < target:
+            lo = end + 1
+        else:
+            hi = start
+    return lo
+
+
+def _iter_lines(lines: mmap.mmap, pos: int) -> Iterable[tuple[int, bytes, bytes]]:
+    """The lines starting at `pos`, with their position, split into the first field
+    and the rest."""
+    while pos < len(lines):
+        end = lines.find(b"\n", pos)
+        first, _, rest = lines[pos:end].partition(b"\t")
+        yield pos, first, rest
+        pos = end + 1
+
+
+class CitationIndex:
+    """The index, in `index_dir`, of the .bib files in `source_dir`."""
+
+    def __init__(self, source_dir: Path, index_dir: Path) -> None:
+        self.source_dir = source_dir
+        self.index_dir = index_dir
+
+    @property
+    def _manifest(self) -> Path:
+        return self.index_dir / "manifest.json"
+
+    def _record(self, name: str) -> Path:
+        return self.index_dir / "files" / f"{name}.tsv"
+
+    def path(self, entry: IndexedEntry) -> Path:
+        return self.source_dir / f"{entry.name}.bib"
+
+    def _write(self, path: Path, data: bytes) -> None:
+        # readers only ever see complete files
+        temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temp.write_bytes(data)
+        temp.replace(path)
+
+    def _stamps(self) -> dict[str, list[int]]:
+        try:
+            paths = list(self.source_dir.iterdir())
+        except FileNotFoundError:
+            return {}
+        stamps = {}
+        for path in paths:
+            if path.suffix == ".bib":
+                st = path.stat()
+                stamps[path.stem] = [st.st_mtime_ns, st.st_size]
+        return stamps
+
+    def _index_file(self, name: str) -> None:
+        data = (self.source_dir / f"{name}.bib").read_bytes()
+        source = data.decode("utf-8", errors="surrogateescape")
+        rows = []
+        pos = offset = 0
+        for entry in iter_entries(source):
+            offset += len(source[pos : entry.start].encode(errors="surrogateescape"))
+            pos = entry.start
+            if entry.key == "":
+                continue
+            fields = entry_fields(source, entry)
+            rows.append(
+                "\t".join(
+                    [
+                        " ".join(entry.key.split()),
+                        str(offset),
+                        _clean(fields.get("year", fields.get("date", ""))),
+                        _clean(fields.get("author", fields.get("editor", ""))),
+                        _clean(fields.get("title", "")),
+                    ]
+                )
+                + "\n"
+            )
+        self._write(self._record(name), "".join(rows).encode(errors="surrogateescape"))
+
+    def _merge(self, names: Iterable[str]) -> None:
+        lines = []
+        for name in names:
+            for row in (
+                self._record(name).read_text(errors="surrogateescape").splitlines()
+            ):
+                key, offset, year, author, title = row.split("\t")
+                lines.append(
+                    "\t".join(
+                        [key.casefold(), key, name, offset, year, author, title]
+                    ).encode(errors="surrogateescape")
+                    + b"\n"
+                )
+        lines.sort()
+
+        postings: dict[bytes, list[int]] = {}
+        pos = 0
+        for line in lines:
+            entry = IndexedEntry.from_line(line[:-1])
+            for word in set(_words(f"{entry.year} {entry.author} {entry.title}")):
+                postings.setdefault(word.encode(), []).append(pos)
+            pos += len(line)
+
+        self._write(self.index_dir / "keys.idx", b"".join(lines))
+        self._write(
+            self.index_dir / "terms.idx",
+            b"".join(
+                word + b"\t" + b",".join(b"%d" % p for p in positions) + b"\n"
+                for word, positions in sorted(postings.items())
+            ),
+        )
+
+    def update(self) -> bool:
+        """Index the citation files which changed since the last update, and return
+        whether the index changed. Files are compared by modification time and size."""
+        try:
+            manifest = json.loads(self._manifest.read_text())
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        if manifest.get("version") != _VERSION:
+            manifest = {"files": {}}
+        indexed = manifest["files"]
+
+        stamps = self._stamps()
+        if stamps == indexed:
+            return False
+
+        (self.index_dir / "files").mkdir(parents=True, exist_ok=True)
+        for name, stamp in stamps.items():
+            if indexed.get(name) != stamp or not self._record(name).exists():
+                self._index_file(name)
+        for name in indexed.keys() - stamps.keys():
+            self._record(name).unlink(missing_ok=True)
+        self._merge(sorted(stamps))
+        self._write(
+            self._manifest,
+            json.dumps({"version": _VERSION, "files": stamps}).encode(),
+        )
+        return True
+
+    def _open(self, name: str) -> Optional[mmap.mmap]:
+        try:
+            with open(self.index_dir / name, "rb") as fileobj:
+                if os.fstat(fileobj.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def where(self, key: str) -> list[IndexedEntry]:
+        """The entries with the key `key`, compared without case."""
+        keys = self._open("keys.idx")
+        if keys is None:
+            return []
+        target = key.casefold().encode(errors="surrogateescape")
+        entries = []
+        for pos, first, _ in _iter_lines(keys, _lower_bound(keys, target)):
+            if first != target:
+                break
+            entries.append(IndexedEntry.from_line(keys[pos : keys.find(b"\n", pos)]))
+        return entries
+
+    def search(self, query: str, limit: Optional[int] = None) -> list[IndexedEntry]:
+        """The entries, in order of their key, whose authors, title and year contain
+        every word of `query`. Each word of the query also matches longer words which
+        start with it."""
+        keys = self._open("keys.idx")
+        terms = self._open("terms.idx")
+        words = _words(_clean(query))
+        if keys is None or terms is None or len(words) == 0:
+            return []
+
+        matches: Optional[set[int]] = None
+        for word in sorted(set(words), key=len, reverse=True):
+            target = word.encode()
+            found: set[int] = set()
+            for _, term, positions in _iter_lines(terms, _lower_bound(terms, target)):
+                if not term.startswith(target):
+                    break
+                found.update(int(p) for p in positions.split(b","))
+            matches = found if matches is None else matches & found
+            if len(matches) == 0:
+                return []
+
+        assert matches is not None
+        return [
+            IndexedEntry.from_line(keys[pos : keys.find(b"\n", pos)])
+            for pos in sorted(matches)[:limit]
+        ]
+
+    def line_number(self, entry: IndexedEntry) -> int:
+        """The line of the citation file on which the entry starts."""
+        with open(self.path(entry), "rb") as fileobj:
+            return fileobj.read(entry.offset).count(b"\n") + 1
+
+
+def citation_index() -> CitationIndex:
+    """The index of the citation files in the data directory."""
+    return CitationIndex(citation_linker.dir_path, DATA_PATH.cache_dir / "citations")
@@ -8,6 +8,7 @@ from pathlib import Path
 
 import click
 
+from .archive import parse_size
 from .base import (
     SHUTIL_ARCHIVE_FORMATS,
     SHUTIL_ARCHIVE_SUFFIX_MAP,
@@ -17,7 +18,10 @@ from .base import (
     LinkCommand,
     ExportMode,
 )
+from .check import DocumentChecker
+from .citeindex import citation_index
 from .control import CommandRunner
+from .deps import DependencyLister
 from .filesystem import (
     ProjectPath,
     NAMES,
@@ -27,6 +31,7 @@ from .filesystem import (
     citation_linker,
     template_linker,
 )
+from .flatten import FlattenWriter
 from .git import (
     InitializeGitRepo,
     CreateGithubRepo,
@@ -37,6 +42,8 @@ from .git import (
 )
 from .utils import FileEditor, CleanProject
 from .output import ArchiveWriter, LatexCompiler
+from .packages import UnusedPackageFinder
+from .partial import PartialCompiler, chapter_name
 from .template import (
     OutputFolderCreator,
     InfoFileWriter,
@@ -44,9 +51,12 @@ from .template import (
     NameSequenceLinker,
     PathSequenceLinker,
     ApplyModificationSequence,
+    ApplyStateModifications,
     TemplateDictWriter,
 )
 from .term import FORMAT_MESSAGE
+from .watch import ProjectWatcher
+from .workspace import WorkspaceRunner
 
 if TYPE_CHECKING:
     from click import Context
@@ -280,7 +290,7 @@ def import_(
 @click.option(
     "--pdf",
     "pdf",
-    help="write .pdf to file",
+    help="write .pdf to file; other documents and variants are written next to it",
     type=click.Path(exists=False, writable=True, path_type=Path),
 )
 @click.option(
@@ -288,17 +298,94 @@ def import_(
     help="write .log to file",
     type=click.Path(exists=False, writable=True, path_type=Path),
 )
+@click.option(
+    "--only",
+    "only",
+    multiple=True,
+    metavar="FILE",
+    help="only compile the chapter FILE loaded with '\\include' (may be repeated)",
+)
+@click.option(
+    "--changed",
+    "changed",
+    is_flag=True,
+    default=False,
+    help="only compile the chapters which changed since the last build",
+)
+@click.option(
+    "--all-variants",
+    "all_variants",
+    is_flag=True,
+    default=False,
+    help="compile each variant of the template dictionary, at the same time",
+)
 @process_atoms()
-def validate(pdf: Optional[Path], logfile: Optional[Path]) -> Iterable[AtomicIterable]:
+def validate(
+    pdf: Optional[Path],
+    logfile: Optional[Path],
+    only: tuple[str, ...],
+    changed: bool,
+    all_variants: bool,
+) -> Iterable[AtomicIterable]:
     """Check for compilation errors. Compilation is performed by the 'latexmk' command.
     Save the resulting pdf with the '--pdf' argument, or the log file with the
     '--logfile' argument. These options, if specified, will overwrite existing files.
+
+    The other root 'documents', the bibliography and the figures are configured in the
+    [render] and [process] sections of the configuration; see the README.
     """
-    yield LatexCompiler(
-        output_map={
-            k: v for k, v in {".pdf": pdf, ".log": logfile}.items() if v is not None
-        }
-    )
+    output_map = {
+        k: v for k, v in {".pdf": pdf, ".log": logfile}.items() if v is not None
+    }
+    if all_variants and (len(only) > 0 or changed):
+        raise click.UsageError(
+            "--all-variants cannot be combined with --only or --changed"
+        )
+    if len(only) > 0 or changed:
+        names = [chapter_name(name) for name in only]
+        for name, arg in zip(names, only):
+            if name is None:
+                raise click.BadParameter(
+                    f"'{arg}' is outside of the project", param_hint="--only"
+                )
+        yield PartialCompiler(
+            only=[name for name in names if name is not None] if only else None,
+            output_map=output_map,
+        )
+    else:
+        yield LatexCompiler(output_map=output_map, all_variants=all_variants)
+
+
+@cli.command(short_help="Rebuild the project on changes.")
+@click.option(
+    "--debounce",
+    "debounce",
+    default=0.2,
+    show_default=True,
+    type=click.FloatRange(min=0),
+    help="seconds to wait for further changes",
+)
+@click.option(
+    "--force/--no-force",
+    "-f/-F",
+    default=False,
+    help="overwrite local template files on change",
+)
+@process_atoms()
+def watch(debounce: float, force: bool) -> Iterable[AtomicIterable]:
+    """Watch the project for changes and recompile. Compilation is performed by the
+    'latexmk' command in a persistent build directory, so that only changed files are
+    copied and auxiliary files are reused between builds. Files matching the ignore
+    patterns are not watched.
+
+    Changes to the template dictionary, or to the linked files in the texproject data
+    directory, re-render the class and bibliography information. If --force is
+    specified, changed template files are also copied over the local versions.
+
+    Saves which happen within DEBOUNCE seconds of each other are combined into a single
+    build. Interrupt the process to stop watching.
+    """
+    yield ProjectWatcher(debounce=debounce, force=force)
 
 
 @cli.command(short_help="Create compressed exports.")
@@ -316,10 +403,72 @@ def validate(pdf: Optional[Path], logfile: Optional[Path]) -> Iterable[AtomicIte
     show_default=True,
     help="specify what to export",
 )
+@click.option(
+    "--threads",
+    "threads",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="compression threads, or 0 for all cores",
+)
+@click.option(
+    "--level",
+    "level",
+    type=click.IntRange(0, 22),
+    help="compression level, at most 9 except for zstdtar",
+)
+@click.option(
+    "--tracked/--all-files",
+    "tracked",
+    default=None,
+    help="only export files tracked by git  [default: archive_tracked from config]",
+)
+@click.option(
+    "--rev",
+    "rev",
+    metavar="COMMIT",
+    help="export the project at a git revision, without changing the working tree",
+)
+@click.option(
+    "--minimal",
+    "minimal",
+    is_flag=True,
+    default=False,
+    help="only export files used by the document, as listed by 'tpr deps'",
+)
+@click.option(
+    "--flatten",
+    "flatten",
+    is_flag=True,
+    default=False,
+    help="inline the input files of the main file, as 'tpr flatten'",
+)
+@click.option(
+    "--max-size",
+    "max_size",
+    metavar="SIZE",
+    help="recompress images to fit the archive within SIZE, such as '50M'",
+)
+@click.option(
+    "--variant",
+    "variant",
+    metavar="NAME",
+    help="export the variant NAME of the template dictionary",
+)
 @click.argument("output", type=click.Path(exists=False, writable=True, path_type=Path))
 @process_atoms()
 def archive(
-    compression: str, mode: ExportMode, output: Path
+    compression: str,
+    mode: ExportMode,
+    threads: int,
+    level: Optional[int],
+    tracked: Optional[bool],
+    rev: Optional[str],
+    minimal: bool,
+    flatten: bool,
+    max_size: Optional[str],
+    variant: Optional[str],
+    output: Path,
 ) -> Iterable[AtomicIterable]:
     """Create a compressed export with name OUTPUT. If the 'arxiv' or 'build' options
     are chosen, 'latexmk' is used to compile additional required files.
@@ -343,19 +492,137 @@ def archive(
      gztar: gzip'ed tar-file
      tar: uncompressed tar-file
      xztar: xz'ed tar-file
+     zstdtar: zstd'ed tar-file (requires Python 3.14 or the 'zstandard' package)
      zip: ZIP file
 
     Note that some compression modes may not be available on your system. The available
     options are listed below.
     """
     if compression is None:
+        suffix = "".join(output.suffixes[-2:])
+        if suffix not in SHUTIL_ARCHIVE_SUFFIX_MAP:
+            suffix = output.suffix
         try:
-            compression = SHUTIL_ARCHIVE_SUFFIX_MAP[output.suffix]
-            output = output.parent / output.stem
+            compression = SHUTIL_ARCHIVE_SUFFIX_MAP[suffix]
+            output = output.parent / output.name.removesuffix(suffix)
         except KeyError:
             compression = "tar"
 
-    yield ArchiveWriter(compression, output, fmt=mode)
+    if level is not None and level > 9 and compression != "zstdtar":
+        raise click.BadParameter(
+            f"level {level} is only supported by 'zstdtar'", param_hint="--level"
+        )
+
+    try:
+        max_bytes = None if max_size is None else parse_size(max_size)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint="--max-size")
+
+    yield ArchiveWriter(
+        compression,
+        output,
+        fmt=mode,
+        threads=threads,
+        level=level,
+        tracked=tracked,
+        rev=rev,
+        minimal=minimal,
+        flatten=flatten,
+        max_size=max_bytes,
+        variant=variant,
+    )
+
+
+@cli.command()
+@process_atoms()
+def deps() -> Iterable[AtomicIterable]:
+    """List the files used by the document. Starting from the main file, the commands
+    '\\input', '\\include', '\\includegraphics' (along with '\\graphicspath'),
+    '\\bibliography', '\\addbibresource' and '\\usepackage' are followed to files in
+    the project directory. If 'tpr watch' has built the project, the files recorded by
+    'latexmk' during the build are included as well.
+
+    References to files which do not exist are reported as errors.
+    """
+    yield DependencyLister()
+
+
+@cli.command()
+@process_atoms()
+def check() -> Iterable[AtomicIterable]:
+    """Check the labels, references and citations of the document without compiling it.
+    Starting from the main file, the files loaded with '\\input' and '\\include' are
+    scanned for '\\label', '\\ref' (and its variants), and '\\cite' (and its
+    variants), which are compared with the entries of the bibliography files.
+
+    Undefined or duplicate labels and citation keys, and missing bibliography files, are
+    reported as errors. Unused bibliography entries are reported as warnings. The scans
+    of the files are cached by their contents, so only changed files are scanned again.
+
+    Labels which are defined by packages or by macros, such as 'LastPage', are not
+    seen by the scan. References to them are not reported if they match one of the
+    patterns in 'check_external_labels' in the [process] section of the configuration.
+    """
+    yield DocumentChecker()
+
+
+@cli.command()
+@click.argument("output", type=click.Path(exists=False, writable=True, path_type=Path))
+@process_atoms()
+def flatten(output: Path) -> Iterable[AtomicIterable]:
+    """Write the main file to OUTPUT as a single file. The files loaded with '\\input'
+    and '\\include' are inlined recursively, where '\\include' starts a new page on
+    both sides of the file and respects '\\includeonly'. Files which are not part of the
+    project, such as installed packages, are not inlined.
+    """
+    yield FlattenWriter(output)
+
+
+@cli.command(
+    short_help="Run a command in many projects.",
+    context_settings={"ignore_unknown_options": True, "allow_interspersed_args": False},
+)
+@click.option(
+    "--jobs",
+    "jobs",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="projects processed at once, or 0 for all cores",
+)
+@click.option(
+    "--json",
+    "report",
+    help="write a JSON report of the results to file",
+    type=click.Path(exists=False, writable=True, path_type=Path),
+)
+@click.argument(
+    "root", type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=Path)
+)
+@click.argument("args", nargs=-1, required=True, type=click.UNPROCESSED)
+@process_atoms(load_template=False)
+def workspace(
+    jobs: int, report: Optional[Path], root: Path, args: tuple[str, ...]
+) -> Iterable[AtomicIterable]:
+    """Run the command ARGS of 'tpr' in each project below the directory ROOT, such as
+    'tpr workspace ~/papers template util --force'. The projects are the directories
+    containing a template dictionary; hidden directories and the directories inside
+    of projects are not searched. The options of 'tpr workspace' are given before ROOT.
+
+    The projects are processed by a pool of worker processes, with up to --jobs
+    projects at once. Each worker loads the program once, and is reused between
+    projects. The number of projects which succeeded is reported, along with the end of
+    the output of each project which failed. With --json, the exit code and the output
+    of each project are written to a file.
+
+    The --silent and --debug options of 'tpr' are passed on to each project. With
+    --dry-run, only the number of projects is reported.
+    """
+    obj = click.get_current_context().obj
+    options = (["--silent"] if not obj["verbose"] else []) + (
+        ["--debug"] if obj["debug"] else []
+    )
+    yield WorkspaceRunner(root, options + list(args), jobs=jobs, report=report)
 
 
 @cli.group()
@@ -414,6 +681,30 @@ def remove(
     yield InfoFileWriter()
 
 
+@template.command()
+@click.option(
+    "--list",
+    "list_only",
+    is_flag=True,
+    default=False,
+    help="only list the unused packages",
+)
+@process_atoms()
+def prune(list_only: bool) -> Iterable[AtomicIterable]:
+    """Remove the macro and style packages whose definitions are not used from the
+    template dictionary. The control sequences and environments defined by each package
+    are compared with those used by the document, and by the other packages which are
+    used. Packages which contain code other than new definitions, such as
+    '\\renewcommand' or '\\RequirePackage', are reported but never removed.
+    """
+    yield UnusedPackageFinder(remove=not list_only)
+    if not list_only:
+        yield ApplyStateModifications()
+        yield TemplateDictWriter()
+        yield TemplateDictLinker()
+        yield InfoFileWriter()
+
+
 @template.command()
 @process_atoms()
 def edit() -> Iterable[AtomicIterable]:
@@ -589,6 +880,49 @@ def show(
         yield PrecommitWriter(force=True)
 
 
+@cli.group()
+def cite() -> None:
+    """Search the citation files in the data directory. The citation files are indexed
+    on first use, and indexed again when they change."""
+
+
+@cite.command()
+@click.argument("key")
+def where(key: str) -> None:
+    """Print the citation files containing the entry KEY, along with the line on which
+    the entry starts. Keys are compared without case.
+    """
+    index = citation_index()
+    index.update()
+    entries = index.where(key)
+    if len(entries) == 0:
+        click.secho(f"error: no citation file contains '{key}'", err=True)
+        sys.exit(1)
+    for entry in entries:
+        click.echo(f"{entry.name}\t{index.path(entry)}:{index.line_number(entry)}")
+
+
+@cite.command()
+@click.argument("query", nargs=-1, required=True)
+@click.option(
+    "--limit",
+    "limit",
+    default=20,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="maximum number of entries",
+)
+def search(query: tuple[str, ...], limit: int) -> None:
+    """Print the entries of the citation files whose authors, title and year contain
+    every word of QUERY. Words may be abbreviated: 'knu 84' matches an entry by Knuth
+    from 1984.
+    """
+    index = citation_index()
+    index.update()
+    for entry in index.search(" ".join(query), limit):
+        click.echo(str(entry))
+
+
 @cli.command("list")
 @click.argument(
     "res_class", type=click.Choice([e.value for e in LinkMode] + ["template"])
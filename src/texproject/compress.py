@@ -0,0 +1,480 @@
+"""Compression backends for archives. Compressed streams are written as a sequence of
+independent members, so that members can be compressed in parallel in a thread pool
+(the compression libraries release the GIL), and so that already compressed files can
+be stored without compression.
+"""
+
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import bz2
+from collections import deque
+from dataclasses import dataclass
+from fnmatch import translate
+import io
+import lzma
+import math
+import os
+import re
+import struct
+import time
+import zlib
+
+try:
+    from compression import zstd  # type: ignore
+except ImportError:
+    zstd = None
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None  # type: ignore
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ThreadPoolExecutor
+    from typing import BinaryIO, Final, Optional, Protocol, Union
+    from .archive import ArchiveEntry
+
+    _Item = Union[tuple["_ZipRecord", None], tuple[None, Future[bytes]]]
+
+    class _Compressor(Protocol):
+        def compress(self, data: bytes, /) -> bytes: ...
+
+        def flush(self) -> bytes: ...
+
+
+def resolve_threads(threads: int) -> int:
+    """The number of threads to use, where 0 means one per available core."""
+    return threads if threads > 0 else (os.cpu_count() or 1)
+
+
+ZSTD_AVAILABLE: Final = zstd is not None or zstandard is not None
+
+
+def _level(level: Optional[int], default: int) -> int:
+    return default if level is None else level
+
+
+_BLOCK_SIZES: Final = {
+    "gztar": 1 << 20,
+    "bztar": 4 << 20,
+    "xztar": 8 << 20,
+    "zstdtar": 4 << 20,
+}
+
+
+def stream_compressor(
+    compression: str, level: Optional[int], store: bool = False
+) -> _Compressor:
+    """A compressor which produces one self-contained member of the compressed stream.
+    Concatenated gzip, bzip2, xz and zstd members are valid streams for the
+    corresponding decompressors. Since only gzip supports storing data without
+    compression, the fastest setting is used for the other formats when `store` is set.
+    """
+    match compression:
+        case "gztar":
+            return zlib.compressobj(
+                0 if store else _level(level, 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+        case "bztar":
+            return bz2.BZ2Compressor(1 if store else max(1, _level(level, 9)))
+        case "xztar":
+            return lzma.LZMACompressor(preset=0 if store else _level(level, 6))
+        case "zstdtar":
+            return _zstd_compressor(1 if store else _level(level, 3))
+        case _:
+            raise ValueError(f"No stream compressor for format '{compression}'")
+
+
+def _zstd_compressor(level: int) -> _Compressor:
+    """A zstd compressor from the standard library if available (Python 3.14 and
+    later), and otherwise from the 'zstandard' package."""
+    if zstd is not None:
+        return zstd.ZstdCompressor(level=level)
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("No zstd implementation is available")
+
+
+def _compress_block(
+    compression: str, level: Optional[int], store: bool, block: bytes
+) -> bytes:
+    compressor = stream_compressor(compression, level, store)
+    return compressor.compress(block) + compressor.flush()
+
+
+class SegmentedStreamWriter(io.RawIOBase):
+    """A writable stream which compresses its input as a sequence of members.
+
+    Without a thread pool, a single member is written incrementally until the storage
+    mode changes. With a thread pool, the input is split into fixed-size blocks which
+    are compressed in parallel, and the compressed blocks are written to `fileobj` in
+    order.
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        compression: str,
+        level: Optional[int],
+        pool: Optional[ThreadPoolExecutor] = None,
+        max_pending: int = 1,
+    ) -> None:
+        super().__init__()
+        self._fileobj = fileobj
+        self._compression = compression
+        self._level = level
+        self._pool = pool
+        self._block_size = _BLOCK_SIZES[compression]
+        self._max_pending = max_pending
+        self._store = False
+        self._compressor: Optional[_Compressor] = None
+        self._buffer = bytearray()
+        self._pending: deque[Future[bytes]] = deque()
+        self._offset = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._offset
+
+    def set_store(self, store: bool) -> None:
+        """Set whether the following data is stored or compressed. Changing the mode
+        ends the current member."""
+        if store != self._store:
+            self._end_member()
+            self._store = store
+
+    def write(self, data: bytes) -> int:  # type: ignore
+        self._offset += len(data)
+        if self._pool is None:
+            if self._compressor is None:
+                self._compressor = stream_compressor(
+                    self._compression, self._level, self._store
+                )
+            self._fileobj.write(self._compressor.compress(data))
+        else:
+            self._buffer += data
+            while len(self._buffer) >= self._block_size:
+                self._submit(bytes(self._buffer[: self._block_size]))
+                del self._buffer[: self._block_size]
+        return len(data)
+
+    def _submit(self, block: bytes) -> None:
+        assert self._pool is not None
+        self._pending.append(
+            self._pool.submit(
+                _compress_block, self._compression, self._level, self._store, block
+            )
+        )
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def _end_member(self) -> None:
+        if self._compressor is not None:
+            self._fileobj.write(self._compressor.flush())
+            self._compressor = None
+        if len(self._buffer) > 0:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+
+    def close(self) -> None:
+        if not self.closed:
+            if self._offset == 0:
+                # an empty stream still requires a valid member
+                self._fileobj.write(
+                    _compress_block(self._compression, self._level, False, b"")
+                )
+            self._end_member()
+            while len(self._pending) > 0:
+                self._fileobj.write(self._pending.popleft().result())
+        super().close()
+
+
+_BYTE_VALUES: Final = [bytes([i]) for i in range(256)]
+
+
+def sample_entropy(sample: bytes) -> float:
+    """The Shannon entropy of the byte distribution of `sample`, in bits per byte."""
+    if len(sample) == 0:
+        return 0.0
+    total = len(sample)
+    return -sum(
+        count / total * math.log2(count / total)
+        for count in map(sample.count, _BYTE_VALUES)
+        if count > 0
+    )
+
+
+@dataclass
+class CompressionPolicy:
+    """Decide which archive entries are stored without compression. An entry is stored
+    if its name matches one of `store_patterns`, or if the entropy of a sample of its
+    contents is at least `entropy_threshold` bits per byte. Sampling is disabled if the
+    threshold is 0.
+    """
+
+    store_patterns: list[str]
+    entropy_threshold: float = 0.0
+    sample_size: int = 1 << 16
+    min_sample_size: int = 1 << 12
+
+    def __post_init__(self) -> None:
+        self._regex = re.compile(
+            "|".join(translate(pat) for pat in self.store_patterns) or "(?!)"
+        )
+
+    @classmethod
+    def from_config(cls, process: dict) -> CompressionPolicy:
+        return cls(process["store_patterns"], process["store_entropy_threshold"])
+
+    def store(self, entry: ArchiveEntry) -> bool:
+        if entry.is_dir:
+            return False
+        if self._regex.match(entry.arcname.name):
+            return True
+        if self.entropy_threshold <= 0 or entry.size() < self.min_sample_size:
+            return False
+        with entry.open() as fileobj:
+            sample = fileobj.read(self.sample_size)
+        return sample_entropy(sample) >= self.entropy_threshold
+
+
+def _deflate_chunk(data: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    """Compress a chunk of a file to raw deflate data. Chunks end on a byte boundary
+    (with a sync flush), so the compressed chunks of a file can simply be concatenated.
+    The tail of the previous chunk is used as a dictionary to retain the compression
+    ratio.
+    """
+    if len(zdict) > 0:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(data) + comp.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+_ZIP64_LIMIT: Final = (1 << 31) - 1
+_MAX_32: Final = 0xFFFFFFFF
+_LOCAL_HEADER: Final = struct.Struct("<4s2B4HL2L2H")
+_CENTRAL_HEADER: Final = struct.Struct("<4s4B4HL2L5H2L")
+_END_RECORD: Final = struct.Struct("<4s4H2LH")
+_END_RECORD_64: Final = struct.Struct("<4sQ2H2L4Q")
+_END_LOCATOR_64: Final = struct.Struct("<4sLQL")
+
+
+@dataclass
+class _ZipRecord:
+    name: bytes
+    flag_bits: int
+    method: int
+    dos_time: int
+    dos_date: int
+    external_attr: int
+    zip64: bool
+    crc: int = 0
+    compressed_size: int = 0
+    file_size: int = 0
+    header_offset: int = 0
+
+    @property
+    def version(self) -> int:
+        return 45 if self.zip64 else 20
+
+    def local_header(self) -> bytes:
+        extra = b""
+        csize, usize = self.compressed_size, self.file_size
+        if self.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, usize, csize)
+            csize = usize = _MAX_32
+        return (
+            _LOCAL_HEADER.pack(
+                b"PK\003\004",
+                self.version,
+                0,
+                self.flag_bits,
+                self.method,
+                self.dos_time,
+                self.dos_date,
+                self.crc,
+                csize,
+                usize,
+                len(self.name),
+                len(extra),
+            )
+            + self.name
+            + extra
+        )
+
+    def central_header(self) -> bytes:
+        fields = []
+        usize, csize, offset = self.file_size, self.compressed_size, self.header_offset
+        if self.zip64 or usize > _ZIP64_LIMIT:
+            fields.append(usize)
+            usize = _MAX_32
+        if self.zip64 or csize > _ZIP64_LIMIT:
+            fields.append(csize)
+            csize = _MAX_32
+        if offset > _ZIP64_LIMIT:
+            fields.append(offset)
+            offset = _MAX_32
+        extra = b""
+        if len(fields) > 0:
+            extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields)
+        return (
+            _CENTRAL_HEADER.pack(
+                b"PK\001\002",
+                self.version,
+                3,  # created on unix
+                self.version,
+                0,
+                self.flag_bits,
+                self.method,
+                self.dos_time,
+                self.dos_date,
+                self.crc,
+                csize,
+                usize,
+                len(self.name),
+                len(extra),
+                0,
+                0,
+                0,
+                self.external_attr,
+                offset,
+            )
+            + self.name
+            + extra
+        )
+
+
+class ParallelZipWriter:
+    """Write a ZIP file in which the deflate streams of the entries are compressed in
+    parallel. Large files are split into chunks which are compressed independently,
+    so both archives of many small files and of a few large files benefit. The output
+    must be seekable, since the local headers are completed after writing the data.
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        pool: ThreadPoolExecutor,
+        level: Optional[int],
+        max_pending: int,
+        chunk_size: int = 1 << 20,
+    ) -> None:
+        self._fileobj = fileobj
+        self._pool = pool
+        self._level = _level(level, zlib.Z_DEFAULT_COMPRESSION)
+        self._max_pending = max_pending
+        self._chunk_size = chunk_size
+        self._records: list[_ZipRecord] = []
+        self._pending: deque[_Item] = deque()
+        self._current: Optional[_ZipRecord] = None
+
+    @staticmethod
+    def _record(entry: ArchiveEntry, size: int, method: int) -> _ZipRecord:
+        name = str(entry.arcname) + ("/" if entry.is_dir else "")
+        try:
+            encoded, flag_bits = name.encode("ascii"), 0
+        except UnicodeEncodeError:
+            encoded, flag_bits = name.encode("utf-8"), 0x800
+        year, month, day, hour, minute, second = time.localtime(entry.mtime)[:6]
+        year = max(year, 1980)
+        return _ZipRecord(
+            name=encoded,
+            flag_bits=flag_bits,
+            method=method,
+            dos_time=hour << 11 | minute << 5 | second // 2,
+            dos_date=(year - 1980) << 9 | month << 5 | day,
+            external_attr=(
+                ((0o040000 | entry.mode) << 16) | 0x10
+                if entry.is_dir
+                else (0o100000 | entry.mode) << 16
+            ),
+            zip64=size * 1.05 > _ZIP64_LIMIT,
+            file_size=size,
+        )
+
+    def add(self, entry: ArchiveEntry, compress: bool = True) -> None:
+        """Queue an entry for writing. If `compress` is False, the entry is stored."""
+        if entry.is_dir:
+            self._push((self._record(entry, 0, 0), None))
+            return
+
+        record = self._record(entry, entry.size(), zlib.DEFLATED if compress else 0)
+        self._push((record, None))
+        crc = 0
+        zdict = b""
+        with entry.open() as fileobj:
+            chunk = fileobj.read(self._chunk_size)
+            while True:
+                following = fileobj.read(self._chunk_size)
+                last = len(following) == 0
+                crc = zlib.crc32(chunk, crc)
+                if compress:
+                    future = self._pool.submit(
+                        _deflate_chunk, chunk, zdict, self._level, last
+                    )
+                    zdict = chunk[-(1 << 15) :]
+                else:
+                    future = self._pool.submit(bytes, chunk)
+                self._push((None, future))
+                if last:
+                    break
+                chunk = following
+        record.crc = crc
+
+    def _push(self, item: _Item) -> None:
+        self._pending.append(item)
+        while len(self._pending) > self._max_pending:
+            self._write(self._pending.popleft())
+
+    def _write(self, item: _Item) -> None:
+        record, future = item
+        if record is not None:
+            self._finish_record()
+            record.header_offset = self._fileobj.tell()
+            self._fileobj.write(record.local_header())
+            self._records.append(record)
+            self._current = record
+        elif future is not None and self._current is not None:
+            data = future.result()
+            self._current.compressed_size += len(data)
+            self._fileobj.write(data)
+
+    def _finish_record(self) -> None:
+        """Complete the local header of the entry which was written last."""
+        if self._current is not None:
+            end = self._fileobj.tell()
+            self._fileobj.seek(self._current.header_offset)
+            self._fileobj.write(self._current.local_header())
+            self._fileobj.seek(end)
+            self._current = None
+
+    def close(self) -> None:
+        while len(self._pending) > 0:
+            self._write(self._pending.popleft())
+        self._finish_record()
+
+        cd_offset = self._fileobj.tell()
+        for record in self._records:
+            self._fileobj.write(record.central_header())
+        cd_size = self._fileobj.tell() - cd_offset
+
+        count = len(self._records)
+        if count >= 0xFFFF or cd_offset > _ZIP64_LIMIT or cd_size > _ZIP64_LIMIT:
+            end64_offset = self._fileobj.tell()
+            self._fileobj.write(
+                _END_RECORD_64.pack(
+                    b"PK\006\006", 44, 45, 45, 0, 0, count, count, cd_size, cd_offset
+                )
+            )
+            self._fileobj.write(_END_LOCATOR_64.pack(b"PK\006\007", 0, end64_offset, 1))
+            count = min(count, 0xFFFF)
+            cd_offset = min(cd_offset, _MAX_32)
+            cd_size = min(cd_size, _MAX_32)
+        self._fileobj.write(
+            _END_RECORD.pack(b"PK\005\006", 0, 0, count, count, cd_size, cd_offset, 0)
+        )
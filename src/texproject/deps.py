@@ -0,0 +1,303 @@
+"""Find the files in the project which are used by the document, by scanning the
+sources starting from the main file, and from the recorder output of a previous build.
+"""
+
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+import posixpath
+import re
+
+from .control import AtomicIterable, RuntimeClosure, RuntimeOutput
+from .snapshot import tree_snapshot
+from .tex import iter_commands, split_list
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Final, Iterable, Optional
+    from .control import TempDir
+    from .filesystem import ProjectPath, TemplateDict
+    from .snapshot import TreeSnapshot
+
+
+# the extensions tried by pdflatex for \includegraphics, in order
+GRAPHICS_EXTENSIONS: Final = (
+    ".pdf",
+    ".png",
+    ".jpg",
+    ".mps",
+    ".jpeg",
+    ".jbig2",
+    ".jb2",
+    ".PDF",
+    ".PNG",
+    ".JPG",
+    ".JPEG",
+    ".JBIG2",
+    ".JB2",
+    ".eps",
+)
+
+# files with these suffixes are scanned for further dependencies
+SCANNED_SUFFIXES: Final = frozenset({"", ".tex", ".ltx", ".sty", ".cls"})
+
+_SIGNATURES: Final = {
+    "input": 1,
+    "include": 1,
+    "subfile": 1,
+    "includegraphics": 1,
+    "includepdf": 1,
+    "graphicspath": 1,
+    "bibliography": 1,
+    "addbibresource": 1,
+    "bibliographystyle": 1,
+    "usepackage": 1,
+    "RequirePackage": 1,
+    "documentclass": 1,
+    "LoadClass": 1,
+}
+
+_GRAPHICSPATH_RE: Final = re.compile(r"\{([^{}]*)\}")
+
+
+@dataclass(frozen=True)
+class Reference:
+    """A reference to a file which could not be found."""
+
+    source: PurePosixPath
+    command: str
+    name: str
+
+    def __str__(self) -> str:
+        return f"'\\{self.command}{{{self.name}}}' in '{self.source}'"
+
+
+@dataclass
+class Dependencies:
+    """The files used by the document, relative to the project directory."""
+
+    files: set[PurePosixPath] = field(default_factory=set)
+    missing: list[Reference] = field(default_factory=list)
+
+    def with_parents(self) -> set[PurePosixPath]:
+        """The files along with their parent directories."""
+        paths = set(self.files)
+        for rel in self.files:
+            paths.update(rel.parents[:-1])
+        return paths
+
+
+def project_relative(name: str) -> Optional[PurePosixPath]:
+    """The normalized form of a file name relative to the project directory, or None if
+    the name points outside of the project directory."""
+    rel = posixpath.normpath(name)
+    if posixpath.isabs(rel) or rel == ".." or rel.startswith("../"):
+        return None
+    return PurePosixPath(rel)
+
+
+def is_project_file(snapshot: TreeSnapshot, rel: PurePosixPath) -> bool:
+    """Whether `rel` is a file in the snapshot which is not ignored."""
+    path = snapshot.root / rel
+    if snapshot.is_ignored(path):
+        return False
+    st = snapshot.stat(path)
+    return st is not None and not st.is_dir
+
+
+def input_candidates(command: str, name: str) -> list[str]:
+    """The file names which are tried, in order, by '\\input' and '\\include'."""
+    if command == "include":
+        return [name + ".tex"]
+    return [name] if name.endswith(".tex") else [name + ".tex", name]
+
+
+def read_recorder(fls_path: Path) -> Iterable[PurePosixPath]:
+    """The files read during a build, from the '.fls' file written by the recorder of
+    latexmk, relative to the build directory. Files outside the build directory, such
+    as installed packages, are skipped."""
+    try:
+        lines = fls_path.read_text(errors="surrogateescape").splitlines()
+    except FileNotFoundError:
+        return
+
+    build_dir = fls_path.parent
+    pwd = build_dir
+    for line in lines:
+        kind, _, name = line.partition(" ")
+        if kind == "PWD":
+            pwd = Path(name)
+        elif kind == "INPUT":
+            path = Path(name)
+            if path.is_absolute():
+                for base in (pwd, build_dir):
+                    if path.is_relative_to(base):
+                        path = path.relative_to(base)
+                        break
+                else:
+                    continue
+            rel = posixpath.normpath(path.as_posix())
+            if not rel.startswith("../"):
+                yield PurePosixPath(rel)
+
+
+class DependencyScanner:
+    """Follow the file references of the document, starting from the main file. Files
+    are looked up in `snapshot`, relative to the project directory as TeX does. The
+    graphics are resolved once all files are scanned, since '\\graphicspath' applies to
+    every '\\includegraphics'.
+    """
+
+    def __init__(
+        self, snapshot: TreeSnapshot, generated: Iterable[PurePosixPath] = ()
+    ) -> None:
+        self.snapshot = snapshot
+        # files which are not in the project, but are added to builds and exports
+        self.generated = set(generated)
+        self.deps = Dependencies()
+        self._queue: list[PurePosixPath] = []
+        self._graphics: list[Reference] = []
+        self._graphics_paths: list[str] = [""]
+
+    def _exists(self, rel: PurePosixPath) -> bool:
+        return rel in self.generated or is_project_file(self.snapshot, rel)
+
+    def _resolve(self, names: Iterable[str]) -> Optional[PurePosixPath]:
+        for name in names:
+            rel = project_relative(name)
+            if rel is not None and self._exists(rel):
+                return rel
+        return None
+
+    def add(self, rel: PurePosixPath) -> None:
+        if rel not in self.deps.files:
+            self.deps.files.add(rel)
+            if rel.suffix in SCANNED_SUFFIXES:
+                self._queue.append(rel)
+
+    def _add_reference(
+        self, ref: Reference, candidates: list[str], required: bool = True
+    ) -> None:
+        rel = self._resolve(candidates)
+        if rel is not None:
+            self.add(rel)
+        elif required:
+            self.deps.missing.append(ref)
+
+    def _scan(self, source: PurePosixPath) -> None:
+        try:
+            text = self.snapshot.read_text(self.snapshot.root / source)
+        except (FileNotFoundError, UnicodeDecodeError):
+            return
+
+        for cmd in iter_commands(text, _SIGNATURES):
+            if len(cmd.arguments) == 0:
+                continue
+            arg = cmd.arguments[0].strip().strip('"')
+            ref = Reference(source, cmd.name, arg)
+            match cmd.name:
+                case "input" | "include" | "subfile":
+                    self._add_reference(ref, input_candidates(cmd.name, arg))
+                case "includegraphics" | "includepdf":
+                    self._graphics.append(ref)
+                case "graphicspath":
+                    self._graphics_paths.extend(_GRAPHICSPATH_RE.findall(arg))
+                case "addbibresource":
+                    self._add_reference(ref, [arg])
+                case "bibliography":
+                    for name in split_list(arg):
+                        self._add_reference(
+                            Reference(source, cmd.name, name),
+                            [name if name.endswith(".bib") else name + ".bib"],
+                        )
+                case "bibliographystyle":
+                    self._add_reference(ref, [arg + ".bst"], required=False)
+                case "usepackage" | "RequirePackage":
+                    # most packages are installed, rather than part of the project
+                    for name in split_list(arg):
+                        self._add_reference(ref, [name + ".sty"], required=False)
+                case "documentclass" | "LoadClass":
+                    self._add_reference(ref, [arg + ".cls"], required=False)
+
+    def _resolve_graphics(self) -> None:
+        for ref in self._graphics:
+            if PurePosixPath(ref.name).suffix in GRAPHICS_EXTENSIONS:
+                suffixes: Iterable[str] = ("",)
+            else:
+                suffixes = GRAPHICS_EXTENSIONS + ("",)
+            self._add_reference(
+                ref,
+                [
+                    posixpath.join(prefix, ref.name + suffix)
+                    for prefix in self._graphics_paths
+                    for suffix in suffixes
+                ],
+            )
+
+    def scan(self, main: PurePosixPath) -> Dependencies:
+        self.add(main)
+        while len(self._queue) > 0:
+            self._scan(self._queue.pop())
+        self._resolve_graphics()
+        return self.deps
+
+    def add_recorded(self, fls_path: Path) -> None:
+        """Add the project files which were read during a previous build."""
+        for rel in read_recorder(fls_path):
+            if self._exists(rel):
+                self.add(rel)
+
+
+def scan_dependencies(
+    proj_path: ProjectPath,
+    snapshot: TreeSnapshot,
+    generated: Iterable[PurePosixPath] = (),
+) -> Dependencies:
+    """The files used by the root documents of the project. If the persistent build
+    directory contains the recorder output of a build, the files read during the build
+    are added as well, which covers files loaded by macros that are not understood by
+    the scanner. The `generated` files are treated as files of the project."""
+    scanner = DependencyScanner(snapshot, generated)
+    scanner.add_recorded(
+        proj_path.build_dir / (proj_path.config.render["default_tex_name"] + ".fls")
+    )
+    for name in proj_path.documents[1:]:
+        scanner.add(PurePosixPath(name + ".tex"))
+    return scanner.scan(PurePosixPath(proj_path.main.name))
+
+
+@dataclass
+class DependencyLister(AtomicIterable):
+    """List the files used by the document."""
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        snapshot = tree_snapshot(proj_path, state)
+        deps: list[Dependencies] = []
+
+        def _callable() -> RuntimeOutput:
+            deps.append(scan_dependencies(proj_path, snapshot))
+            return RuntimeOutput(
+                True, "\n".join(sorted(str(rel) for rel in deps[0].files))
+            )
+
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Files used by '{proj_path.main.name}'"),
+            True,
+            _callable,
+        )
+
+        if len(deps) > 0:
+            for ref in deps[0].missing:
+                yield RuntimeClosure(
+                    FORMAT_MESSAGE.error(f"Missing file for {ref}"),
+                    False,
+                    lambda: RuntimeOutput(False),
+                )
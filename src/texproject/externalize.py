@@ -0,0 +1,315 @@
+"""Compile the TikZ pictures of the document separately and in parallel, and replace them
+in the build directory by the resulting PDF files. The files are cached by the source of
+the picture, the preamble of the document, and the files which they use, so unchanged
+pictures are never compiled again.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+
+from .compress import resolve_threads
+from .control import RuntimeClosure, RuntimeOutput
+from .deps import input_candidates, project_relative
+from .flatten import Flattener
+from .tex import iter_commands
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Final, Iterable, Optional, Sequence
+
+
+# changed whenever the figure documents change
+_VERSION: Final = b"texproject-figure-1"
+
+# the directory of the build directory to which the figures are added
+FIGURE_DIR: Final = "tpr-figures"
+
+_SIGNATURES: Final[dict[str, int | str]] = {
+    "begin": "m",
+    "end": "m",
+    "input": 1,
+    "include": 1,
+    "subfile": 1,
+}
+
+# pictures which depend on the rest of the document cannot be compiled separately
+_DEPENDENT_RE: Final = re.compile(
+    r"remember picture|overlay|#"
+    r"|\\(?:label|ref|eqref|pageref|autoref|cref|Cref|cite)(?![A-Za-z])"
+)
+
+_DEPTH_RE: Final = re.compile(r"^texproject-depth=([0-9.]+)pt$", re.MULTILINE)
+
+_FIGURE_DOCUMENT: Final = r"""{preamble}
+\usepackage[active,tightpage]{{preview}}
+\begin{{document}}
+\sbox0{{{picture}}}
+\typeout{{texproject-depth=\the\dp0}}
+\begin{{preview}}\usebox0\end{{preview}}
+\end{{document}}
+"""
+
+
+@dataclass(frozen=True)
+class Picture:
+    """A 'tikzpicture' environment, which spans `source[start:end]`."""
+
+    start: int
+    end: int
+
+    def text(self, source: str) -> str:
+        return source[self.start : self.end]
+
+
+def iter_pictures(source: str, start: int = 0) -> Iterable[Picture]:
+    """The outermost 'tikzpicture' environments which start after `start`, and which
+    can be compiled separately."""
+    depth = 0
+    begin = 0
+    for cmd in iter_commands(source, {"begin": "m", "end": "m"}):
+        if cmd.start < start or cmd.arguments != ("tikzpicture",):
+            continue
+        if cmd.name == "begin":
+            if depth == 0:
+                begin = cmd.start
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+            if depth == 0:
+                picture = Picture(begin, cmd.end)
+                if _DEPENDENT_RE.search(picture.text(source)) is None:
+                    yield picture
+
+
+def document_start(source: str) -> Optional[int]:
+    """The position of '\\begin{document}' in `source`."""
+    for cmd in iter_commands(source, {"begin": "m"}):
+        if cmd.arguments == ("document",):
+            return cmd.start
+    return None
+
+
+class _BuildReader:
+    """Read the text of files in the build directory."""
+
+    def __init__(self, build_dir: Path) -> None:
+        self.build_dir = build_dir
+
+    def __call__(self, rel: PurePosixPath) -> Optional[str]:
+        try:
+            return (self.build_dir / rel).read_text(
+                encoding="utf-8", errors="surrogateescape"
+            )
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+
+
+def _document_files(
+    read_text: _BuildReader, main: PurePosixPath
+) -> list[PurePosixPath]:
+    """The .tex files loaded by the document, starting from `main`."""
+    files = [main]
+    idx = 0
+    while idx < len(files):
+        text = read_text(files[idx]) or ""
+        idx += 1
+        for cmd in iter_commands(text, _SIGNATURES):
+            if cmd.name in ("begin", "end") or len(cmd.arguments) == 0:
+                continue
+            for candidate in input_candidates(cmd.name, cmd.arguments[0].strip()):
+                rel = project_relative(candidate)
+                if rel is not None and rel.suffix == ".tex" and read_text(rel):
+                    if rel not in files:
+                        files.append(rel)
+                    break
+    return files
+
+
+class FigureCache:
+    """The compiled figures, stored in `cache_dir` by their key, along with the depth of
+    the picture below the baseline."""
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = cache_dir
+
+    def lookup(self, key: str) -> Optional[tuple[Path, str]]:
+        try:
+            depth = (self.cache_dir / (key + ".depth")).read_text()
+        except FileNotFoundError:
+            return None
+        return self.cache_dir / (key + ".pdf"), depth
+
+    def store(self, key: str, pdf: Path, depth: str) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # the depth is written last, since it marks the figure as complete
+        for suffix, write in [
+            (".pdf", lambda path: shutil.copyfile(pdf, path)),
+            (".depth", lambda path: path.write_text(depth)),
+        ]:
+            temp = self.cache_dir / f"{key}.{os.getpid()}{suffix}.tmp"
+            write(temp)
+            temp.replace(self.cache_dir / (key + suffix))
+
+
+class Externalizer:
+    """Externalize the pictures of the document in `build_dir`, compiling each picture
+    with `command` in a separate process, with up to `jobs` processes at once."""
+
+    def __init__(
+        self,
+        build_dir: Path,
+        main: PurePosixPath,
+        cache: FigureCache,
+        command: Sequence[str],
+        jobs: int = 0,
+    ) -> None:
+        self.build_dir = build_dir
+        self.main = main
+        self.cache = cache
+        self.command = list(command)
+        self.jobs = resolve_threads(jobs)
+        self._read = _BuildReader(build_dir)
+
+    def _context_digest(self, preamble: str) -> hashlib._Hash:
+        """The hash of the preamble, along with the packages and classes of the project
+        which it may load."""
+        digest = hashlib.sha256(_VERSION)
+        digest.update("\0".join(self.command).encode() + b"\0")
+
+        def _read_preamble(rel: PurePosixPath) -> Optional[str]:
+            return preamble if rel == self.main else self._read(rel)
+
+        for chunk in Flattener(_read_preamble).flatten(self.main):
+            digest.update(chunk.encode("utf-8", errors="surrogateescape"))
+        for path in sorted(self.build_dir.rglob("*")):
+            if path.suffix in (".sty", ".cls") and path.is_file():
+                digest.update(
+                    b"\0" + path.relative_to(self.build_dir).as_posix().encode()
+                )
+                digest.update(hashlib.sha256(path.read_bytes()).digest())
+        return digest
+
+    def _key(self, context: hashlib._Hash, picture: str, files: list[str]) -> str:
+        digest = context.copy()
+        digest.update(b"\0" + picture.encode("utf-8", errors="surrogateescape"))
+        # data files, such as the tables of pgfplots, which are used by the picture
+        for name in files:
+            if name in picture:
+                digest.update(b"\0" + name.encode())
+                digest.update(
+                    hashlib.sha256((self.build_dir / name).read_bytes()).digest()
+                )
+        return digest.hexdigest()
+
+    def _compile(self, key: str, document: str) -> bool:
+        jobname = f"tpr-figure-{key}"
+        (self.build_dir / (jobname + ".tex")).write_text(
+            document, encoding="utf-8", errors="surrogateescape"
+        )
+        try:
+            proc = subprocess.run(
+                self.command + [f"-jobname={jobname}", jobname + ".tex"],
+                cwd=self.build_dir,
+                capture_output=True,
+            )
+        except FileNotFoundError:
+            return False
+        pdf = self.build_dir / (jobname + ".pdf")
+        if proc.returncode != 0 or not pdf.exists():
+            return False
+        log = (self.build_dir / (jobname + ".log")).read_text(errors="replace")
+        depth = _DEPTH_RE.search(log)
+        if depth is None:
+            return False
+        self.cache.store(key, pdf, depth.group(1) + "pt")
+        return True
+
+    def run(self) -> RuntimeOutput:
+        main_text = self._read(self.main)
+        begin = None if main_text is None else document_start(main_text)
+        if main_text is None or begin is None:
+            return RuntimeOutput(True, "No document to externalize")
+        context = self._context_digest(main_text[:begin])
+        files = sorted(
+            path.relative_to(self.build_dir).as_posix()
+            for path in self.build_dir.rglob("*")
+            if path.suffix != ".tex" and path.is_file()
+        )
+
+        # the pictures, with their keys, by the file containing them
+        pictures: dict[PurePosixPath, list[tuple[Picture, str]]] = {}
+        documents: dict[str, str] = {}
+        for rel in _document_files(self._read, self.main):
+            source = self._read(rel) or ""
+            for picture in iter_pictures(source, begin if rel == self.main else 0):
+                text = picture.text(source)
+                key = self._key(context, text, files)
+                pictures.setdefault(rel, []).append((picture, key))
+                if self.cache.lookup(key) is None:
+                    documents[key] = _FIGURE_DOCUMENT.format(
+                        preamble=main_text[:begin].rstrip(), picture=text
+                    )
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            compiled = sum(
+                pool.map(self._compile, documents.keys(), documents.values())
+            )
+
+        (self.build_dir / FIGURE_DIR).mkdir(exist_ok=True)
+        replaced = 0
+        for rel, found in pictures.items():
+            source = self._read(rel) or ""
+            out = []
+            pos = 0
+            for picture, key in found:
+                cached = self.cache.lookup(key)
+                if cached is None:
+                    continue
+                pdf, depth = cached
+                shutil.copyfile(pdf, self.build_dir / FIGURE_DIR / (key + ".pdf"))
+                out.append(source[pos : picture.start])
+                out.append(
+                    f"\\raisebox{{-{depth}}}{{\\pgfimage{{{FIGURE_DIR}/{key}}}}}"
+                )
+                pos = picture.end
+                replaced += 1
+            out.append(source[pos:])
+            (self.build_dir / rel).write_text(
+                "".join(out), encoding="utf-8", errors="surrogateescape"
+            )
+
+        total = sum(len(found) for found in pictures.values())
+        return RuntimeOutput(
+            True,
+            f"Externalized {replaced} of {total} pictures, compiling {compiled}"
+            + (
+                f" ({len(documents) - compiled} failed)"
+                if compiled < len(documents)
+                else ""
+            ),
+        )
+
+
+def externalize_figures(
+    build_dir: Path,
+    main: PurePosixPath,
+    cache_dir: Path,
+    command: Sequence[str],
+    jobs: int = 0,
+) -> RuntimeClosure:
+    """Replace the pictures of the document in `build_dir` by compiled figures. Pictures
+    which fail to compile on their own are left in place."""
+    externalizer = Externalizer(build_dir, main, FigureCache(cache_dir), command, jobs)
+    return RuntimeClosure(
+        FORMAT_MESSAGE.info(f"Externalize pictures in '{build_dir}'"),
+        True,
+        externalizer.run,
+    )
@@ -2,13 +2,14 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
 
+from functools import cached_property
 from importlib.resources import files
 
 from . import defaults
 from pathlib import Path
 from tomllib import loads
 from tomli_w import dumps
-from xdg_base_dirs import xdg_data_home, xdg_config_home
+from xdg_base_dirs import xdg_cache_home, xdg_data_home, xdg_config_home
 
 from .base import (
     NAMES,
@@ -19,6 +20,7 @@ from .base import (
     AddCommand,
     UpdateCommand,
 )
+from .ignore import IgnoreMatcher
 
 if TYPE_CHECKING:
     from typing import Final, Optional, Callable, Any, Iterable
@@ -151,6 +153,11 @@ class _DataPath:
         """TODO: write"""
         return self.data_dir / "templates"
 
+    @constant
+    def cache_dir(self) -> Path:
+        """Cached build outputs, which are shared between projects."""
+        return xdg_cache_home() / "texproject"
+
 
 class _JinjaTemplatePath:
     """TODO: write"""
@@ -263,6 +270,11 @@ class ProjectPath:
         """TODO: write"""
         return "tmp"
 
+    @relative("data")
+    def build_dir(self) -> str:
+        """Persistent build directory, reused between compilations."""
+        return "tmp/build"
+
     @relative("root")
     def main(self) -> str:
         """TODO: write"""
@@ -296,6 +308,22 @@ class ProjectPath:
     def git_files(self) -> list[Path]:
         return [self.gitignore, self.git_home, self.github_home]
 
+    @property
+    def documents(self) -> list[str]:
+        """The names of the root .tex files, without the suffix, starting with the main
+        file."""
+        names = [self.config.render["default_tex_name"]]
+        for name in self.config.render["documents"]:
+            name = name.removesuffix(".tex")
+            if name not in names:
+                names.append(name)
+        return names
+
+    @cached_property
+    def ignore(self) -> IgnoreMatcher:
+        """The compiled ignore patterns, relative to the project directory."""
+        return IgnoreMatcher(self.config.process["ignore_patterns"], self.dir)
+
     @relative("root")
     def latexmain(self) -> str:
         """TODO: write"""
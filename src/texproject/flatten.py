@@ -0,0 +1,168 @@
+"""Inline the files loaded with '\\input' and '\\include' into a single LaTeX source."""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass
+from pathlib import PurePosixPath
+
+from .control import AtomicIterable, RuntimeClosure, RuntimeOutput
+from .deps import input_candidates, is_project_file, project_relative
+from .error import AbortRunner
+from .snapshot import tree_snapshot
+from .tex import iter_commands, split_list
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Callable, Final, Iterable, Optional
+    from pathlib import Path
+    from .control import TempDir
+    from .filesystem import ProjectPath, TemplateDict
+    from .snapshot import TreeSnapshot
+
+
+_SIGNATURES: Final = {"input": 1, "include": 1, "includeonly": 1, "endinput": 0}
+
+
+class Flattener:
+    """Inline '\\input' and '\\include' recursively, starting from a file. The result is
+    produced as a stream of chunks, so only the files which are currently being inlined
+    are held in memory. Files are read with `read_text`, which returns None for files
+    which do not exist; commands which load other files, such as installed packages,
+    are kept as they are.
+
+    An '\\include' is replaced by the file surrounded by '\\clearpage', and files which
+    are excluded by '\\includeonly' are replaced by '\\clearpage' only. The lines after
+    an '\\endinput' are dropped.
+    """
+
+    def __init__(self, read_text: Callable[[PurePosixPath], Optional[str]]) -> None:
+        self.read_text = read_text
+        self.inlined: set[PurePosixPath] = set()
+        self._include_only: Optional[set[str]] = None
+
+    def _resolve(self, command: str, name: str) -> Optional[tuple[PurePosixPath, str]]:
+        for candidate in input_candidates(command, name):
+            rel = project_relative(candidate)
+            if rel is None:
+                continue
+            text = self.read_text(rel)
+            if text is not None:
+                return rel, text
+        return None
+
+    def _chunks(self, text: str, stack: tuple[PurePosixPath, ...]) -> Iterable[str]:
+        pos = 0
+        for cmd in iter_commands(text, _SIGNATURES):
+            if cmd.name == "endinput":
+                yield text[pos : cmd.start]
+                # the rest of the line is still read
+                line_end = text.find("\n", cmd.end)
+                yield text[cmd.end : len(text) if line_end < 0 else line_end]
+                return
+            if len(cmd.arguments) == 0:
+                continue
+            name = cmd.arguments[0].strip().strip('"')
+
+            if cmd.name == "includeonly":
+                self._include_only = set(split_list(cmd.arguments[0]))
+                continue
+
+            if cmd.name == "include" and (
+                self._include_only is not None and name not in self._include_only
+            ):
+                yield text[pos : cmd.start]
+                yield "\\clearpage"
+                pos = cmd.end
+                continue
+
+            resolved = self._resolve(cmd.name, name)
+            if resolved is None:
+                continue
+            rel, contents = resolved
+            if rel in stack:
+                raise AbortRunner(
+                    "Cyclic input: "
+                    + " -> ".join(f"'{path}'" for path in stack + (rel,))
+                )
+            self.inlined.add(rel)
+
+            # the final newline of the file is replaced by the end of the line of the
+            # command, unless the command is followed by more text on the same line
+            line_end = text.find("\n", cmd.end)
+            rest = text[cmd.end : len(text) if line_end < 0 else line_end]
+            keep_newline = cmd.name == "include" or not (rest == "" or rest.isspace())
+
+            yield text[pos : cmd.start]
+            if cmd.name == "include":
+                yield "\\clearpage\n"
+            yield from self._inlined(contents, stack + (rel,), keep_newline)
+            if cmd.name == "include":
+                yield "\\clearpage"
+            pos = cmd.end
+
+        yield text[pos:]
+
+    def _inlined(
+        self, contents: str, stack: tuple[PurePosixPath, ...], keep_newline: bool
+    ) -> Iterable[str]:
+        last = ""
+        for chunk in self._chunks(contents, stack):
+            if chunk == "":
+                continue
+            if last != "":
+                yield last
+            last = chunk
+        yield last.removesuffix("\n")
+        if keep_newline:
+            yield "\n"
+
+    def flatten(self, main: PurePosixPath) -> Iterable[str]:
+        text = self.read_text(main)
+        if text is None:
+            raise AbortRunner(f"Could not read '{main}'.")
+        yield from self._chunks(text, (main,))
+
+
+def snapshot_reader(
+    snapshot: TreeSnapshot,
+) -> Callable[[PurePosixPath], Optional[str]]:
+    """Read the text of files in the snapshot which are not ignored."""
+
+    def read_text(rel: PurePosixPath) -> Optional[str]:
+        if not is_project_file(snapshot, rel):
+            return None
+        return snapshot.read_text(snapshot.root / rel)
+
+    return read_text
+
+
+def write_flattened(
+    flattener: Flattener, main: PurePosixPath, target: Path
+) -> RuntimeOutput:
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with open(target, "w", encoding="utf-8", errors="surrogateescape") as fileobj:
+        for chunk in flattener.flatten(main):
+            fileobj.write(chunk)
+    return RuntimeOutput(True, f"Inlined {len(flattener.inlined)} files into '{main}'")
+
+
+@dataclass
+class FlattenWriter(AtomicIterable):
+    """Write the main file, with all of the files it loads inlined, to `output_file`."""
+
+    output_file: Path
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        main = PurePosixPath(proj_path.main.name)
+        flattener = Flattener(snapshot_reader(tree_snapshot(proj_path, state)))
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Flatten '{main}' into '{self.output_file}'"),
+            True,
+            lambda: write_flattened(flattener, main, self.output_file),
+        )
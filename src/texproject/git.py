@@ -10,6 +10,7 @@ from .filesystem import JINJA_PATH
 from .utils import run_command
 from .template import JinjaTemplate
 from .term import FORMAT_MESSAGE
+import os
 import subprocess
 
 if TYPE_CHECKING:
@@ -29,6 +30,23 @@ def is_git_repo(path: Path) -> bool:
     )
 
 
+def tracked_files(path: Path) -> list[str]:
+    """The files below `path` in the git index, relative to `path`, from a single
+    'git ls-files' call."""
+    try:
+        proc = subprocess.run(
+            ["git", "ls-files", "-z", "--cached"], cwd=path, capture_output=True
+        )
+    except FileNotFoundError:
+        raise AbortRunner("could not find command 'git'")
+    if proc.returncode != 0:
+        raise AbortRunner(
+            "Could not list the tracked files. Is the project a git repository?",
+            stderr=proc.stderr,
+        )
+    return [os.fsdecode(name) for name in proc.stdout.split(b"\0") if name != b""]
+
+
 def git_has_remote(path: Path) -> bool:
     return (
         subprocess.run(
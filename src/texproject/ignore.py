@@ -0,0 +1,194 @@
+"""Match paths against the ignore patterns of a project, using the same rules as the
+.gitignore file which is rendered from them.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass
+import os
+import re
+
+if TYPE_CHECKING:
+    from pathlib import Path
+    from typing import Callable, Iterable, Optional
+
+
+_GLOB_CHARS = frozenset("*?[\\")
+
+
+def _translate(glob: str) -> str:
+    """Translate a gitignore glob to a regular expression. A '*' or '?' never matches a
+    '/', whereas '**' matches any number of directories."""
+    parts = []
+    i, n = 0, len(glob)
+    while i < n:
+        c = glob[i]
+        if glob.startswith("**/", i) and (i == 0 or glob[i - 1] == "/"):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if glob.startswith("**", i) and i + 2 == n and (i == 0 or glob[i - 1] == "/"):
+            parts.append(".*")
+            break
+        if c == "*":
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            parts.append(re.escape(glob[i]))
+        elif c == "[":
+            j = i + 1
+            if j < n and glob[j] in "!^":
+                j += 1
+            if j < n and glob[j] == "]":
+                j += 1
+            while j < n and glob[j] != "]":
+                j += 1
+            if j >= n:
+                parts.append("\\[")
+            else:
+                body = glob[i + 1 : j].replace("\\", "\\\\")
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                parts.append(f"(?!/)[{body}]")
+                i = j
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return "".join(parts)
+
+
+@dataclass(frozen=True)
+class _Rule:
+    regex: str
+    anchored: bool
+    dir_only: bool
+    negate: bool
+
+
+def _parse(pattern: str) -> Optional[tuple[_Rule, str]]:
+    """Parse a line of a .gitignore file, returning the rule along with the glob."""
+    if pattern.startswith("#") or pattern.strip() == "":
+        return None
+    # trailing spaces are ignored unless escaped
+    stripped = pattern.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(pattern):
+        stripped += " "
+    pattern = stripped
+
+    negate = pattern.startswith("!")
+    if negate or pattern.startswith("\\!") or pattern.startswith("\\#"):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    glob = pattern.lstrip("/")
+    return _Rule(_translate(glob), anchored, dir_only, negate), glob
+
+
+class IgnoreMatcher:
+    """A compiled set of ignore patterns with .gitignore semantics.
+
+    Patterns without a slash match the name of a file or directory at any depth, and
+    other patterns match the path relative to `root`. Patterns ending with a slash only
+    match directories. Since the contents of an ignored directory are never visited,
+    they are ignored as well.
+
+    The common patterns of the form '*.ext' and plain names are matched with a suffix
+    table and a set lookup, and all other patterns are combined into a single regular
+    expression. Negated patterns require the patterns to be evaluated in order, which
+    is done only if any are present.
+    """
+
+    def __init__(self, patterns: Iterable[str], root: Path) -> None:
+        self.root = root
+        self._root = str(root)
+        self.patterns = list(patterns)
+
+        rules = []
+        suffixes: list[str] = []
+        names: set[str] = set()
+        for parsed in map(_parse, self.patterns):
+            if parsed is None:
+                continue
+            rule, glob = parsed
+            if not (rule.anchored or rule.dir_only or rule.negate):
+                if glob.startswith("*") and _GLOB_CHARS.isdisjoint(glob[1:]):
+                    suffixes.append(glob[1:])
+                    continue
+                if _GLOB_CHARS.isdisjoint(glob):
+                    names.add(glob)
+                    continue
+            rules.append(rule)
+
+        self._suffixes = tuple(suffixes)
+        self._names = frozenset(names)
+        self._has_dir_rules = any(rule.dir_only for rule in rules)
+        self._ordered: Optional[list[tuple[_Rule, re.Pattern]]] = None
+        if any(rule.negate for rule in rules):
+            # evaluate all patterns in order, so that the last matching pattern wins
+            self._ordered = [
+                (rule, re.compile(rule.regex))
+                for rule, _ in filter(None, map(_parse, self.patterns))
+            ]
+            self._has_dir_rules = any(rule.dir_only for rule, _ in self._ordered)
+
+        def _combine(anchored: bool, dir_only: bool) -> Optional[re.Pattern]:
+            selected = [
+                rule.regex
+                for rule in rules
+                if rule.anchored == anchored and rule.dir_only == dir_only
+            ]
+            if len(selected) == 0:
+                return None
+            return re.compile("|".join(f"(?:{regex})" for regex in selected))
+
+        self._name_regex = _combine(False, False)
+        self._path_regex = _combine(True, False)
+        self._dir_name_regex = _combine(False, True)
+        self._dir_path_regex = _combine(True, True)
+
+    def match(self, relpath: str, is_dir: bool | Callable[[], bool] = False) -> bool:
+        """Whether the path `relpath` (relative to the root, with '/' separators) is
+        matched by the patterns. The parent directories of `relpath` are not checked.
+        """
+        name = relpath.rpartition("/")[2]
+        if self._ordered is not None:
+            ignored = False
+            for rule, regex in self._ordered:
+                if rule.negate != ignored:
+                    continue
+                if rule.dir_only and not (is_dir() if callable(is_dir) else is_dir):
+                    continue
+                if regex.fullmatch(relpath if rule.anchored else name):
+                    ignored = not rule.negate
+            return ignored
+
+        if (
+            name in self._names
+            or name.endswith(self._suffixes)
+            or (self._name_regex is not None and self._name_regex.fullmatch(name))
+            or (self._path_regex is not None and self._path_regex.fullmatch(relpath))
+        ):
+            return True
+        if self._has_dir_rules and (is_dir() if callable(is_dir) else is_dir):
+            return bool(
+                (self._dir_name_regex and self._dir_name_regex.fullmatch(name))
+                or (self._dir_path_regex and self._dir_path_regex.fullmatch(relpath))
+            )
+        return False
+
+    def __call__(self, directory: str, names: list[str]) -> set[str]:
+        """Select the ignored names in `directory`, which must be below the root. This
+        has the same interface as the `ignore` argument of `shutil.copytree`."""
+        prefix = os.path.relpath(directory, self._root).replace(os.sep, "/")
+        prefix = "" if prefix == "." else prefix + "/"
+        return {
+            name
+            for name in names
+            if self.match(
+                prefix + name,
+                lambda: os.path.isdir(os.path.join(directory, name)),
+            )
+        }
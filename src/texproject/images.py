@@ -0,0 +1,212 @@
+"""Downsample and recompress the raster images of an export, to keep the export within
+a size limit such as the one of arXiv. This requires the optional 'Pillow' package.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import io
+import os
+
+try:
+    from PIL import Image  # type: ignore
+except ImportError:
+    Image = None  # type: ignore
+
+from .archive import format_size
+from .compress import resolve_threads
+from .control import RuntimeOutput
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Callable, Final, Iterable, Optional
+    from pathlib import Path, PurePosixPath
+    from .archive import ArchiveEntry
+
+
+PILLOW_AVAILABLE: Final = Image is not None
+
+# changed whenever the recompression changes
+_VERSION: Final = "texproject-image-1"
+
+RASTER_SUFFIXES: Final = (".png", ".jpg", ".jpeg")
+
+# the resolution and quality which are tried in turn to fit within a size limit, after
+# the configured settings
+_FALLBACK_SETTINGS: Final = ((200, 80), (150, 75), (100, 70))
+
+# the number of files listed in the size report
+_REPORTED_FILES: Final = 10
+
+
+@dataclass(frozen=True)
+class ImageSettings:
+    """Downsample images to at most `dpi` when printed `width` inches wide, and save
+    JPEG images with `quality`."""
+
+    dpi: int = 300
+    width: float = 6.5
+    quality: int = 85
+
+    @property
+    def max_pixels(self) -> int:
+        return round(self.dpi * self.width)
+
+    def fallbacks(self) -> list[ImageSettings]:
+        """These settings, followed by the settings which give smaller images."""
+        return [self] + [
+            ImageSettings(dpi, self.width, min(quality, self.quality))
+            for dpi, quality in _FALLBACK_SETTINGS
+            if dpi < self.dpi
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.dpi} dpi at {self.width:g} in, quality {self.quality}"
+
+
+def recompress_image(data: bytes, suffix: str, settings: ImageSettings) -> bytes:
+    """The image `data` downsampled and recompressed with `settings`, or `data` if the
+    result is not smaller or the image cannot be read. The resolution recorded in the
+    image is scaled along with the image, so that its natural size in the document does
+    not change."""
+    assert Image is not None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            x_dpi, y_dpi = image.info.get("dpi", (72, 72))
+            scale = min(1.0, settings.max_pixels / max(width, height))
+            resized = image.resize(
+                (max(1, round(width * scale)), max(1, round(height * scale))),
+                Image.Resampling.LANCZOS,
+            )
+    except (OSError, ValueError):
+        return data
+    out = io.BytesIO()
+    options = {"optimize": True, "dpi": (x_dpi * scale, y_dpi * scale)}
+    if suffix.lower() == ".png":
+        resized.save(out, "PNG", **options)
+    else:
+        resized.save(out, "JPEG", quality=settings.quality, **options)
+    return min(out.getvalue(), data, key=len)
+
+
+def _recompress_task(args: tuple[bytes, str, ImageSettings]) -> bytes:
+    return recompress_image(*args)
+
+
+class ImageCache:
+    """The recompressed images, stored in `cache_dir` by the hash of the image and the
+    settings."""
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = cache_dir
+
+    def path(self, data: bytes, suffix: str, settings: ImageSettings) -> Path:
+        digest = hashlib.sha256(
+            f"{_VERSION}\0{settings!r}\0{suffix.lower()}\0".encode()
+        )
+        digest.update(data)
+        return self.cache_dir / (digest.hexdigest() + suffix.lower())
+
+    def store(self, path: Path, data: bytes) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temp.write_bytes(data)
+        temp.replace(path)
+
+
+class ImageRecompressor:
+    """Recompress the raster images of an export with `settings`, with up to `jobs`
+    processes at once. If `max_size` is given, the smaller settings of
+    `ImageSettings.fallbacks` are tried in turn until the files of the export fit within
+    `max_size` bytes."""
+
+    def __init__(
+        self,
+        cache: ImageCache,
+        settings: ImageSettings,
+        max_size: Optional[int] = None,
+        jobs: int = 0,
+    ) -> None:
+        self.cache = cache
+        self.settings = settings
+        self.max_size = max_size
+        self.jobs = resolve_threads(jobs)
+        # the recompressed images, by their name in the export
+        self.replaced: dict[PurePosixPath, Path] = {}
+
+    def _recompress(
+        self, images: dict[PurePosixPath, bytes], settings: ImageSettings
+    ) -> dict[PurePosixPath, Path]:
+        paths = {
+            arcname: self.cache.path(data, arcname.suffix, settings)
+            for arcname, data in images.items()
+        }
+        pending = [arcname for arcname, path in paths.items() if not path.exists()]
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            results = pool.map(
+                _recompress_task,
+                [(images[arcname], arcname.suffix, settings) for arcname in pending],
+            )
+            for arcname, data in zip(pending, results):
+                self.cache.store(paths[arcname], data)
+        return paths
+
+    def run(self, get_entries: Callable[[], Iterable[ArchiveEntry]]) -> RuntimeOutput:
+        sizes: dict[PurePosixPath, int] = {}
+        images: dict[PurePosixPath, bytes] = {}
+        for entry in get_entries():
+            if entry.is_dir:
+                continue
+            if entry.arcname.suffix.lower() in RASTER_SUFFIXES:
+                with entry.open() as fileobj:
+                    images[entry.arcname] = fileobj.read()
+                sizes[entry.arcname] = len(images[entry.arcname])
+            else:
+                sizes[entry.arcname] = entry.size()
+        original = dict(sizes)
+
+        messages = []
+        if not PILLOW_AVAILABLE:
+            messages.append(
+                FORMAT_MESSAGE.error("Recompressing images requires 'Pillow'")
+            )
+        elif len(images) > 0:
+            candidates = (
+                self.settings.fallbacks()
+                if self.max_size is not None
+                else [self.settings]
+            )
+            for settings in candidates:
+                paths = self._recompress(images, settings)
+                for arcname, path in paths.items():
+                    sizes[arcname] = path.stat().st_size
+                if self.max_size is None or sum(sizes.values()) <= self.max_size:
+                    break
+            self.replaced = {
+                arcname: path
+                for arcname, path in paths.items()
+                if sizes[arcname] < original[arcname]
+            }
+            messages.append(
+                f"Recompressed {len(self.replaced)} of {len(images)} images with"
+                f" {settings}"
+            )
+
+        total = sum(sizes.values())
+        budget = self.max_size or total
+        messages.append(
+            f"Export files: {format_size(sum(original.values()))} ->"
+            f" {format_size(total)}"
+            + ("" if self.max_size is None else f" of {format_size(self.max_size)}")
+        )
+        for arcname in sorted(sizes, key=sizes.__getitem__, reverse=True)[
+            :_REPORTED_FILES
+        ]:
+            messages.append(
+                f"  {format_size(sizes[arcname]):>10}"
+                f" {100 * sizes[arcname] / max(budget, 1):5.1f}%  {arcname}"
+            )
+        return RuntimeOutput(True, "\n".join(messages))
@@ -1,30 +1,71 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
 
-from dataclasses import dataclass
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import cache, partial
+from operator import attrgetter, contains
+from pathlib import PurePosixPath
+import posixpath
 import shlex
+import shutil
 
-from .base import UpdateCommand, LinkMode, ExportMode
-from .control import RuntimeClosure, AtomicIterable, RuntimeOutput, TempDir
-from .filesystem import JINJA_PATH, ProjectPath
-from .template import (
-    JinjaTemplate,
-    apply_template_dict_modification,
-    TemplateDictLinker,
-)
-from .term import FORMAT_MESSAGE
-from .utils import (
-    run_cmd,
-    remove_path,
-    rename_path,
-    copy_directory,
+from .archive import (
+    ExportOverlay,
+    extract_entries,
+    format_size,
+    iter_snapshot,
     make_archive,
-    CleanProject,
 )
+from .assets import AssetCache, AssetConverter
+from .base import NAMES, UpdateCommand, RemoveCommand, LinkMode, ExportMode
+from .bibtex import (
+    CITING_SUFFIXES,
+    BibliographyCache,
+    BibliographyPruner,
+    CachedBibliography,
+    prune_bibliography_files,
+    read_aux,
+    scan_citations,
+    unscanned_citations,
+    unscanned_message,
+)
+from .compress import CompressionPolicy, resolve_threads
+from .control import (
+    RuntimeClosure,
+    AtomicIterable,
+    RuntimeOutput,
+    TempDir,
+    FAIL,
+    SUCCESS,
+)
+from .deps import DependencyScanner, scan_dependencies
+from .externalize import externalize_figures
+from .filesystem import DATA_PATH, JINJA_PATH, LINKER_MAP, ProjectPath
+from .flatten import Flattener, snapshot_reader, write_flattened
+from .git import tracked_files
+from .images import ImageCache, ImageRecompressor, ImageSettings
+from .revision import RevisionSnapshot
+from .snapshot import TreeSnapshot, replace_snapshot, tree_snapshot
+from .template import JinjaTemplate, apply_template_dict_modification
+from .tex import (
+    command_usage,
+    csname_prefixes,
+    drop_definitions,
+    iter_definitions,
+    strip_comments,
+)
+from .term import FORMAT_MESSAGE
+from .utils import run_cmd, copy_directory
+from .variants import select_variants
 
 if TYPE_CHECKING:
+    from .archive import ArchiveEntry
+    from .base import ModCommand
     from .filesystem import TemplateDict
-    from typing import Optional, Iterable
+    from .variants import Variant
+    from typing import Callable, Final, Optional, Iterable, Sequence
     from pathlib import Path
 
 
@@ -32,18 +73,35 @@ def compile_latex(
     proj_path: ProjectPath,
     build_dir: Path,
     check: bool = False,
+    options: Sequence[str] = (),
+    document: Optional[str] = None,
 ) -> RuntimeClosure:
-    """Compile the latex files located at build_dir"""
+    """Compile the latex files located at build_dir. The root files other than the
+    main file are compiled into their own output directory, so that documents which are
+    compiled at once do not share auxiliary files."""
+    name = document or proj_path.config.render["default_tex_name"]
+    outdir = _document_dir(proj_path, name)
 
-    short_cmd = [
-        "latexmk",
-        "-pdf",
-        "-interaction=nonstopmode",
-    ] + proj_path.config.process["latexmk_compile_options"]
+    short_cmd = (
+        [
+            "latexmk",
+            "-pdf",
+            "-interaction=nonstopmode",
+        ]
+        + proj_path.config.process["latexmk_compile_options"]
+        + list(options)
+        + ([] if outdir is None else [f"-outdir={outdir}"])
+    )
 
     def _callable() -> RuntimeOutput:
+        if outdir is not None:
+            # pdflatex does not create the directories for the files of '\\include'
+            for path in [build_dir, *build_dir.rglob("*")]:
+                rel = path.relative_to(build_dir)
+                if path.is_dir() and not rel.is_relative_to(_DOCUMENTS_DIR):
+                    (build_dir / outdir / rel).mkdir(parents=True, exist_ok=True)
         out = run_cmd(
-            short_cmd + [proj_path.config.render["default_tex_name"] + ".tex"],
+            short_cmd + [name + ".tex"],
             build_dir,
             check=check,
         )
@@ -52,7 +110,7 @@ def compile_latex(
     return RuntimeClosure(
         FORMAT_MESSAGE.info(
             "Compiling LaTeX file"
-            f" '{build_dir}/{proj_path.config.render['default_tex_name']}.tex' with"
+            f" '{build_dir}/{name}.tex' with"
             f" command '{shlex.join(short_cmd)}'"
         ),
         True,
@@ -60,15 +118,112 @@ def compile_latex(
     )
 
 
+# the output directories of the root files other than the main file, in the build
+# directory
+_DOCUMENTS_DIR: Final = "tpr-documents"
+
+
+def _document_dir(proj_path: ProjectPath, document: str) -> Optional[str]:
+    if document == proj_path.config.render["default_tex_name"]:
+        return None
+    return posixpath.join(_DOCUMENTS_DIR, document)
+
+
+def document_output(
+    proj_path: ProjectPath, build_dir: Path, document: str, filetype: str
+) -> Path:
+    """The output file with suffix `filetype` of the root file `document`."""
+    outdir = _document_dir(proj_path, document)
+    if outdir is None:
+        return build_dir / (document + filetype)
+    return build_dir / outdir / (posixpath.basename(document) + filetype)
+
+
+def compile_documents(
+    proj_path: ProjectPath, closures: dict[str, RuntimeClosure]
+) -> RuntimeClosure:
+    """Run the compilations `closures`, by the name of the compiled document, at once,
+    with up to 'document_jobs' at a time."""
+    names = list(closures)
+    if len(names) == 1:
+        return closures[names[0]]
+    jobs = min(resolve_threads(proj_path.config.process["document_jobs"]), len(names))
+
+    def _callable() -> RuntimeOutput:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            outputs = list(pool.map(RuntimeClosure.run, closures.values()))
+        messages = []
+        for name, output in zip(names, outputs):
+            if not output.success:
+                messages.append(FORMAT_MESSAGE.error(f"Compiling {name} failed"))
+                messages.append(str(output.message() or ""))
+        return RuntimeOutput(len(messages) == 0, "\n".join(messages) or None)
+
+    return RuntimeClosure(
+        FORMAT_MESSAGE.info(
+            f"Compiling {len(names)} documents, {jobs} at once: " + ", ".join(names)
+        ),
+        True,
+        _callable,
+    )
+
+
+def _document_label(document: str, variant: Optional[Variant] = None) -> str:
+    label = f"'{document}.tex'"
+    return label if variant is None else f"{label} ({variant.name})"
+
+
+def output_targets(
+    proj_path: ProjectPath,
+    target: Path,
+    filetype: str,
+    variant: Optional[Variant] = None,
+) -> dict[str, Path]:
+    """The files to which the outputs of the root files are written, given the target
+    of the main file. Within a directory, the outputs keep their names. Otherwise, the
+    other outputs are written next to `target`, with the name of the document added.
+    The name of the variant is added to the names of the outputs of a variant."""
+    tag = "" if variant is None else f"-{variant.name}"
+    names = proj_path.documents
+    if target.is_dir():
+        return {
+            name: target / (posixpath.basename(name) + tag + filetype) for name in names
+        }
+    return {names[0]: target.with_name(f"{target.stem}{tag}{target.suffix}")} | {
+        name: target.with_name(
+            f"{target.stem}-{posixpath.basename(name)}{tag}{target.suffix}"
+        )
+        for name in names[1:]
+    }
+
+
 def copy_output(
-    proj_path: ProjectPath, build_dir: Path, output_map: dict[str, Path]
+    proj_path: ProjectPath,
+    build_dir: Path,
+    output_map: dict[str, Path],
+    keep: bool = False,
+    documents: Optional[Sequence[str]] = None,
+    variant: Optional[Variant] = None,
 ) -> RuntimeClosure:
+    """Move the output files of the root files `documents`, by default only the main
+    file, out of `build_dir`, or copy them if `keep`, for instance when the build
+    directory is persistent."""
+    if documents is None:
+        documents = [proj_path.config.render["default_tex_name"]]
+    targets = [
+        (document_output(proj_path, build_dir, name, filetype), target)
+        for filetype, output in output_map.items()
+        for name, target in output_targets(proj_path, output, filetype, variant).items()
+        if name in documents
+    ]
+
     def _callable() -> RuntimeOutput:
-        for filetype, target in output_map.items():
+        for source, target in targets:
             try:
-                (
-                    build_dir / (proj_path.config.render["default_tex_name"] + filetype)
-                ).rename(target)
+                if keep:
+                    shutil.copyfile(source, target)
+                else:
+                    source.rename(target)
             except FileNotFoundError:
                 pass
         # todo: catch the case where something cannot be copied, even when requested!
@@ -77,32 +232,224 @@ def copy_output(
     return RuntimeClosure(
         FORMAT_MESSAGE.info(
             "Creating output files: "
-            + ", ".join(f"'{path.name}'" for path in output_map.values())
+            + ", ".join(f"'{target.name}'" for _, target in targets)
         ),
         True,
         _callable,
     )
 
 
+def _render_variant_info(
+    proj_path: ProjectPath, template_dict: TemplateDict, variant: Variant
+) -> str:
+    return JinjaTemplate(JINJA_PATH.classinfo).get_text(
+        proj_path, template_dict, variant=variant
+    )
+
+
+def _variant_message(variant: Variant) -> str:
+    return FORMAT_MESSAGE.info(
+        f"Render the class information of variant '{variant.name}'"
+    )
+
+
+def write_variant_info(
+    proj_path: ProjectPath,
+    template_dict: TemplateDict,
+    variant: Variant,
+    build_dir: Path,
+) -> RuntimeClosure:
+    """Replace the class information file in `build_dir` by the one of `variant`."""
+    target = build_dir / proj_path.classinfo.relative_to(proj_path.dir)
+
+    def _callable() -> RuntimeOutput:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(_render_variant_info(proj_path, template_dict, variant))
+        return RuntimeOutput(True)
+
+    return RuntimeClosure(_variant_message(variant), True, _callable)
+
+
 @dataclass
 class LatexCompiler(AtomicIterable):
+    """Compile the root files of the project in a temporary build directory, and copy
+    the output files in `output_map` out of it. With `all_variants`, each variant of
+    the template dictionary is compiled in its own build directory, with the class
+    information of the variant, and all of the documents are compiled at once."""
+
     output_map: Optional[dict[str, Path]]
+    all_variants: bool = False
 
     def __call__(
         self,
         proj_path: ProjectPath,
-        _template_dict: TemplateDict,
-        _state: dict,
+        template_dict: TemplateDict,
+        state: dict,
         temp_dir: TempDir,
     ) -> Iterable[RuntimeClosure]:
-        # copy files to a build directory and compile
-        build_dir = temp_dir.provision()
-        yield copy_directory(proj_path, proj_path.dir, build_dir)
-        yield compile_latex(proj_path, build_dir)
+        variants: list[Optional[Variant]] = [None]
+        if self.all_variants:
+            try:
+                variants = list(select_variants(template_dict, None))
+            except ValueError as err:
+                yield RuntimeClosure(FORMAT_MESSAGE.error(str(err)), *FAIL)
+                return
+
+        snapshot = tree_snapshot(proj_path, state)
+        converter = None
+        if proj_path.config.process["convert_assets"]:
+            # the figures are converted once, and copied to each build directory
+            converter = _asset_converter(proj_path, snapshot)
+            yield converter.convert()
+
+        closures: dict[str, RuntimeClosure] = {}
+        succeeded: set[str] = set()
+        stores: list[RuntimeClosure] = []
+        outputs: list[RuntimeClosure] = []
+        for variant in variants:
+            # copy files to a build directory and compile
+            build_dir = temp_dir.provision()
+            yield copy_directory(snapshot, build_dir)
+            if variant is not None:
+                yield write_variant_info(proj_path, template_dict, variant, build_dir)
+            if converter is not None:
+                yield converter.copy_to(build_dir)
+            if proj_path.config.process["prune_bibliography"]:
+                yield prune_bibliography_files(
+                    snapshot, build_dir, _build_aux(proj_path)
+                )
+            if proj_path.config.process["externalize_figures"]:
+                yield _externalize(proj_path, build_dir)
+
+            # bibtex is skipped when the bibliography is restored from the cache
+            cached = _cached_bibliography(proj_path)
+            bbl_path = build_dir / (
+                proj_path.config.render["default_tex_name"] + ".bbl"
+            )
+            if cached is not None:
+                yield cached.restore(
+                    snapshot_reader(snapshot),
+                    PurePosixPath(proj_path.main.name),
+                    _build_aux(proj_path),
+                    bbl_path,
+                )
+            restored = cached is not None and cached.restored
+            for name in proj_path.documents:
+                label = _document_label(name, variant)
+                closures[label] = _record_success(
+                    compile_latex(
+                        proj_path,
+                        build_dir,
+                        options=(
+                            ["-bibtex-"]
+                            if restored and name == proj_path.documents[0]
+                            else ()
+                        ),
+                        document=name,
+                    ),
+                    succeeded,
+                    label,
+                )
+            if cached is not None and not restored:
+                # the .bbl file is only generated by the main document
+                main_label = _document_label(proj_path.documents[0], variant)
+                stores.append(
+                    cached.store(bbl_path, partial(contains, succeeded, main_label))
+                )
+
+            # copy the relevant output
+            if self.output_map is not None and len(self.output_map) > 0:
+                outputs.append(
+                    copy_output(
+                        proj_path,
+                        build_dir,
+                        output_map=self.output_map,
+                        documents=proj_path.documents,
+                        variant=variant,
+                    )
+                )
+
+        yield compile_documents(proj_path, closures)
+        yield from stores
+        yield from outputs
+
+
+def _record_success(
+    closure: RuntimeClosure, succeeded: set[str], label: str
+) -> RuntimeClosure:
+    """Add `label` to `succeeded` if `closure` succeeds."""
+
+    def _callable() -> RuntimeOutput:
+        output = closure.run()
+        if output.success:
+            succeeded.add(label)
+        return output
+
+    return RuntimeClosure(closure.message(), closure.success(), _callable)
+
+
+def _build_aux(proj_path: ProjectPath) -> Path:
+    """The .aux file in the persistent build directory."""
+    return proj_path.build_dir / (proj_path.config.render["default_tex_name"] + ".aux")
 
-        # copy the relevant output
-        if self.output_map is not None and len(self.output_map) > 0:
-            yield copy_output(proj_path, build_dir, output_map=self.output_map)
+
+def _cached_bibliography(proj_path: ProjectPath) -> Optional[CachedBibliography]:
+    if not proj_path.config.process["cache_bibliography"]:
+        return None
+    return CachedBibliography(BibliographyCache(DATA_PATH.cache_dir / "bbl"))
+
+
+def _asset_converter(proj_path: ProjectPath, snapshot: TreeSnapshot) -> AssetConverter:
+    return AssetConverter(
+        snapshot,
+        AssetCache(DATA_PATH.cache_dir / "assets"),
+        proj_path.config.process["asset_commands"],
+        proj_path.config.process["asset_jobs"],
+    )
+
+
+def _externalize(proj_path: ProjectPath, build_dir: Path) -> RuntimeClosure:
+    return externalize_figures(
+        build_dir,
+        PurePosixPath(proj_path.main.name),
+        DATA_PATH.cache_dir / "figures",
+        proj_path.config.process["externalize_command"],
+        proj_path.config.process["externalize_jobs"],
+    )
+
+
+@dataclass
+class ExportContext:
+    """The state of an export which is shared by the steps of its pipeline: the files
+    of the project, and the modifications applied to them. The modifications are applied
+    in a single pass over the files when the export is written."""
+
+    snapshot: TreeSnapshot
+    data_dir_name: str
+    overlay: ExportOverlay = field(default_factory=ExportOverlay)
+    include: Optional[set[PurePosixPath]] = None
+    variant: Optional[Variant] = None
+
+    def entries(self) -> Iterable[ArchiveEntry]:
+        entries = iter_snapshot(self.snapshot)
+        if self.include is not None:
+            entries = (entry for entry in entries if entry.arcname in self.include)
+        return self.overlay.apply(entries)
+
+    def read_text(self, arcname: PurePosixPath) -> Optional[str]:
+        """The text of a file in the export, or None if it is not part of the export."""
+        read_source = snapshot_reader(self.snapshot)
+
+        def _read_included(rel: PurePosixPath) -> Optional[str]:
+            if self.include is not None and rel not in self.include:
+                return None
+            return read_source(rel)
+
+        return self.overlay.read_text(arcname, _read_included)
+
+
+def export_context(state: dict) -> ExportContext:
+    return state["export"]
 
 
 @dataclass
@@ -110,6 +457,14 @@ class ArchiveWriter(AtomicIterable):
     compression: str
     output_file: Path
     fmt: ExportMode = ExportMode.source
+    threads: int = 1
+    level: Optional[int] = None
+    tracked: Optional[bool] = None
+    rev: Optional[str] = None
+    minimal: bool = False
+    flatten: bool = False
+    max_size: Optional[int] = None
+    variant: Optional[str] = None
 
     def __call__(
         self,
@@ -118,192 +473,675 @@ class ArchiveWriter(AtomicIterable):
         state: dict,
         temp_dir: TempDir,
     ) -> Iterable[RuntimeClosure]:
-        build_dir = temp_dir.provision()
-
-        # must copy before ModifyArxiv
-        yield copy_directory(proj_path, proj_path.dir, build_dir)
+        tracked = self.tracked
+        if tracked is None:
+            tracked = proj_path.config.process["archive_tracked"]
+        if self.rev is not None:
+            # the files and the template dictionary are read from the revision
+            revision = RevisionSnapshot(proj_path, self.rev)
+            snapshot = replace_snapshot(state, revision)
+            template_dict = revision.template_dict(proj_path, temp_dir)
+        elif tracked:
+            snapshot = replace_snapshot(
+                state,
+                TreeSnapshot(
+                    proj_path.dir,
+                    proj_path.ignore,
+                    proj_path.temp_dir,
+                    list_files=partial(tracked_files, proj_path.dir),
+                ),
+            )
+        else:
+            snapshot = tree_snapshot(proj_path, state)
 
-        # compile the tex files to get .bbl / .pdf
-        if self.fmt in (ExportMode.arxiv, ExportMode.build):
-            if self.fmt == ExportMode.arxiv:
-                yield from ModifyArxiv(build_dir)(
-                    proj_path, template_dict, state, temp_dir
-                )
-                output_map = {
-                    ".bbl": build_dir
-                    / (proj_path.config.render["default_tex_name"] + ".bbl")
-                }
-            else:
-                output_map = {
-                    ".pdf": build_dir
-                    / (proj_path.config.render["default_tex_name"] + ".pdf")
-                }
-            yield compile_latex(proj_path, build_dir, check=True)
-            yield copy_output(proj_path, build_dir, output_map)
-
-        elif self.fmt == ExportMode.nohidden:
-            yield from ModifyNoHidden(build_dir)(
+        export = ExportContext(snapshot, proj_path.data_dir.name)
+        state["export"] = export
+        if self.variant is not None:
+            try:
+                (export.variant,) = select_variants(template_dict, [self.variant])
+            except ValueError as err:
+                yield RuntimeClosure(FORMAT_MESSAGE.error(str(err)), *FAIL)
+                return
+        if proj_path.config.process["convert_assets"]:
+            yield from ConvertAssets()(proj_path, template_dict, state, temp_dir)
+        if self.minimal:
+            yield from SelectDependencies()(proj_path, template_dict, state, temp_dir)
+        steps = EXPORT_PIPELINES[self.fmt]
+        if self.flatten or self.variant is not None:
+            # modify the export before compiling, so that the compiled export is the
+            # modified one
+            steps = (
+                [step for step in steps if not isinstance(step, CompileOutput)]
+                + ([WriteVariantInfo()] if self.variant is not None else [])
+                + ([FlattenMain()] if self.flatten else [])
+                + [step for step in steps if isinstance(step, CompileOutput)]
+            )
+        for step in steps:
+            yield from step(proj_path, template_dict, state, temp_dir)
+        if self.max_size is not None or (
+            self.fmt == ExportMode.arxiv
+            and proj_path.config.process["arxiv_recompress_images"]
+        ):
+            yield from RecompressImages(self.max_size)(
                 proj_path, template_dict, state, temp_dir
             )
 
-        yield make_archive(build_dir, self.output_file, self.compression)
+        yield make_archive(
+            export.entries,
+            self.output_file,
+            self.compression,
+            self.threads,
+            self.level,
+            CompressionPolicy.from_config(proj_path.config.process),
+            self.max_size,
+        )
+
+
+def _read_stripped(path: Path) -> str:
+    return path.read_text().strip()
 
 
 @dataclass
-class ModifyArxiv(AtomicIterable):
-    working_dir: Path
+class ConvertAssets(AtomicIterable):
+    """Add the figures which are converted to PDF, such as SVG and EPS files, to the
+    export. This is enabled with 'convert_assets'."""
 
     def __call__(
         self,
         proj_path: ProjectPath,
-        template_dict: TemplateDict,
+        _template_dict: TemplateDict,
         state: dict,
-        temp_dir: TempDir,
+        _temp_dir: TempDir,
     ) -> Iterable[RuntimeClosure]:
-        # rename data directory to a filename with no dots and which does not exist
-        new_data_dir_name = proj_path.data_dir.name.replace(".", "")
-        while (self.working_dir / new_data_dir_name).exists():
-            new_data_dir_name += "X"
-        new_data_dir = self.working_dir / new_data_dir_name
+        export = export_context(state)
+        converter = _asset_converter(proj_path, export.snapshot)
+        yield converter.convert()
+        for rel, path in converter.converted.items():
+            yield export.overlay.add_path(rel, path)
 
-        main_tex_path = self.working_dir / (
-            proj_path.config.render["default_tex_name"] + ".tex"
-        )
-        new_proj_path = ProjectPath(self.working_dir, data_dir=new_data_dir)
 
-        yield rename_path(self.working_dir / proj_path.data_dir.name, new_data_dir)
-        for st in ("classinfo_file", "bibinfo_file"):
-            yield remove_path(new_data_dir / (proj_path.config.render[st] + ".tex"))
+@dataclass
+class RecompressImages(AtomicIterable):
+    """Downsample and recompress the PNG and JPEG images of the export, and report the
+    size of the largest files. If `max_size` is given, smaller settings are tried until
+    the files fit within `max_size` bytes."""
 
-        # perform substitutions that arxiv does not like, respecting existing files
-        yield apply_template_dict_modification(
-            template_dict,
-            UpdateCommand(LinkMode.macro, "typesetting", "arxiv-typesetting"),
+    max_size: Optional[int] = None
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        export = export_context(state)
+        process = proj_path.config.process
+        recompressor = ImageRecompressor(
+            ImageCache(DATA_PATH.cache_dir / "images"),
+            ImageSettings(
+                process["image_dpi"], process["image_width"], process["image_quality"]
+            ),
+            self.max_size,
+            process["image_jobs"],
         )
-        yield from TemplateDictLinker()(
-            new_proj_path,
-            template_dict,
-            state,
-            temp_dir,
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info("Recompress images in export"),
+            True,
+            lambda: recompressor.run(export.entries),
         )
+        for arcname, path in recompressor.replaced.items():
+            yield export.overlay.add_path(arcname, path)
+
+
+@dataclass
+class SelectDependencies(AtomicIterable):
+    """Only export the files which are used by the document."""
 
-        # todo: during dry run, temp_dir may not exist! in this situation, nothing will
-        # print... todo: think about what sort of controls are required when interacting
-        # with temp directories, or if it is fine for stuff to just fail. For example,
-        # when some commands depend on modifications done by other commands / filesystem
-        # state, (e.g. cleaning here) stuff will break very subtly
-        yield from CleanProject()(new_proj_path, template_dict, state, temp_dir)
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        export = export_context(state)
 
-        # replace \input{...classinfo.tex} and \input{...bibinfo.tex}
-        # with the contents of the corresponding files
         def _callable() -> RuntimeOutput:
-            with open(main_tex_path, "r", encoding="utf-8") as texfile:
-                new_contents = texfile.read()
+            deps = scan_dependencies(
+                proj_path, export.snapshot, generated=export.overlay.files
+            )
+            export.include = deps.with_parents()
+            # files added to the export are only kept if they are used
+            for rel in set(export.overlay.files) - export.include:
+                del export.overlay.files[rel]
+            return RuntimeOutput(
+                True,
+                "\n".join(
+                    FORMAT_MESSAGE.error(f"Missing file for {ref}")
+                    for ref in deps.missing
+                )
+                or None,
+            )
 
-                for end, writer in [
-                    (
-                        proj_path.config.render["classinfo_file"],
-                        JinjaTemplate(JINJA_PATH.classinfo),
-                    ),
-                    (
-                        proj_path.config.render["bibinfo_file"],
-                        JinjaTemplate(JINJA_PATH.bibinfo),
-                    ),
-                ]:
-                    new_contents = new_contents.replace(
-                        r"\input{" + proj_path.data_dir.name + "/" + end + r"}" + "\n",
-                        writer.get_text(
-                            proj_path,
-                            template_dict,
-                            render_mods={"project_data_folder": new_data_dir_name},
-                        ),
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Select files used by '{proj_path.main.name}'"),
+            True,
+            _callable,
+        )
+
+
+@dataclass
+class FlattenMain(AtomicIterable):
+    """Replace the main file of the export by a single file, with the files it loads
+    inlined, and remove the inlined files which are not used by the other root
+    documents from the export, along with the directories which are left empty."""
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        export = export_context(state)
+        main = PurePosixPath(proj_path.main.name)
+        target = temp_dir.provision()
+        flattener = Flattener(export.read_text)
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Flatten '{main}'"),
+            True,
+            lambda: write_flattened(flattener, main, target),
+        )
+        yield export.overlay.add_path(main, target)
+
+        # the other documents are not flattened, so they still need their inputs
+        removed = set(flattener.inlined)
+        others = [PurePosixPath(name + ".tex") for name in proj_path.documents[1:]]
+        if len(others) > 0:
+            scanner = DependencyScanner(export.snapshot)
+            for rel in others[1:]:
+                scanner.add(rel)
+            removed -= scanner.scan(others[0]).files
+        for rel in sorted(removed):
+            yield export.overlay.remove(rel)
+
+        # remove the directories which only contained inlined files
+        kept = {
+            parent
+            for entry in export.entries()
+            if not entry.is_dir
+            for parent in entry.arcname.parents
+        }
+        emptied = {
+            parent for rel in removed for parent in rel.parents if parent not in kept
+        }
+        for directory in sorted(emptied):
+            if directory.parent not in emptied:
+                yield export.overlay.remove(directory)
+
+
+# the number of bytes read from each exported file to decide if it is a text file
+_TEXT_SAMPLE_SIZE: Final = 8192
+
+
+def _is_text_entry(entry: ArchiveEntry) -> bool:
+    if entry.is_dir:
+        return False
+    with entry.open() as fileobj:
+        return b"\0" not in fileobj.read(_TEXT_SAMPLE_SIZE)
+
+
+class StripComments(AtomicIterable):
+    """Strip the comments from the .tex files of the export, which is enabled with
+    'arxiv_strip_comments', and remove the lines which define macros that are not used,
+    which is enabled with 'arxiv_drop_unused_macros'. A macro is used if it occurs in
+    any text file of the export, including the generated .bbl file, or if its name may
+    be built with '\\csname'."""
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        strip = proj_path.config.process["arxiv_strip_comments"]
+        drop = proj_path.config.process["arxiv_drop_unused_macros"]
+        if not (strip or drop):
+            return
+        export = export_context(state)
+        tex_files: list[PurePosixPath] = []
+        unused: set[str] = set()
+
+        def _strip(text: str) -> str:
+            if strip:
+                text = strip_comments(text)
+            return drop_definitions(text, unused)
+
+        def _callable() -> RuntimeOutput:
+            # macros may also be used by the local packages, the bibliography, and
+            # files which are included with '\\input', such as figures
+            sources = [
+                entry.arcname for entry in export.entries() if _is_text_entry(entry)
+            ]
+            usage: Counter[str] = Counter()
+            definitions: Counter[str] = Counter()
+            prefixes: set[str] = set()
+            original: dict[PurePosixPath, str] = {}
+            for arcname in sources:
+                text = export.read_text(arcname)
+                if text is None:
+                    continue
+                if arcname.suffix == ".tex":
+                    tex_files.append(arcname)
+                    original[arcname] = text
+                    definitions.update(
+                        definition.name for definition in iter_definitions(text)
                     )
-            with open(main_tex_path, "w", encoding="utf-8") as texfile:
-                texfile.write(new_contents)
-            return RuntimeOutput(True)
+                usage.update(command_usage(text))
+                prefixes.update(csname_prefixes(text))
 
+            if drop:
+                unused.update(
+                    name
+                    for name in definitions
+                    if usage[name] <= definitions[name]
+                    and not any(name.startswith(prefix) for prefix in prefixes)
+                )
+            removed = sum(
+                len(text.encode("utf-8", "surrogateescape"))
+                - len(_strip(text).encode("utf-8", "surrogateescape"))
+                for text in original.values()
+            )
+            return RuntimeOutput(
+                True, f"Removed {format_size(removed)} from {len(tex_files)} files"
+            )
+
+        parts = {"comments": strip, "unused macro definitions": drop}
+        message = " and ".join(part for part, enabled in parts.items() if enabled)
         yield RuntimeClosure(
-            FORMAT_MESSAGE.info("Modifying main tex file."),
+            FORMAT_MESSAGE.info(f"Strip {message}"),
             True,
             _callable,
         )
-        yield JinjaTemplate(JINJA_PATH.arxiv_autotex).write(
-            proj_path, template_dict, state, self.working_dir / "000README.XXX"
-        )
+        for arcname in tex_files:
+            yield export.overlay.rewrite(
+                arcname,
+                _strip,
+                message=FORMAT_MESSAGE.info(f"Strip {message} from '{arcname}'"),
+            )
 
 
 @dataclass
-class ModifyNoHidden(AtomicIterable):
-    working_dir: Path
+class PruneBibliography(AtomicIterable):
+    """Prune the .bib files of the export to the entries which are cited. This is
+    enabled with 'prune_bibliography'."""
 
     def __call__(
         self,
         proj_path: ProjectPath,
-        template_dict: TemplateDict,
+        _template_dict: TemplateDict,
         state: dict,
-        temp_dir: TempDir,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        if not proj_path.config.process["prune_bibliography"]:
+            return
+        export = export_context(state)
+        pruner = BibliographyPruner()
+        bib_files: list[PurePosixPath] = []
+
+        def _callable() -> RuntimeOutput:
+            pruner.add_citations(read_aux(_build_aux(proj_path)))
+            unscanned: dict[str, PurePosixPath] = {}
+            for entry in export.entries():
+                if entry.arcname.suffix in CITING_SUFFIXES:
+                    source = export.read_text(entry.arcname) or ""
+                    pruner.add_citations(scan_citations(source))
+                    unscanned.update(
+                        dict.fromkeys(unscanned_citations(source), entry.arcname)
+                    )
+                elif entry.arcname.suffix == ".bib":
+                    bib_files.append(entry.arcname)
+            if len(unscanned) > 0:
+                bib_files.clear()
+                return RuntimeOutput(True, unscanned_message(unscanned))
+            for arcname in bib_files:
+                pruner.add_database(export.read_text(arcname) or "")
+            return RuntimeOutput(True, pruner.summary(len(bib_files)))
+
+        yield RuntimeClosure(FORMAT_MESSAGE.info("Collect citations"), True, _callable)
+        for arcname in bib_files:
+            yield export.overlay.rewrite(
+                arcname,
+                pruner.prune,
+                message=FORMAT_MESSAGE.info(f"Prune bibliography file '{arcname}'"),
+            )
+
+
+@dataclass
+class RenameDataDir(AtomicIterable):
+    """Rename the data directory to a name with no dots, and which does not exist."""
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
     ) -> Iterable[RuntimeClosure]:
-        # rename data directory to a filename with no dots and which does not exist
+        export = export_context(state)
         new_data_dir_name = proj_path.data_dir.name.replace(".", "")
-        while (self.working_dir / new_data_dir_name).exists():
+        while export.snapshot.exists(proj_path.dir / new_data_dir_name):
             new_data_dir_name += "X"
-        new_data_dir = self.working_dir / new_data_dir_name
 
-        main_tex_path = self.working_dir / (
-            proj_path.config.render["default_tex_name"] + ".tex"
+        export.data_dir_name = new_data_dir_name
+        yield export.overlay.rename(
+            PurePosixPath(proj_path.data_dir.name), PurePosixPath(new_data_dir_name)
         )
-        new_proj_path = ProjectPath(self.working_dir, data_dir=new_data_dir)
 
-        yield rename_path(self.working_dir / proj_path.data_dir.name, new_data_dir)
-        for st in ("classinfo_file", "bibinfo_file"):
-            yield remove_path(new_data_dir / (proj_path.config.render[st] + ".tex"))
 
-        yield from TemplateDictLinker()(
-            new_proj_path,
-            template_dict,
-            state,
-            temp_dir,
-        )
+@dataclass
+class WriteVariantInfo(AtomicIterable):
+    """Replace the class information file of the export by the one of the variant of
+    the export, unless the file was inlined into the main file."""
 
-        # todo: during dry run, temp_dir may not exist! in this situation, nothing will
-        # print... todo: think about what sort of controls are required when interacting
-        # with temp directories, or if it is fine for stuff to just fail. For example,
-        # when some commands depend on modifications done by other commands / filesystem
-        # state, (e.g. cleaning here) stuff will break very subtly
-        yield from CleanProject(remove_git_files=True)(
-            new_proj_path, template_dict, state, temp_dir
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        export = export_context(state)
+        arcname = PurePosixPath(export.data_dir_name, proj_path.classinfo.name)
+        if export.variant is None or export.read_text(arcname) is None:
+            return
+        yield export.overlay.add_text(
+            arcname,
+            partial(_render_variant_info, proj_path, template_dict, export.variant),
+            message=_variant_message(export.variant),
         )
 
-        # replace \input{...classinfo.tex} and \input{...bibinfo.tex}
-        # with the contents of the corresponding files
-        def _callable() -> RuntimeOutput:
-            with open(main_tex_path, "r", encoding="utf-8") as texfile:
-                new_contents = texfile.read()
 
-                for end, writer in [
-                    (
-                        proj_path.config.render["classinfo_file"],
-                        JinjaTemplate(JINJA_PATH.classinfo),
-                    ),
-                    (
-                        proj_path.config.render["bibinfo_file"],
-                        JinjaTemplate(JINJA_PATH.bibinfo),
+@dataclass
+class InlineInfoFiles(AtomicIterable):
+    """Replace \\input{...classinfo} and \\input{...bibinfo} in the main tex file with
+    the contents of the corresponding files, and remove the files from the export.
+    """
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        export = export_context(state)
+        data_dir_name = export.data_dir_name
+        info_files = [
+            (proj_path.config.render["classinfo_file"], JINJA_PATH.classinfo),
+            (proj_path.config.render["bibinfo_file"], JINJA_PATH.bibinfo),
+        ]
+        for name, _ in info_files:
+            yield export.overlay.remove(PurePosixPath(data_dir_name, name + ".tex"))
+
+        @cache
+        def rendered() -> list[tuple[str, str]]:
+            return [
+                (
+                    r"\input{" + proj_path.data_dir.name + "/" + name + "}\n",
+                    JinjaTemplate(template_path).get_text(
+                        proj_path,
+                        template_dict,
+                        render_mods={"project_data_folder": data_dir_name},
+                        variant=export.variant,
                     ),
-                ]:
-                    new_contents = new_contents.replace(
-                        r"\input{" + proj_path.data_dir.name + "/" + end + r"}" + "\n",
-                        writer.get_text(
-                            proj_path,
-                            template_dict,
-                            render_mods={"project_data_folder": new_data_dir_name},
-                        ),
-                    )
-            with open(main_tex_path, "w", encoding="utf-8") as texfile:
-                texfile.write(new_contents)
-            return RuntimeOutput(True)
+                )
+                for name, template_path in info_files
+            ]
 
-        yield RuntimeClosure(
-            FORMAT_MESSAGE.info("Modifying main tex file."),
-            True,
-            _callable,
+        def transform(text: str) -> str:
+            for source, target in rendered():
+                text = text.replace(source, target)
+            return text
+
+        yield export.overlay.rewrite(
+            PurePosixPath(proj_path.main.name),
+            transform,
+            message=FORMAT_MESSAGE.info("Modifying main tex file."),
+        )
+
+
+@dataclass
+class ModifyTemplateDict(AtomicIterable):
+    """Modify the template dictionary used for the export."""
+
+    mod: ModCommand
+
+    def __call__(
+        self,
+        _proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        _state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        yield apply_template_dict_modification(template_dict, self.mod)
+
+
+@dataclass
+class AddRenderedFile(AtomicIterable):
+    """Render a template into the export."""
+
+    template_path: Path
+    target: Callable[[ProjectPath], Path]
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        yield export_context(state).overlay.add_text(
+            PurePosixPath(self.target(proj_path).name),
+            lambda: JinjaTemplate(self.template_path).get_text(
+                proj_path, template_dict
+            ),
+        )
+
+
+@dataclass
+class CompileOutput(AtomicIterable):
+    """Compile the export in a temporary build directory, and add the output file with
+    suffix `filetype` to the export. Each of the root files is compiled."""
+
+    filetype: str
+
+    def documents(self, proj_path: ProjectPath) -> list[str]:
+        return proj_path.documents
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        export = export_context(state)
+        build_dir = temp_dir.provision()
+        yield extract_entries(export.entries, proj_path.dir, build_dir)
+        # the pictures only change the typeset output
+        if self.filetype == ".pdf" and proj_path.config.process["externalize_figures"]:
+            yield _externalize(proj_path, build_dir)
+        yield compile_documents(
+            proj_path,
+            {
+                _document_label(name): compile_latex(
+                    proj_path, build_dir, check=True, document=name
+                )
+                for name in self.documents(proj_path)
+            },
         )
+
+        for name in self.documents(proj_path):
+            yield export.overlay.add_path(
+                PurePosixPath(name + self.filetype),
+                document_output(proj_path, build_dir, name, self.filetype),
+            )
+
+
+@dataclass
+class CompileBibliography(CompileOutput):
+    """Add the .bbl file to the export. The file is taken from the cache if the same
+    bibliography was generated before, by an export or by a build of 'tpr validate', in
+    which case the export is not compiled."""
+
+    filetype: str = ".bbl"
+
+    def documents(self, proj_path: ProjectPath) -> list[str]:
+        # only the main file is compiled by arxiv
+        return proj_path.documents[:1]
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        state: dict,
+        temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        cached = _cached_bibliography(proj_path)
+        if cached is None:
+            yield from super().__call__(proj_path, template_dict, state, temp_dir)
+            return
+
+        export = export_context(state)
+        build_dir = temp_dir.provision()
+        name = PurePosixPath(proj_path.config.render["default_tex_name"] + self.filetype)
+        yield cached.restore(
+            snapshot_reader(export.snapshot),
+            PurePosixPath(proj_path.main.name),
+            _build_aux(proj_path),
+            build_dir / name,
+        )
+        if not cached.restored:
+            succeeded: set[str] = set()
+            yield extract_entries(export.entries, proj_path.dir, build_dir)
+            yield _record_success(
+                compile_latex(proj_path, build_dir, check=True), succeeded, "main"
+            )
+            yield cached.store(build_dir / name, partial(contains, succeeded, "main"))
+        yield export.overlay.add_path(name, build_dir / name)
+
+
+@dataclass
+class OverlayTemplateDictLinker(AtomicIterable):
+    """Add the template files which are missing from the project to the export, in the
+    same way that `TemplateDictLinker` would link them into a copy of the project.
+    """
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        export = export_context(state)
+        for mode in LinkMode:
+            linker = LINKER_MAP[mode]
+            target_dir = PurePosixPath(
+                export.data_dir_name, NAMES.resource_subdir(mode)
+            )
+            for name in template_dict[NAMES.convert_mode(mode)]:
+                rel_path = NAMES.rel_data_path(name + linker.suffix, mode)
+                source_path = linker.file_path(name).resolve()
+                message_args = (linker, name, target_dir)
+
+                if export.snapshot.exists(proj_path.data_dir / rel_path):
+                    yield RuntimeClosure(
+                        FORMAT_MESSAGE.link(*message_args, mode="exists"), *SUCCESS
+                    )
+                elif source_path.exists():
+                    yield export.overlay.add_text(
+                        PurePosixPath(export.data_dir_name, rel_path),
+                        partial(_read_stripped, source_path),
+                        message=FORMAT_MESSAGE.link(*message_args, mode="new"),
+                    )
+                else:
+
+                    def _fail_callable(
+                        mode: LinkMode = mode, name: str = name
+                    ) -> RuntimeOutput:
+                        state["template_modifications"].append(
+                            RemoveCommand(mode, name)
+                        )
+                        return RuntimeOutput(False)
+
+                    yield RuntimeClosure(
+                        FORMAT_MESSAGE.link(*message_args, mode="fail"),
+                        False,
+                        _fail_callable,
+                    )
+
+
+@dataclass
+class OverlayCleanProject(AtomicIterable):
+    """Remove the template files which are not loaded in the template dictionary, as
+    well as the git files if requested, from the export.
+    """
+
+    remove_git_files: bool = False
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        export = export_context(state)
+        for mode in LinkMode:
+            for path, name in NAMES.existing_template_files(
+                proj_path.data_dir, mode, glob=export.snapshot.glob
+            ):
+                if name not in template_dict[NAMES.convert_mode(mode)]:
+                    yield export.overlay.remove(
+                        PurePosixPath(
+                            export.data_dir_name, NAMES.resource_subdir(mode), path.name
+                        )
+                    )
+
+        if self.remove_git_files:
+            for path in proj_path.git_files():
+                yield export.overlay.remove(
+                    PurePosixPath(path.relative_to(proj_path.dir))
+                )
+
+
+# the steps which create each type of export, in order
+EXPORT_PIPELINES: Final[dict[ExportMode, list[AtomicIterable]]] = {
+    ExportMode.source: [],
+    ExportMode.build: [CompileOutput(".pdf")],
+    ExportMode.nohidden: [
+        RenameDataDir(),
+        InlineInfoFiles(),
+        OverlayTemplateDictLinker(),
+        OverlayCleanProject(remove_git_files=True),
+    ],
+    ExportMode.arxiv: [
+        RenameDataDir(),
+        InlineInfoFiles(),
+        # perform substitutions that arxiv does not like, respecting existing files
+        ModifyTemplateDict(
+            UpdateCommand(LinkMode.macro, "typesetting", "arxiv-typesetting")
+        ),
+        OverlayTemplateDictLinker(),
+        OverlayCleanProject(),
+        AddRenderedFile(JINJA_PATH.arxiv_autotex, attrgetter("arxiv_autotex")),
+        PruneBibliography(),
+        CompileBibliography(),
+        # after the bibliography, so that the macros used by the .bbl file are kept
+        StripComments(),
+    ],
+}
@@ -0,0 +1,208 @@
+"""Find the macro and style packages of the template dictionary which are not used by
+the document, by comparing the control sequences and environments they define with
+those used by the document."""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass, field
+from pathlib import PurePosixPath
+
+from .base import NAMES, LinkMode, RemoveCommand
+from .control import AtomicIterable, RuntimeClosure, RuntimeOutput, SUCCESS
+from .deps import scan_dependencies, SCANNED_SUFFIXES
+from .flatten import snapshot_reader
+from .snapshot import tree_snapshot
+from .tex import (
+    NEW_DEFINITIONS,
+    TokenKind,
+    command_usage,
+    iter_commands,
+    iter_definitions,
+    tokenize,
+)
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Final, Hashable, Iterable, Mapping, TypeVar
+    from .control import TempDir
+    from .filesystem import ProjectPath, TemplateDict
+
+    Key = TypeVar("Key", bound=Hashable)
+
+
+_ENVIRONMENT_DEFINITIONS: Final = {"newenvironment": "moomm", "newtheorem": "momo"}
+
+# commands which may appear in a package outside of definitions, without effects on the
+# document
+_INERT_COMMANDS: Final = frozenset(
+    {"ProvidesPackage", "NeedsTeXFormat", "makeatletter", "makeatother", "endinput"}
+)
+
+
+@dataclass
+class PackageScan:
+    """The control sequences and environments defined by a package, and those which it
+    uses. A package has side effects if it contains code other than new definitions,
+    such as loading other packages or changing existing macros, since it may then change
+    the document without any of its definitions being used."""
+
+    commands: set[str] = field(default_factory=set)
+    environments: set[str] = field(default_factory=set)
+    used_commands: set[str] = field(default_factory=set)
+    used_environments: set[str] = field(default_factory=set)
+    side_effects: bool = False
+
+    @property
+    def definitions(self) -> int:
+        return len(self.commands) + len(self.environments)
+
+    def is_used(self, commands: set[str], environments: set[str]) -> bool:
+        return not (
+            self.commands.isdisjoint(commands)
+            and self.environments.isdisjoint(environments)
+        )
+
+
+def used_environments(source: str) -> set[str]:
+    return {
+        cmd.arguments[0].strip()
+        for cmd in iter_commands(source, {"begin": "m"})
+        if len(cmd.arguments) > 0
+    }
+
+
+def scan_package(source: str) -> PackageScan:
+    scan = PackageScan(
+        used_commands=set(command_usage(source)),
+        used_environments=used_environments(source),
+    )
+    # the parts of the source which contain definitions
+    spans = []
+    for definition in iter_definitions(source):
+        scan.commands.add(definition.name)
+        spans.append((definition.command.start, definition.command.end))
+        if definition.command.name not in NEW_DEFINITIONS or "@" in definition.name:
+            scan.side_effects = True
+    for cmd in iter_commands(source, _ENVIRONMENT_DEFINITIONS):
+        if len(cmd.arguments) > 0:
+            scan.environments.add(cmd.arguments[0].strip())
+            spans.append((cmd.start, cmd.end))
+
+    spans.sort()
+    idx = 0
+    for tok in tokenize(source):
+        if tok.kind != TokenKind.command:
+            continue
+        while idx < len(spans) and spans[idx][1] <= tok.start:
+            idx += 1
+        inside = idx < len(spans) and spans[idx][0] <= tok.start
+        if not inside and tok.name not in _INERT_COMMANDS:
+            scan.side_effects = True
+            break
+    return scan
+
+
+def find_unused_packages(
+    packages: Mapping[Key, str], documents: Iterable[str]
+) -> dict[Key, PackageScan]:
+    """The packages, with sources in `packages`, which define macros or environments of
+    which none are used by the `documents`, or by the other packages which are used.
+    Packages with side effects are included, even though they may not be safe to
+    remove."""
+    scans = {key: scan_package(source) for key, source in packages.items()}
+    commands: set[str] = set()
+    environments: set[str] = set()
+    for source in documents:
+        commands.update(command_usage(source))
+        environments.update(used_environments(source))
+
+    # starting from the packages used by the documents, the usage of the packages which
+    # are kept is added until nothing changes
+    unused = {key for key, scan in scans.items() if scan.definitions > 0}
+    kept = set(scans) - unused
+    kept |= {key for key in unused if scans[key].is_used(commands, environments)}
+    unused -= kept
+    while len(kept) > 0:
+        for key in kept:
+            commands.update(scans[key].used_commands)
+            environments.update(scans[key].used_environments)
+        kept = {key for key in unused if scans[key].is_used(commands, environments)}
+        unused -= kept
+    return {key: scans[key] for key in sorted(unused, key=str)}
+
+
+@dataclass
+class UnusedPackageFinder(AtomicIterable):
+    """Report the macro and style packages in the template dictionary whose definitions
+    are not used by the document. If `remove`, the packages without side effects are
+    removed from the template dictionary by modifications added to the state."""
+
+    remove: bool = False
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        snapshot = tree_snapshot(proj_path, state)
+        read_text = snapshot_reader(snapshot)
+        found: list[dict[tuple[LinkMode, str], PackageScan]] = []
+
+        def _callable() -> RuntimeOutput:
+            paths = {
+                (mode, name): PurePosixPath(
+                    proj_path.data_dir.name,
+                    NAMES.rel_data_path(name + ".sty", mode),
+                )
+                for mode in (LinkMode.macro, LinkMode.style)
+                for name in template_dict[NAMES.convert_mode(mode)]
+            }
+            packages = {}
+            for key, rel in paths.items():
+                source = read_text(rel)
+                if source is not None:
+                    packages[key] = source
+
+            documents = []
+            for rel in scan_dependencies(proj_path, snapshot).files:
+                if rel.suffix in SCANNED_SUFFIXES and rel not in paths.values():
+                    source = read_text(rel)
+                    if source is not None:
+                        documents.append(source)
+
+            found.append(find_unused_packages(packages, documents))
+            return RuntimeOutput(
+                True,
+                f"Found {len(found[0])} unused packages out of {len(packages)}",
+            )
+
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info("Find unused macro and style packages"),
+            True,
+            _callable,
+        )
+
+        if len(found) == 0:
+            return
+        # the project macro file is only loaded along with the macro packages
+        macros = template_dict[NAMES.convert_mode(LinkMode.macro)]
+        keep_one = proj_path.project_macro.exists() and all(
+            (LinkMode.macro, name) in found[0]
+            and not found[0][LinkMode.macro, name].side_effects
+            for name in macros
+        )
+        for (mode, name), scan in found[0].items():
+            message = (
+                f"Unused {mode} package '{name}': none of its {scan.definitions}"
+                " definitions are used"
+            )
+            if scan.side_effects:
+                message += ", but it contains other code which may affect the document"
+            elif keep_one and mode == LinkMode.macro:
+                message += ", but it is kept to load the project macro file"
+                keep_one = False
+            elif self.remove:
+                state["template_modifications"].append(RemoveCommand(mode, name))
+            yield RuntimeClosure(FORMAT_MESSAGE.info(message), *SUCCESS)
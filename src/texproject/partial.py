@@ -0,0 +1,270 @@
+"""Compile only some of the chapters of a document, which are loaded with '\\include',
+in the persistent build directory. The other chapters are excluded with
+'\\includeonly', and their .aux files from earlier builds are reused, so that the
+numbering of pages, sections and equations stays correct.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass, field
+import hashlib
+import json
+import posixpath
+from pathlib import PurePosixPath
+
+from .control import AtomicIterable, RuntimeClosure, RuntimeOutput
+from .deps import DependencyScanner, input_candidates, project_relative
+from .flatten import snapshot_reader
+from .output import compile_latex, copy_output
+from .snapshot import tree_snapshot
+from .tex import iter_commands
+from .term import FORMAT_MESSAGE
+from .watch import BuildDirSync
+
+if TYPE_CHECKING:
+    from typing import Callable, Final, Iterable, Optional, Sequence
+    from pathlib import Path
+    from .control import TempDir
+    from .filesystem import ProjectPath, TemplateDict
+    from .snapshot import TreeSnapshot
+
+
+# changed whenever the contents of the state file change
+_VERSION: Final = 1
+
+_SIGNATURES: Final[dict[str, int | str]] = {"input": 1, "include": 1}
+
+
+def chapter_name(name: str) -> Optional[str]:
+    """The name of a chapter as written in '\\include', from its file name."""
+    rel = project_relative(name.strip())
+    return None if rel is None else posixpath.splitext(str(rel))[0]
+
+
+def find_chapters(
+    read_text: Callable[[PurePosixPath], Optional[str]], main: PurePosixPath
+) -> list[str]:
+    """The chapters loaded with '\\include' by `main`, or by the files it loads with
+    '\\input', in order."""
+    chapters: list[str] = []
+    queue = [main]
+    seen = {main}
+    while len(queue) > 0:
+        text = read_text(queue.pop(0)) or ""
+        for cmd in iter_commands(text, _SIGNATURES):
+            if len(cmd.arguments) == 0:
+                continue
+            arg = cmd.arguments[0].strip().strip('"')
+            if cmd.name == "include":
+                name = chapter_name(arg)
+                if name is not None and name not in chapters:
+                    chapters.append(name)
+                continue
+            for candidate in input_candidates(cmd.name, arg):
+                rel = project_relative(candidate)
+                if rel is not None and rel not in seen and read_text(rel) is not None:
+                    seen.add(rel)
+                    queue.append(rel)
+                    break
+    return chapters
+
+
+def _digest(snapshot: TreeSnapshot, files: Iterable[PurePosixPath]) -> str:
+    digest = hashlib.sha256()
+    for rel in sorted(files):
+        digest.update(str(rel).encode("utf-8", errors="surrogateescape") + b"\0")
+        try:
+            digest.update(hashlib.sha256((snapshot.root / rel).read_bytes()).digest())
+        except (FileNotFoundError, IsADirectoryError):
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def document_digests(
+    snapshot: TreeSnapshot, main: PurePosixPath, chapters: Sequence[str]
+) -> tuple[str, dict[str, str]]:
+    """The hash of the files used by each chapter, and of the other files used by the
+    document, such as the preamble and the bibliography."""
+    files = {
+        name: DependencyScanner(snapshot).scan(PurePosixPath(name + ".tex")).files
+        for name in chapters
+    }
+    used = DependencyScanner(snapshot).scan(main).files
+    shared = used.difference(*files.values())
+    return _digest(snapshot, shared), {
+        name: _digest(snapshot, chapter_files) for name, chapter_files in files.items()
+    }
+
+
+@dataclass
+class PartialBuildState:
+    """The hashes of the document and of the chapters as of their last successful
+    build, along with the number of partial builds since the last full build."""
+
+    main: str = ""
+    chapters: dict[str, str] = field(default_factory=dict)
+    partial_builds: int = 0
+
+    @classmethod
+    def load(cls, path: Path) -> PartialBuildState:
+        try:
+            data = json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return cls()
+        if data.get("version") != _VERSION:
+            return cls()
+        return cls(data["main"], data["chapters"], data["partial_builds"])
+
+    def record(
+        self, plan: PartialBuildPlan, main: str, chapters: dict[str, str]
+    ) -> None:
+        """Record a successful build with `plan`. The chapters which were not compiled
+        keep their previous hashes, and changes outside of the chapters are only
+        recorded by full builds."""
+        compiled = chapters.keys() if plan.included is None else set(plan.included)
+        if plan.included is None:
+            self.main = main
+        self.chapters = {
+            name: digest if name in compiled else self.chapters.get(name, "")
+            for name, digest in chapters.items()
+        }
+        self.partial_builds = 0 if plan.included is None else self.partial_builds + 1
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(
+            json.dumps(
+                {
+                    "version": _VERSION,
+                    "main": self.main,
+                    "chapters": self.chapters,
+                    "partial_builds": self.partial_builds,
+                }
+            )
+        )
+
+
+@dataclass
+class PartialBuildPlan:
+    """The chapters to compile, or None to compile the entire document."""
+
+    included: Optional[list[str]] = None
+    reason: str = ""
+
+    def options(self) -> list[str]:
+        if self.included is None:
+            return []
+        return ["-usepretex=\\includeonly{" + ",".join(self.included) + "}"]
+
+
+def plan_build(
+    state: PartialBuildState,
+    main: str,
+    chapters: dict[str, str],
+    only: Optional[Sequence[str]],
+    full_build_interval: int,
+) -> PartialBuildPlan:
+    """Decide which chapters to compile, given the hashes `main` and `chapters` of the
+    document. The chapters `only` are compiled if given, and otherwise the chapters
+    which changed since their last build. The entire document is compiled when the
+    files outside of the chapters changed, and after `full_build_interval` partial
+    builds."""
+    if only is not None:
+        return PartialBuildPlan(list(only), "as requested")
+    if len(chapters) == 0:
+        return PartialBuildPlan(None, "the document has no chapters")
+    if state.main != main or state.chapters.keys() != chapters.keys():
+        return PartialBuildPlan(None, "the document changed")
+    if 0 < full_build_interval <= state.partial_builds:
+        return PartialBuildPlan(
+            None, f"{state.partial_builds} partial builds since the last full build"
+        )
+    return PartialBuildPlan(
+        [name for name, digest in chapters.items() if state.chapters[name] != digest],
+        "changed since the last build",
+    )
+
+
+@dataclass
+class PartialCompiler(AtomicIterable):
+    """Compile the document in the persistent build directory, only including the
+    chapters `only`, or the chapters which changed since their last build. The output
+    files in `output_map` are copied out of the build directory."""
+
+    only: Optional[list[str]] = None
+    output_map: dict[str, Path] = field(default_factory=dict)
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        build_dir = proj_path.build_dir
+        snapshot = tree_snapshot(proj_path, state)
+        main = PurePosixPath(proj_path.main.name)
+        state_path = proj_path.temp_dir / "partial.json"
+        syncer = BuildDirSync(proj_path.dir, build_dir, proj_path.ignore)
+        yield syncer.apply(syncer.plan())
+
+        plans: list[PartialBuildPlan] = []
+        digests: list[tuple[str, dict[str, str]]] = []
+
+        def _plan() -> RuntimeOutput:
+            chapters = find_chapters(snapshot_reader(snapshot), main)
+            unknown = [name for name in self.only or [] if name not in chapters]
+            if len(unknown) > 0:
+                return RuntimeOutput(
+                    False,
+                    "\n".join(
+                        FORMAT_MESSAGE.error(f"'{name}' is not included by '{main}'")
+                        for name in unknown
+                    ),
+                )
+            digests.append(document_digests(snapshot, main, chapters))
+            plans.append(
+                plan_build(
+                    PartialBuildState.load(state_path),
+                    *digests[0],
+                    self.only,
+                    proj_path.config.process["partial_full_build_interval"],
+                )
+            )
+            included = plans[0].included
+            if included is None:
+                message = f"Compile all chapters: {plans[0].reason}"
+            elif len(included) == 0:
+                message = "No chapters changed since the last build"
+            else:
+                message = (
+                    f"Compile {len(included)} of {len(chapters)} chapters"
+                    f" {plans[0].reason}" + "".join(f"\n  {name}" for name in included)
+                )
+            return RuntimeOutput(True, message)
+
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info(f"Find the chapters of '{main}' to compile"),
+            True,
+            _plan,
+        )
+        if len(plans) == 0:
+            return
+        plan = plans[0]
+        if plan.included != []:
+            compile_closure = compile_latex(
+                proj_path, build_dir, options=plan.options()
+            )
+
+            def _compile() -> RuntimeOutput:
+                output = compile_closure.run()
+                if output.success:
+                    build_state = PartialBuildState.load(state_path)
+                    build_state.record(plan, *digests[0])
+                    build_state.save(state_path)
+                return output
+
+            yield RuntimeClosure(compile_closure.message(), True, _compile)
+
+        if len(self.output_map) > 0:
+            yield copy_output(proj_path, build_dir, self.output_map, keep=True)
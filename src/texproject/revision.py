@@ -0,0 +1,169 @@
+"""Read the files of the project at a git revision directly from the object store,
+without checking out the revision or touching the working tree.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from pathlib import Path, PurePosixPath
+import posixpath
+import subprocess
+import threading
+
+from .error import AbortRunner
+from .filesystem import TemplateDict
+from .snapshot import FileStat, TreeSnapshot
+
+if TYPE_CHECKING:
+    from typing import Iterable, Optional
+    from .control import TempDir
+    from .filesystem import ProjectPath
+
+
+def _git(root: Path, *args: str) -> bytes:
+    try:
+        proc = subprocess.run(["git", *args], cwd=root, capture_output=True)
+    except FileNotFoundError:
+        raise AbortRunner("could not find command 'git'")
+    if proc.returncode != 0:
+        raise AbortRunner(f"Command 'git {' '.join(args)}' failed.", stderr=proc.stderr)
+    return proc.stdout
+
+
+class RevisionSnapshot(TreeSnapshot):
+    """The files of the project directory at the git revision `rev`. The listing is
+    read with 'git ls-tree', which includes the file sizes, and the contents are
+    streamed with a single 'git cat-file --batch' process. Symbolic links are replaced
+    by the file they point to, if it is part of the revision.
+    """
+
+    def __init__(self, proj_path: ProjectPath, rev: str) -> None:
+        super().__init__(proj_path.dir, proj_path.ignore, list_files=self._list_tree)
+        self.rev = rev
+        self.commit = ""
+        self.mtime = 0.0
+        self._blobs: dict[PurePosixPath, tuple[str, int, int]] = {}
+
+    def _list_tree(self) -> Iterable[str]:
+        try:
+            self.commit = (
+                _git(self.root, "rev-parse", "--verify", f"{self.rev}^{{commit}}")
+                .decode()
+                .strip()
+            )
+        except AbortRunner:
+            raise AbortRunner(f"Invalid git revision '{self.rev}'.")
+        self.mtime = float(_git(self.root, "show", "-s", "--format=%ct", self.commit))
+
+        links: dict[PurePosixPath, str] = {}
+        for record in _git(
+            self.root, "ls-tree", "-r", "-z", "--long", self.commit
+        ).split(b"\0"):
+            if record == b"":
+                continue
+            meta, _, name = record.partition(b"\t")
+            mode, kind, oid, size = meta.decode().split()
+            rel = PurePosixPath(name.decode("utf-8", "surrogateescape"))
+            if kind != "blob":
+                # submodules are not included
+                continue
+            if mode == "120000":
+                links[rel] = oid
+            else:
+                self._blobs[rel] = (
+                    oid,
+                    0o755 if mode == "100755" else 0o644,
+                    int(size),
+                )
+
+        if len(links) > 0:
+            targets = self._read_blobs(links.values())
+            for rel, target in zip(links, targets):
+                resolved = PurePosixPath(
+                    posixpath.normpath(posixpath.join(rel.parent, target.decode()))
+                )
+                if resolved in self._blobs:
+                    self._blobs[rel] = self._blobs[resolved]
+
+        return sorted(str(rel) for rel in self._blobs)
+
+    def _stat_listed(self, rel: PurePosixPath) -> Optional[FileStat]:
+        if rel in self._blobs:
+            _, mode, size = self._blobs[rel]
+            return FileStat(False, size, mode, self.mtime)
+        # parent directories are not listed separately
+        return FileStat(True, 0, 0o755, self.mtime)
+
+    def _stat_uncovered(self, path: Path) -> Optional[FileStat]:
+        if path.is_relative_to(self.root):
+            return None
+        return super()._stat_uncovered(path)
+
+    def _listdir_uncovered(self, path: Path) -> list[str]:
+        if path.is_relative_to(self.root):
+            return []
+        return super()._listdir_uncovered(path)
+
+    def refresh(self, path: Path) -> None:
+        """The revision does not change when the working tree is modified."""
+        del path
+
+    def _read_blobs(self, oids: Iterable[str]) -> Iterable[bytes]:
+        """Stream the contents of the objects `oids`, in order."""
+        proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=self.root,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        assert proc.stdin is not None and proc.stdout is not None
+        oid_list = list(oids)
+
+        def _write() -> None:
+            assert proc.stdin is not None
+            try:
+                for oid in oid_list:
+                    proc.stdin.write(oid.encode() + b"\n")
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        # write in a thread, so that neither pipe fills up
+        writer = threading.Thread(target=_write, daemon=True)
+        writer.start()
+        try:
+            for oid in oid_list:
+                header = proc.stdout.readline().split()
+                if len(header) != 3 or header[0].decode() != oid:
+                    raise AbortRunner(f"Could not read object '{oid}' from git.")
+                data = proc.stdout.read(int(header[2]))
+                proc.stdout.read(1)
+                yield data
+        finally:
+            proc.kill()
+            proc.wait()
+            writer.join()
+
+    def contents(self, paths: Iterable[PurePosixPath]) -> Iterable[Optional[bytes]]:
+        path_list = list(paths)
+        blobs = iter(
+            self._read_blobs(
+                self._blobs[rel][0] for rel in path_list if rel in self._blobs
+            )
+        )
+        for rel in path_list:
+            yield next(blobs) if rel in self._blobs else b""
+
+    def read_text(self, path: Path) -> str:
+        self._ensure()
+        rel = PurePosixPath(path.relative_to(self.root).as_posix())
+        if rel not in self._blobs:
+            raise AbortRunner(f"File '{rel}' does not exist at revision '{self.rev}'.")
+        return b"".join(self._read_blobs([self._blobs[rel][0]])).decode(
+            "utf-8", "surrogateescape"
+        )
+
+    def template_dict(self, proj_path: ProjectPath, temp_dir: TempDir) -> TemplateDict:
+        """The template dictionary of the project at the revision."""
+        source = temp_dir.provision()
+        source.write_text(self.read_text(proj_path.template))
+        return TemplateDict(source)
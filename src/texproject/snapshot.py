@@ -0,0 +1,289 @@
+"""A snapshot of the files in the project directory, shared by the atoms of a single
+run so that the project tree is walked and stat'ed only once.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+import os
+from pathlib import Path, PurePosixPath
+
+from .control import RuntimeClosure
+from .error import AbortRunner
+
+if TYPE_CHECKING:
+    from typing import Callable, Final, Iterable, Optional
+    from .control import RuntimeOutput
+    from .filesystem import ProjectPath
+    from .utils import IgnoreFunction
+
+
+_ROOT: Final = PurePosixPath(".")
+
+
+@dataclass(frozen=True)
+class FileStat:
+    """The cached stat result of a file or directory."""
+
+    is_dir: bool
+    size: int
+    mode: int
+    mtime: float
+
+    @classmethod
+    def from_stat(cls, st: os.stat_result) -> FileStat:
+        is_dir = (st.st_mode & 0o170000) == 0o040000
+        return cls(is_dir, 0 if is_dir else st.st_size, st.st_mode & 0o777, st.st_mtime)
+
+
+class TreeSnapshot:
+    """The files below `root`, collected with a single walk when first queried. Paths
+    matched by `ignore` are recorded as ignored, and are not descended into; the
+    directory `skip` is not visited at all. Queries about paths which are not covered by
+    the snapshot (ignored, skipped, or outside of `root`) fall back to the filesystem.
+
+    If `list_files` is given, the snapshot only contains the files it returns (as paths
+    relative to `root`) along with their parent directories, instead of the results of a
+    walk; for instance, the files tracked by git.
+
+    Closures which modify the tree should be wrapped with `track`, so that the snapshot
+    is refreshed after they run.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        ignore: IgnoreFunction,
+        skip: Optional[Path] = None,
+        list_files: Optional[Callable[[], Iterable[str]]] = None,
+    ) -> None:
+        self.root = root
+        self._ignore = ignore
+        self._skip = skip
+        self._list_files = list_files
+        self._stats: Optional[dict[PurePosixPath, FileStat]] = None
+        self._children: dict[PurePosixPath, dict[str, None]] = {}
+        self._ignored: set[PurePosixPath] = set()
+
+    def _walk(self, top: PurePosixPath) -> None:
+        """Walk the directory `top` with a single `os.scandir` per directory."""
+        assert self._stats is not None
+        stack = [top]
+        while len(stack) > 0:
+            current = stack.pop()
+            directory = self.root / current
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            ignored = self._ignore(str(directory), [entry.name for entry in entries])
+            children = self._children.setdefault(current, {})
+            for entry in entries:
+                rel = current / entry.name
+                if entry.name in ignored:
+                    self._ignored.add(rel)
+                    continue
+                if Path(entry.path) == self._skip:
+                    continue
+                try:
+                    st = FileStat.from_stat(entry.stat())
+                except FileNotFoundError:
+                    raise AbortRunner(
+                        f"Could not read '{entry.path}'. You may have broken symlinks?"
+                    )
+                self._stats[rel] = st
+                children[entry.name] = None
+                if st.is_dir:
+                    stack.append(rel)
+
+    def _add_listed(self, names: Iterable[str]) -> None:
+        """Add the listed files, along with their parent directories."""
+        assert self._stats is not None
+        for name in names:
+            rel = PurePosixPath(name)
+            for path in list(reversed(rel.parents[:-1])) + [rel]:
+                if path in self._stats:
+                    continue
+                if path in self._ignored or self._skip == self.root / path:
+                    break
+                if len(self._ignore(str(self.root / path.parent), [path.name])) > 0:
+                    self._ignored.add(path)
+                    break
+                st = self._stat_listed(path)
+                if st is None:
+                    # deleted from the working tree
+                    break
+                if path == rel and st.is_dir:
+                    # submodules are not included
+                    break
+                self._stats[path] = st
+                self._children.setdefault(path.parent, {})[path.name] = None
+                if st.is_dir:
+                    self._children.setdefault(path, {})
+
+    def _stat_listed(self, rel: PurePosixPath) -> Optional[FileStat]:
+        try:
+            return FileStat.from_stat((self.root / rel).stat())
+        except FileNotFoundError:
+            return None
+
+    def _stat_uncovered(self, path: Path) -> Optional[FileStat]:
+        """Look up a path which is not covered by the snapshot."""
+        try:
+            return FileStat.from_stat(path.stat())
+        except FileNotFoundError:
+            return None
+
+    def _listdir_uncovered(self, path: Path) -> list[str]:
+        try:
+            return os.listdir(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+    def _ensure(self) -> dict[PurePosixPath, FileStat]:
+        if self._stats is None:
+            self._stats = {}
+            if self._list_files is None:
+                self._walk(_ROOT)
+            else:
+                self._add_listed(self._list_files())
+        return self._stats
+
+    def _relative(self, path: Path) -> Optional[PurePosixPath]:
+        """The path relative to the root, or None if it is not covered."""
+        try:
+            rel = PurePosixPath(path.relative_to(self.root).as_posix())
+        except ValueError:
+            return None
+        if self._skip is not None and path.is_relative_to(self._skip):
+            return None
+        if self.is_ignored(path):
+            return None
+        return rel
+
+    def is_ignored(self, path: Path) -> bool:
+        """Whether `path`, or one of its parents, is matched by the ignore patterns."""
+        self._ensure()
+        try:
+            rel = PurePosixPath(path.relative_to(self.root).as_posix())
+        except ValueError:
+            return False
+        return rel in self._ignored or any(
+            parent in self._ignored for parent in rel.parents
+        )
+
+    def stat(self, path: Path) -> Optional[FileStat]:
+        """The stat result of `path`, or None if it does not exist."""
+        stats = self._ensure()
+        rel = self._relative(path)
+        if rel is not None:
+            return stats.get(rel) if rel != _ROOT else FileStat(True, 0, 0o755, 0.0)
+        return self._stat_uncovered(path)
+
+    def exists(self, path: Path) -> bool:
+        return self.stat(path) is not None
+
+    def listdir(self, path: Path) -> list[str]:
+        """The names in the directory `path` which are not ignored."""
+        self._ensure()
+        rel = self._relative(path)
+        if rel is None:
+            return self._listdir_uncovered(path)
+        return list(self._children.get(rel, {}))
+
+    def glob(self, path: Path, pattern: str) -> Iterable[Path]:
+        """The paths in the directory `path` whose names match `pattern`."""
+        return [
+            path / name for name in self.listdir(path) if fnmatchcase(name, pattern)
+        ]
+
+    def entries(self) -> list[tuple[PurePosixPath, FileStat]]:
+        """All paths which are not ignored, relative to the root. Directories are
+        always listed before their contents."""
+        return list(self._ensure().items())
+
+    def ignored(self) -> list[PurePosixPath]:
+        """The paths which are matched by the ignore patterns, relative to the root. The
+        contents of ignored directories are not listed."""
+        self._ensure()
+        return sorted(self._ignored)
+
+    def contents(self, paths: Iterable[PurePosixPath]) -> Iterable[Optional[bytes]]:
+        """The contents of the given files, in order, if they are not read from the
+        filesystem at the corresponding path; None for the working tree."""
+        for _ in paths:
+            yield None
+
+    def read_text(self, path: Path) -> str:
+        return path.read_text(encoding="utf-8", errors="surrogateescape")
+
+    def _discard(self, rel: PurePosixPath) -> None:
+        assert self._stats is not None
+        self._children.get(rel.parent, {}).pop(rel.name, None)
+        if self._stats.pop(rel, None) is not None and rel in self._children:
+            for name in self._children.pop(rel):
+                self._discard(rel / name)
+
+    def refresh(self, path: Path) -> None:
+        """Update the snapshot after `path` was created, modified or removed."""
+        if self._stats is None:
+            return
+        rel = self._relative(path)
+        if rel is None or rel == _ROOT:
+            return
+        self._discard(rel)
+        self._ignored = {ign for ign in self._ignored if not ign.is_relative_to(rel)}
+
+        for parent in reversed(rel.parents[:-1]):
+            if parent not in self._stats:
+                # a new parent directory; walk it instead
+                rel = parent
+                break
+        try:
+            st = FileStat.from_stat((self.root / rel).stat())
+        except FileNotFoundError:
+            return
+        if len(self._ignore(str(self.root / rel.parent), [rel.name])) > 0:
+            self._ignored.add(rel)
+            return
+        self._stats[rel] = st
+        self._children.setdefault(rel.parent, {})[rel.name] = None
+        if st.is_dir:
+            self._walk(rel)
+
+    def track(self, closure: RuntimeClosure, *paths: Path) -> RuntimeClosure:
+        """Refresh `paths` in the snapshot after the closure runs."""
+
+        def _callable() -> RuntimeOutput:
+            output = closure.run()
+            for path in paths:
+                self.refresh(path)
+            return output
+
+        return RuntimeClosure(closure.message(), closure.success(), _callable)
+
+
+def tree_snapshot(proj_path: ProjectPath, state: dict) -> TreeSnapshot:
+    """The snapshot of the project directory for the current run."""
+    if "tree_snapshot" not in state:
+        state["tree_snapshot"] = TreeSnapshot(
+            proj_path.dir, proj_path.ignore, proj_path.temp_dir
+        )
+    return state["tree_snapshot"]
+
+
+def replace_snapshot(state: dict, snapshot: TreeSnapshot) -> TreeSnapshot:
+    """Use `snapshot` as the snapshot of the project for the rest of the run, for
+    instance one which only contains the files tracked by git."""
+    state["tree_snapshot"] = snapshot
+    return snapshot
+
+
+def track_changes(state: dict, closure: RuntimeClosure, *paths: Path) -> RuntimeClosure:
+    """Refresh `paths` in the snapshot of the current run, if one exists, after the
+    closure runs."""
+    if "tree_snapshot" in state:
+        return state["tree_snapshot"].track(closure, *paths)
+    return closure
@@ -1,4 +1,5 @@
 """TODO: write"""
+
 from __future__ import annotations
 from typing import TYPE_CHECKING
 
@@ -34,13 +35,15 @@ from .filesystem import (
     FileLinker,
     LINKER_MAP,
 )
+from .snapshot import track_changes
 from .utils import touch_file
 
 if TYPE_CHECKING:
-    from typing import Iterable, ClassVar, Optional
+    from typing import Iterable, ClassVar, Mapping, Optional
 
     from .base import ModCommand
     from .filesystem import ProjectPath
+    from .variants import Variant
 
 
 def data_name(name: str, mode: LinkMode) -> str:
@@ -130,6 +133,7 @@ class JinjaTemplate:
         proj_path: ProjectPath,
         template_dict: TemplateDict,
         render_mods: Optional[dict] = None,
+        variant: Optional[Variant] = None,
     ) -> str:
         config = proj_path.config
         if render_mods is not None:
@@ -145,11 +149,18 @@ class JinjaTemplate:
             + f"{render['project_data_folder']}/{render['bibinfo_file']}"
             + "}"
         )
+        template: Mapping = template_dict
+        metadata = config.metadata
+        if variant is not None:
+            template = variant.apply(template_dict)
+            metadata = metadata | variant.metadata
+
         return self._env.get_template(str(self.template_path)).render(
             user=config.user,
-            template=template_dict,
+            template=template,
             config=render,
-            metadata=config.metadata,
+            metadata=metadata,
+            variant=variant,
             github=config.github,
             process=config.process,
             bibliography=bibtext,
@@ -182,14 +193,18 @@ class JinjaTemplate:
                     os.chmod(target_path, stat.S_IXUSR | stat.S_IWUSR | stat.S_IRUSR)
                 return RuntimeOutput(True)
 
-            return RuntimeClosure(
-                FORMAT_MESSAGE.render(
-                    self.template_path,
-                    target_path,
-                    overwrite=target_path.exists(),
+            return track_changes(
+                state,
+                RuntimeClosure(
+                    FORMAT_MESSAGE.render(
+                        self.template_path,
+                        target_path,
+                        overwrite=target_path.exists(),
+                    ),
+                    True,
+                    _callable,
                 ),
-                True,
-                _callable,
+                target_path,
             )
 
         except TemplateNotFound:
@@ -265,15 +280,21 @@ def _link_helper(
                 FORMAT_MESSAGE.link(*message_args, mode="exists"), *SUCCESS
             )
         if target_path.exists() and op == LinkCommand.replace:
-            return RuntimeClosure(
-                FORMAT_MESSAGE.link(*message_args, mode="overwrite"),
-                True,
-                _callable,
+            return track_changes(
+                state,
+                RuntimeClosure(
+                    FORMAT_MESSAGE.link(*message_args, mode="overwrite"),
+                    True,
+                    _callable,
+                ),
+                target_path,
             )
-        return RuntimeClosure(
-            FORMAT_MESSAGE.link(*message_args, mode="new"),
-            True,
-            _callable,
+        return track_changes(
+            state,
+            RuntimeClosure(
+                FORMAT_MESSAGE.link(*message_args, mode="new"), True, _callable
+            ),
+            target_path,
         )
 
 
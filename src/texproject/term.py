@@ -2,7 +2,7 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
 
-from pathlib import Path
+from pathlib import Path, PurePath
 import shlex
 
 import click
@@ -49,7 +49,9 @@ class _MessageFormatter:
     def prompt(self, prompt: str) -> str:
         return self._apply_style(prompt, "prompt", "info")
 
-    def link(self, linker: FileLinker, name: str, target_dir: Path, mode: str) -> str:
+    def link(
+        self, linker: FileLinker, name: str, target_dir: PurePath, mode: str
+    ) -> str:
         """TODO: write"""
 
         def helper(prop: str) -> str:
@@ -96,10 +98,10 @@ class _MessageFormatter:
     def copy(self, source: Path, target: Path) -> str:
         return self._apply_style(f"Copying '{source}' to '{target}'", "file", "info")
 
-    def rename(self, source: Path, target: Path) -> str:
+    def rename(self, source: PurePath, target: PurePath) -> str:
         return self._apply_style(f"Rename '{source}' to '{target}'", "file", "info")
 
-    def remove(self, target: Path) -> str:
+    def remove(self, target: PurePath) -> str:
         return self._apply_style(f"Removing file '{target}'", "file", "info")
 
     def edit(self, file_path: Path) -> str:
@@ -0,0 +1,382 @@
+"""A lightweight tokenizer for LaTeX sources, which finds commands along with their
+arguments without expanding any macros.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from collections import Counter
+from dataclasses import dataclass
+from enum import Enum
+import re
+
+if TYPE_CHECKING:
+    from typing import Container, Final, Iterable, Mapping, Optional
+
+
+class TokenKind(Enum):
+    command = "command"
+    comment = "comment"
+    verbatim = "verbatim"
+    begin_group = "{"
+    end_group = "}"
+    begin_optional = "["
+    end_optional = "]"
+    text = "text"
+
+
+@dataclass(frozen=True)
+class Token:
+    kind: TokenKind
+    text: str
+    start: int
+    end: int
+
+    @property
+    def name(self) -> str:
+        """The name of a command token, without the backslash."""
+        return self.text[1:]
+
+
+_VERBATIM_ENVIRONMENTS: Final = "verbatim|Verbatim|lstlisting|minted|comment"
+
+_TOKEN_RE: Final = re.compile(
+    # verbatim text is never tokenized
+    rf"(?P<verbatim>\\begin\{{(?P<env>(?:{_VERBATIM_ENVIRONMENTS})\*?)\}}"
+    r".*?\\end\{(?P=env)\}"
+    r"|\\verb\*?(?P<delim>[^A-Za-z*\s]).*?(?P=delim)"
+    # the argument of a url may contain '%'
+    r"|\\(?:url|path|href)\{[^{}]*\})"
+    r"|(?P<command>\\(?:[A-Za-z@]+|.))"
+    r"|(?P<comment>%[^\n]*)"
+    r"|(?P<group>[{}\[\]])"
+    r"|(?P<text>[^\\%{}\[\]]+)",
+    re.DOTALL,
+)
+
+
+def tokenize(source: str) -> Iterable[Token]:
+    """Split `source` into tokens. Concatenating the text of the tokens gives back the
+    source."""
+    for match in _TOKEN_RE.finditer(source):
+        group = match.lastgroup
+        if group == "group":
+            kind = TokenKind(match.group())
+        elif group in ("env", "delim"):
+            kind = TokenKind.verbatim
+        else:
+            kind = TokenKind(group)
+        yield Token(kind, match.group(), match.start(), match.end())
+
+
+@dataclass(frozen=True)
+class Command:
+    """A command along with its arguments, as written in the source."""
+
+    name: str
+    star: bool
+    options: tuple[str, ...]
+    arguments: tuple[str, ...]
+    start: int
+    end: int
+
+
+# commands whose argument may also be given without braces, as in '\input file'
+_BARE_ARGUMENT: Final = frozenset({"input"})
+
+_BARE_RE: Final = re.compile(r"[ \t]*([^\s{}%\\]+)")
+
+
+class _Parser:
+    def __init__(self, source: str, tokens: list[Token]) -> None:
+        self.source = source
+        self.tokens = tokens
+
+    def skip_space(self, idx: int) -> int:
+        """Skip whitespace and comments, but not paragraph breaks."""
+        newlines = 0
+        while idx < len(self.tokens):
+            tok = self.tokens[idx]
+            if tok.kind == TokenKind.comment:
+                newlines = 0
+            elif tok.kind == TokenKind.text and tok.text.isspace():
+                newlines += tok.text.count("\n")
+                if newlines > 1:
+                    break
+            else:
+                break
+            idx += 1
+        return idx
+
+    def group(self, idx: int, close: TokenKind) -> Optional[tuple[str, int]]:
+        """Read a balanced group starting at `idx`, returning the contents without
+        comments and the index after the closing token."""
+        depth = 0
+        contents: list[str] = []
+        for end in range(idx + 1, len(self.tokens)):
+            tok = self.tokens[end]
+            if tok.kind == TokenKind.begin_group:
+                depth += 1
+            elif tok.kind == TokenKind.end_group:
+                if depth == 0 and close == TokenKind.end_group:
+                    return "".join(contents), end + 1
+                depth -= 1
+                if depth < 0:
+                    return None
+            elif tok.kind == close and depth == 0:
+                return "".join(contents), end + 1
+            if tok.kind != TokenKind.comment:
+                contents.append(tok.text)
+        return None
+
+    def command(self, idx: int, spec: str) -> Command:
+        tok = self.tokens[idx]
+        star = False
+        options: list[str] = []
+        arguments: list[str] = []
+        end = tok.end
+        pos = idx + 1
+
+        if pos < len(self.tokens) and self.tokens[pos].text == "*":
+            star = True
+            end = self.tokens[pos].end
+            pos += 1
+
+        for arg_type in spec:
+            if arg_type == "p":
+                # the parameter text of a definition, such as '#1#2'
+                while pos < len(self.tokens) and self.tokens[pos].kind not in (
+                    TokenKind.begin_group,
+                    TokenKind.end_group,
+                ):
+                    pos += 1
+                continue
+
+            nxt_pos = self.skip_space(pos)
+            if nxt_pos >= len(self.tokens):
+                break
+            nxt = self.tokens[nxt_pos]
+            if arg_type == "o":
+                if nxt.kind != TokenKind.begin_optional:
+                    continue
+                parsed = self.group(nxt_pos, TokenKind.end_optional)
+                if parsed is None:
+                    break
+                options.append(parsed[0])
+            elif nxt.kind == TokenKind.begin_group:
+                parsed = self.group(nxt_pos, TokenKind.end_group)
+                if parsed is None:
+                    break
+                arguments.append(parsed[0])
+            elif nxt.kind == TokenKind.command:
+                # a single token is also an argument, as in '\\newcommand\\name'
+                parsed = (nxt.text, nxt_pos + 1)
+                arguments.append(nxt.text)
+            elif nxt.kind == TokenKind.text and tok.name in _BARE_ARGUMENT:
+                match = _BARE_RE.match(self.source, nxt.start)
+                if match is None:
+                    break
+                arguments.append(match.group(1))
+                end = match.end()
+                break
+            else:
+                break
+            pos = parsed[1]
+            end = self.tokens[pos - 1].end
+
+        return Command(tok.name, star, tuple(options), tuple(arguments), tok.start, end)
+
+
+def iter_commands(
+    source: str, signatures: Mapping[str, int | str]
+) -> Iterable[Command]:
+    """Find the commands in `source` with a name in `signatures`, which maps the name to
+    the arguments of the command. The arguments are given either as the number of
+    mandatory arguments, which may be preceded by optional arguments, or as a string of
+    argument types: 'm' for a mandatory argument, 'o' for an optional argument, and 'p'
+    for the parameter text of a '\\def'. Commands in comments and verbatim text are
+    skipped, and commands with missing arguments are returned with fewer arguments."""
+    tokens = list(tokenize(source))
+    parser = _Parser(source, tokens)
+    for idx, tok in enumerate(tokens):
+        if tok.kind == TokenKind.command and tok.name in signatures:
+            spec = signatures[tok.name]
+            if isinstance(spec, int):
+                spec = "oo" + "m" * spec
+            yield parser.command(idx, spec)
+
+
+def split_list(argument: str) -> list[str]:
+    """Split a comma-separated argument, such as the argument of '\\usepackage'."""
+    return [item.strip() for item in argument.split(",") if item.strip() != ""]
+
+
+def _line_start(source: str, pos: int) -> Optional[int]:
+    """The start of the line containing `pos`, if only whitespace precedes `pos` on the
+    line."""
+    start = source.rfind("\n", 0, pos) + 1
+    return start if source[start:pos].strip() == "" else None
+
+
+def _line_end(source: str, pos: int, skip_spaces: bool) -> int:
+    """The end of the line after `pos`, including the line break, if only whitespace
+    follows `pos` on the line. Otherwise, `pos`, or the position after the spaces at
+    `pos` if `skip_spaces`."""
+    end = pos
+    while end < len(source) and source[end] in " \t":
+        end += 1
+    if end == len(source) or source[end] == "\n":
+        return min(end + 1, len(source))
+    return end if skip_spaces else pos
+
+
+def _closing_fi(tokens: list[Token], idx: int) -> Optional[int]:
+    """The index of the '\\fi' which closes the conditional at `idx`, or None if the
+    conditional has another branch or is not closed."""
+    depth = 0
+    for end in range(idx, len(tokens)):
+        tok = tokens[end]
+        if tok.kind != TokenKind.command:
+            continue
+        if tok.name.startswith("if") and tokens[end - 1].text != "\\newif":
+            depth += 1
+        elif tok.name == "fi":
+            depth -= 1
+            if depth == 0:
+                return end
+        elif tok.name in ("else", "or") and depth == 1:
+            return None
+    return None
+
+
+def strip_comments(source: str) -> str:
+    """Remove the comments from `source`, along with '\\iffalse ... \\fi' blocks and
+    'comment' environments, without changing the typeset result. Lines which only
+    contain a comment are removed entirely, whereas other comments are replaced by an
+    empty comment, since the '%' also removes the line break. Verbatim text is kept."""
+    tokens = list(tokenize(source))
+    removed: list[tuple[int, int]] = []
+    idx = 0
+    while idx < len(tokens):
+        tok = tokens[idx]
+        if tok.kind == TokenKind.comment:
+            start = _line_start(source, tok.start)
+            if start is None:
+                # keep an empty comment, which removes the line break
+                removed.append((tok.start + 1, tok.end))
+            else:
+                removed.append((start, _line_end(source, tok.end, False)))
+        elif tok.kind == TokenKind.verbatim and tok.text.startswith("\\begin{comment}"):
+            start = _line_start(source, tok.start)
+            removed.append(
+                (
+                    tok.start if start is None else start,
+                    _line_end(source, tok.end, False),
+                )
+            )
+        elif tok.kind == TokenKind.command and tok.name == "iffalse":
+            fi = _closing_fi(tokens, idx)
+            if fi is not None:
+                start = _line_start(source, tok.start)
+                # spaces after '\\fi' are skipped by TeX
+                removed.append(
+                    (
+                        tok.start if start is None else start,
+                        _line_end(source, tokens[fi].end, True),
+                    )
+                )
+                idx = fi
+        idx += 1
+
+    out = []
+    pos = 0
+    for start, end in removed:
+        if end > pos:
+            out.append(source[pos : max(start, pos)])
+            pos = end
+    out.append(source[pos:])
+    return "".join(out)
+
+
+# commands which define a macro, whose name is the first argument
+DEFINITIONS: Final = {
+    "newcommand": "moom",
+    "renewcommand": "moom",
+    "providecommand": "moom",
+    "DeclareRobustCommand": "moom",
+    "DeclareMathOperator": "mm",
+    "def": "mpm",
+    "gdef": "mpm",
+    "edef": "mpm",
+    "xdef": "mpm",
+}
+
+# definitions which do not replace an existing macro, so that they can be removed if
+# the macro is not used
+NEW_DEFINITIONS: Final = frozenset(
+    {"newcommand", "providecommand", "DeclareMathOperator"}
+)
+
+_TRAILING_RE: Final = re.compile(r"[ \t]*(?:%[^\n]*)?(?:\n|$)")
+
+
+@dataclass(frozen=True)
+class Definition:
+    """The definition of the macro `name`, without the backslash."""
+
+    name: str
+    command: Command
+
+
+def iter_definitions(source: str) -> Iterable[Definition]:
+    for cmd in iter_commands(source, DEFINITIONS):
+        if len(cmd.arguments) < 2:
+            continue
+        name = cmd.arguments[0].strip()
+        if _TOKEN_RE.fullmatch(name) and name.startswith("\\"):
+            yield Definition(name[1:], cmd)
+
+
+def command_usage(source: str) -> Counter[str]:
+    """The number of times each command occurs in `source`, including definitions."""
+    return Counter(
+        tok.name for tok in tokenize(source) if tok.kind == TokenKind.command
+    )
+
+
+_CSNAME_RE: Final = re.compile(
+    r"\\csname\s*(.*?)\\endcsname|\\@nameuse\s*\{([^{}]*)\}", re.DOTALL
+)
+_NON_LETTER_RE: Final = re.compile(r"[^a-zA-Z@]")
+
+
+def csname_prefixes(source: str) -> set[str]:
+    """The names of the commands which are used through '\\csname' or '\\@nameuse' in
+    `source`. A name which is built from arguments or other macros is cut before the
+    first character which is not a letter, so that any command starting with the
+    result may be used."""
+    prefixes = set()
+    for match in _CSNAME_RE.finditer(source):
+        name = (match[1] if match[1] is not None else match[2]).strip()
+        prefixes.add(_NON_LETTER_RE.split(name, maxsplit=1)[0])
+    return prefixes
+
+
+def drop_definitions(source: str, names: Container[str]) -> str:
+    """Remove the new definitions of the macros `names` which occupy entire lines."""
+    out = []
+    pos = 0
+    for definition in iter_definitions(source):
+        if (
+            definition.name not in names
+            or definition.command.name not in NEW_DEFINITIONS
+        ):
+            continue
+        cmd = definition.command
+        start = _line_start(source, cmd.start)
+        trailing = _TRAILING_RE.match(source, cmd.end)
+        if start is None or trailing is None or start < pos:
+            continue
+        out.append(source[pos:start])
+        pos = trailing.end()
+    out.append(source[pos:])
+    return "".join(out)
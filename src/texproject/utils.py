@@ -2,6 +2,8 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 from dataclasses import dataclass
+import os
+from pathlib import Path
 import shutil
 import subprocess
 
@@ -16,13 +18,16 @@ from .control import (
     FAIL,
 )
 from .error import AbortRunner
+from .snapshot import track_changes
 from .term import FORMAT_MESSAGE
 
 if TYPE_CHECKING:
-    from pathlib import Path
-    from typing import Iterable, Literal, Optional
+    from typing import Callable, Iterable, Literal, Optional
     from .filesystem import ProjectPath, TemplateDict
     from .control import TempDir
+    from .snapshot import TreeSnapshot
+
+    IgnoreFunction = Callable[[str, list[str]], set[str]]
 
 
 def remove_path(target: Path) -> RuntimeClosure:
@@ -41,41 +46,48 @@ def rename_path(source: Path, target: Path) -> RuntimeClosure:
     return RuntimeClosure(FORMAT_MESSAGE.rename(source, target), True, _callable)
 
 
-def copy_directory(
-    proj_path: ProjectPath, source: Path, target: Path
-) -> RuntimeClosure:
-    """Copy directory `source` to `target, ignoring files from config.ignore_patterns.
+def copy_directory(snapshot: TreeSnapshot, target: Path) -> RuntimeClosure:
+    """Copy the files in `snapshot` to the directory `target`. The files matching
+    config.ignore_patterns are already excluded from the snapshot of a project.
     """
 
     def _callable() -> RuntimeOutput:
+        target.mkdir(parents=True, exist_ok=True)
         try:
-            shutil.copytree(
-                source,
-                target,
-                copy_function=shutil.copy,
-                ignore=shutil.ignore_patterns(
-                    *proj_path.config.process["ignore_patterns"]
-                ),
-            )
-        except shutil.Error:
+            for rel, st in snapshot.entries():
+                if st.is_dir:
+                    (target / rel).mkdir(exist_ok=True)
+                else:
+                    shutil.copy(snapshot.root / rel, target / rel)
+        except FileNotFoundError:
             raise AbortRunner("Directory copying failed. You may have broken symlinks?")
         return RuntimeOutput(True)
 
-    return RuntimeClosure(FORMAT_MESSAGE.copy(source, target), True, _callable)
-
+    return RuntimeClosure(FORMAT_MESSAGE.copy(snapshot.root, target), True, _callable)
 
-def make_archive(
-    source_dir: Path, target_file: Path, compression: str
-) -> RuntimeClosure:
-    def _callable() -> RuntimeOutput:
-        shutil.make_archive(str(target_file), compression, source_dir)
-        return RuntimeOutput(True)
 
-    return RuntimeClosure(
-        FORMAT_MESSAGE.archive(target_file, compression),
-        True,
-        _callable,
-    )
+def walk_tree(
+    top: Path, ignore: IgnoreFunction, skip: Optional[Path] = None
+) -> Iterable[tuple[Path, os.DirEntry]]:
+    """Walk the directory tree below `top` with a single `os.scandir` per directory,
+    yielding the directory containing each entry along with the entry itself. Entries
+    rejected by `ignore`, as well as the directory `skip`, are not visited.
+    """
+    stack = [top]
+    while len(stack) > 0:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        ignored = ignore(str(current), [entry.name for entry in entries])
+        for entry in entries:
+            if entry.name in ignored or Path(entry.path) == skip:
+                continue
+            yield current, entry
+            if entry.is_dir():
+                stack.append(Path(entry.path))
 
 
 def run_cmd(
@@ -157,14 +169,14 @@ class CleanProject(AtomicIterable):
         self,
         proj_path: ProjectPath,
         template_dict: TemplateDict,
-        _state: dict,
+        state: dict,
         _temp_dir: TempDir,
     ) -> Iterable[RuntimeClosure]:
         for mode in LinkMode:
             for path, name in NAMES.existing_template_files(proj_path.data_dir, mode):
                 if name not in template_dict[NAMES.convert_mode(mode)]:
-                    yield remove_path(path)
+                    yield track_changes(state, remove_path(path), path)
 
         if self.remove_git_files:
             for path in proj_path.git_files():
-                yield remove_path(path)
+                yield track_changes(state, remove_path(path), path)
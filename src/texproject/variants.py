@@ -0,0 +1,92 @@
+"""Variants of the document, such as an anonymized version for review, a camera-ready
+version, or a draft with comments, which are defined in the [variants] table of the
+template dictionary. Each variant only changes the class information file, which is
+rendered for the variant in the build directory or in the export.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from dataclasses import dataclass, field
+
+if TYPE_CHECKING:
+    from typing import Any, Mapping, Optional
+    from .filesystem import TemplateDict
+
+
+@dataclass(frozen=True)
+class Variant:
+    """The variant `name` of the document, which replaces the class options of the
+    template dictionary if `class_options` is given, sets the values of the constants
+    in `constants`, and adds `metadata` to the metadata available to the templates."""
+
+    name: str
+    class_options: Optional[list[str]] = None
+    constants: dict[str, str] = field(default_factory=dict)
+    metadata: dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, name: str, dct: Mapping[str, Any]) -> Variant:
+        unknown = set(dct) - {"class_options", "constants", "metadata"}
+        if len(unknown) > 0:
+            raise ValueError(
+                f"variant '{name}' has unknown keys "
+                + ", ".join(f"'{key}'" for key in sorted(unknown))
+            )
+        class_options = dct.get("class_options")
+        if class_options is not None and not _is_list_of_str(class_options):
+            raise ValueError(f"'class_options' of variant '{name}' is not a list")
+        constants = dct.get("constants", {})
+        if not isinstance(constants, dict) or not _is_list_of_str(
+            list(constants.values())
+        ):
+            raise ValueError(f"'constants' of variant '{name}' is not a table of text")
+        for constant in constants:
+            # the constants are defined as macros, whose names may only contain letters
+            if not (constant.isascii() and constant.isalpha()):
+                raise ValueError(
+                    f"constant '{constant}' of variant '{name}' may only contain letters"
+                )
+        metadata = dct.get("metadata", {})
+        if not isinstance(metadata, dict):
+            raise ValueError(f"'metadata' of variant '{name}' is not a table")
+        return cls(name, class_options, constants, metadata)
+
+    def apply(self, template_dict: Mapping[str, Any]) -> dict[str, Any]:
+        """The template dictionary of the variant."""
+        if self.class_options is None:
+            return dict(template_dict)
+        return dict(template_dict) | {"class_options": self.class_options}
+
+
+def _is_list_of_str(value: Any) -> bool:
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def variant_matrix(template_dict: TemplateDict) -> dict[str, Variant]:
+    """The variants defined in the template dictionary, in order. Raises ValueError if a
+    variant is not valid."""
+    variants = template_dict.get("variants", {})
+    if not isinstance(variants, dict):
+        raise ValueError("'variants' is not a table")
+    matrix = {}
+    for name, dct in variants.items():
+        if not isinstance(dct, dict):
+            raise ValueError(f"variant '{name}' is not a table")
+        matrix[name] = Variant.from_dict(name, dct)
+    return matrix
+
+
+def select_variants(
+    template_dict: TemplateDict, names: Optional[list[str]]
+) -> list[Variant]:
+    """The variants `names`, or all of the variants if `names` is None. Raises
+    ValueError if a variant is not defined, or if there are no variants."""
+    matrix = variant_matrix(template_dict)
+    if names is None:
+        if len(matrix) == 0:
+            raise ValueError("the template dictionary defines no variants")
+        return list(matrix.values())
+    for name in names:
+        if name not in matrix:
+            raise ValueError(f"unknown variant '{name}'")
+    return [matrix[name] for name in names]
@@ -0,0 +1,462 @@
+"""Watch a project for changes and incrementally rebuild it in a persistent build
+directory.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import ctypes
+import ctypes.util
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+import select
+import shutil
+import struct
+import sys
+import time
+from tomllib import TOMLDecodeError
+
+from .base import NAMES, LinkMode, LinkCommand
+from .control import AtomicIterable, RuntimeClosure, RuntimeOutput, SUCCESS, FAIL
+from .filesystem import LINKER_MAP
+from .output import compile_latex
+from .template import TemplateDictLinker, InfoFileWriter
+from .term import FORMAT_MESSAGE
+from .utils import walk_tree
+
+if TYPE_CHECKING:
+    from typing import Final, Iterable, Optional, Protocol
+    from .control import TempDir
+    from .filesystem import ProjectPath, TemplateDict
+    from .utils import IgnoreFunction
+
+    StatKey = tuple[int, int]
+
+    class Observer(Protocol):
+        @property
+        def backend(self) -> str:
+            ...
+
+        def watch_files(self, paths: Iterable[Path]) -> None:
+            ...
+
+        def poll(self, timeout: Optional[float]) -> Optional[set[Path]]:
+            ...
+
+        def close(self) -> None:
+            ...
+
+
+def _stat_key(st: os.stat_result) -> StatKey:
+    return (st.st_mtime_ns, st.st_size)
+
+
+@dataclass
+class SyncPlan:
+    """The files which must be copied to or removed from the build directory."""
+
+    copies: dict[Path, StatKey] = field(default_factory=dict)
+    removals: list[Path] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.copies) + len(self.removals)
+
+
+class BuildDirSync:
+    """Mirror the project tree into a build directory. Only files whose size or
+    modification time differ from the last synchronized version are copied, so that
+    the auxiliary files produced by previous compilations are retained.
+    """
+
+    def __init__(self, source: Path, target: Path, ignore: IgnoreFunction) -> None:
+        self.source: Final = source
+        self.target: Final = target
+        self._ignore = ignore
+        self._synced: dict[Path, StatKey] = {}
+
+    def _scan(self, top: Path) -> dict[Path, StatKey]:
+        return {
+            Path(entry.path).relative_to(self.source): _stat_key(entry.stat())
+            for _, entry in walk_tree(top, self._ignore, skip=self.target)
+            if entry.is_file()
+        }
+
+    def _is_ignored(self, path: Path) -> bool:
+        return len(self._ignore(str(path.parent), [path.name])) > 0
+
+    def _is_current(self, rel: Path, key: StatKey) -> bool:
+        if rel in self._synced:
+            return self._synced[rel] == key
+        # files copied during an earlier session keep their modification time
+        try:
+            return _stat_key((self.target / rel).stat()) == key
+        except FileNotFoundError:
+            return False
+
+    def plan(self, changed: Optional[Iterable[Path]] = None) -> SyncPlan:
+        """Determine the changes required to synchronize the build directory. If
+        `changed` is specified, only the corresponding paths (and subtrees) are
+        examined. Otherwise, the entire project tree is rescanned.
+        """
+        if changed is None:
+            current = self._scan(self.source)
+            candidates = set(current) | set(self._synced)
+        else:
+            current = {}
+            candidates = set()
+            for path in changed:
+                try:
+                    rel = path.relative_to(self.source)
+                except ValueError:
+                    continue
+                if path.is_dir():
+                    if self.target not in (path, *path.parents):
+                        current.update(self._scan(path))
+                elif path.is_file() and not self._is_ignored(path):
+                    current[rel] = _stat_key(path.stat())
+                candidates.add(rel)
+                candidates.update(p for p in self._synced if rel in p.parents)
+            candidates.update(current)
+
+        plan = SyncPlan()
+        for rel in sorted(candidates):
+            if rel in current:
+                if not self._is_current(rel, current[rel]):
+                    plan.copies[rel] = current[rel]
+            elif rel in self._synced:
+                plan.removals.append(rel)
+        return plan
+
+    def apply(self, plan: SyncPlan) -> RuntimeClosure:
+        def _callable() -> RuntimeOutput:
+            for rel, key in plan.copies.items():
+                (self.target / rel).parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    shutil.copy2(self.source / rel, self.target / rel)
+                except FileNotFoundError:
+                    continue
+                self._synced[rel] = key
+            for rel in plan.removals:
+                (self.target / rel).unlink(missing_ok=True)
+                del self._synced[rel]
+            return RuntimeOutput(True)
+
+        return RuntimeClosure(
+            FORMAT_MESSAGE.info(
+                f"Synchronize {len(plan.copies)} changed and {len(plan.removals)}"
+                f" removed file(s) to '{self.target}'"
+            ),
+            True,
+            _callable,
+        )
+
+
+class _PollingObserver:
+    """Detect changes by periodically comparing snapshots of the watched files."""
+
+    backend: Final = "polling"
+
+    def __init__(
+        self, root: Path, ignore: IgnoreFunction, skip: Path, interval: float = 0.5
+    ) -> None:
+        self._root = root
+        self._ignore = ignore
+        self._skip = skip
+        self._interval = interval
+        self._files: set[Path] = set()
+        self._snapshot = self._take_snapshot()
+
+    def _take_snapshot(self) -> dict[Path, StatKey]:
+        snapshot = {
+            Path(entry.path): _stat_key(entry.stat())
+            for _, entry in walk_tree(self._root, self._ignore, skip=self._skip)
+            if entry.is_file()
+        }
+        for path in self._files:
+            try:
+                snapshot[path] = _stat_key(path.stat())
+            except FileNotFoundError:
+                pass
+        return snapshot
+
+    def watch_files(self, paths: Iterable[Path]) -> None:
+        self._files = set(paths)
+        self._snapshot = self._take_snapshot()
+
+    def poll(self, timeout: Optional[float]) -> Optional[set[Path]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._take_snapshot()
+            changed = {
+                path
+                for path in set(snapshot) | set(self._snapshot)
+                if snapshot.get(path) != self._snapshot.get(path)
+            }
+            self._snapshot = snapshot
+            if len(changed) > 0:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(
+                self._interval
+                if deadline is None
+                else max(0.0, min(self._interval, deadline - time.monotonic()))
+            )
+
+    def close(self) -> None:
+        pass
+
+
+class _InotifyObserver:
+    """Receive change notifications from the Linux inotify API."""
+
+    backend: Final = "inotify"
+
+    _IN_CLOSE_WRITE: Final = 0x00000008
+    _IN_MOVED_FROM: Final = 0x00000040
+    _IN_MOVED_TO: Final = 0x00000080
+    _IN_CREATE: Final = 0x00000100
+    _IN_DELETE: Final = 0x00000200
+    _IN_Q_OVERFLOW: Final = 0x00004000
+    _IN_IGNORED: Final = 0x00008000
+    _IN_ISDIR: Final = 0x40000000
+    _MASK: Final = (
+        _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+    )
+    _EVENT: Final = struct.Struct("iIII")
+
+    def __init__(self, root: Path, ignore: IgnoreFunction, skip: Path) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "could not initialize inotify")
+        self._ignore = ignore
+        self._skip = skip
+        self._watches: dict[int, Path] = {}
+        self._tree_dirs: set[Path] = set()
+        self._files: set[Path] = set()
+        self._add_tree(root)
+
+    def _add_watch(self, path: Path) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self._MASK)
+        if wd >= 0:
+            self._watches[wd] = path
+
+    def _add_tree(self, top: Path) -> None:
+        self._add_watch(top)
+        self._tree_dirs.add(top)
+        for _, entry in walk_tree(top, self._ignore, skip=self._skip):
+            if entry.is_dir():
+                self._add_watch(Path(entry.path))
+                self._tree_dirs.add(Path(entry.path))
+
+    def watch_files(self, paths: Iterable[Path]) -> None:
+        self._files = set(paths)
+        watched = set(self._watches.values())
+        for parent in {path.parent for path in self._files} - watched:
+            self._add_watch(parent)
+
+    def _accept(self, parent: Path, name: str) -> bool:
+        path = parent / name
+        if path in self._files:
+            return True
+        return (
+            parent in self._tree_dirs
+            and path != self._skip
+            and len(self._ignore(str(parent), [name])) == 0
+        )
+
+    def poll(self, timeout: Optional[float]) -> Optional[set[Path]]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return set()
+
+        changed: set[Path] = set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            start = offset + self._EVENT.size
+            name = os.fsdecode(data[start : start + length].rstrip(b"\0"))
+            offset = start + length
+
+            if mask & self._IN_Q_OVERFLOW:
+                return None
+            parent = self._watches.get(wd)
+            if mask & self._IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if parent is None or not self._accept(parent, name):
+                continue
+
+            path = parent / name
+            if mask & self._IN_ISDIR and mask & (self._IN_CREATE | self._IN_MOVED_TO):
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def make_observer(root: Path, ignore: IgnoreFunction, skip: Path) -> Observer:
+    """Construct an inotify observer if possible, and otherwise fall back to polling."""
+    if sys.platform.startswith("linux"):
+        try:
+            return _InotifyObserver(root, ignore, skip)
+        except (OSError, AttributeError):
+            pass
+    return _PollingObserver(root, ignore, skip)
+
+
+def _collect(
+    observer: Observer, debounce: float
+) -> tuple[Optional[set[Path]], float]:
+    """Block until a change is observed, and then continue collecting changes until
+    none have been observed for `debounce` seconds. Returns the changed paths (or None
+    if the full tree must be rescanned) and the time at which the first change was
+    observed.
+    """
+    changed = observer.poll(None)
+    while changed is not None and len(changed) == 0:
+        changed = observer.poll(None)
+    start = time.monotonic()
+
+    while True:
+        more = observer.poll(debounce)
+        if more is None:
+            changed = None
+        elif len(more) == 0:
+            return changed, start
+        elif changed is not None:
+            changed |= more
+
+
+def _linked_sources(template_dict: TemplateDict) -> set[Path]:
+    return {
+        LINKER_MAP[mode].file_path(name).resolve()
+        for mode in LinkMode
+        for name in template_dict[NAMES.convert_mode(mode)]
+    }
+
+
+@dataclass
+class ProjectWatcher(AtomicIterable):
+    debounce: float = 0.2
+    force: bool = False
+
+    def _requires_render(
+        self,
+        proj_path: ProjectPath,
+        changed: Optional[set[Path]],
+        linked: set[Path],
+    ) -> bool:
+        if changed is None:
+            return True
+        return any(path in linked or path == proj_path.template for path in changed)
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        template_dict: TemplateDict,
+        state: dict,
+        temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        syncer = BuildDirSync(proj_path.dir, proj_path.build_dir, proj_path.ignore)
+        observer = make_observer(proj_path.dir, proj_path.ignore, proj_path.build_dir)
+        linked = _linked_sources(template_dict)
+        observer.watch_files(linked)
+
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info(
+                f"Watching '{proj_path.dir}' for changes using {observer.backend}"
+                " (interrupt to stop)"
+            ),
+            *SUCCESS,
+        )
+
+        changed: Optional[set[Path]] = None
+        render = False
+        start = time.monotonic()
+        cycle = 0
+        interrupts: list[KeyboardInterrupt] = []
+        try:
+            while True:
+                if render:
+                    try:
+                        template_dict.reload()
+                    except TOMLDecodeError:
+                        yield RuntimeClosure(
+                            FORMAT_MESSAGE.error(
+                                "Could not parse template dictionary; using the"
+                                " previous version."
+                            ),
+                            *FAIL,
+                        )
+                    linked = _linked_sources(template_dict)
+                    observer.watch_files(linked)
+                    yield from TemplateDictLinker(
+                        LinkCommand.replace if self.force else LinkCommand.copy
+                    )(proj_path, template_dict, state, temp_dir)
+                    yield from InfoFileWriter()(
+                        proj_path, template_dict, state, temp_dir
+                    )
+
+                plan = syncer.plan(None if render else changed)
+                if cycle == 0 or len(plan) > 0:
+                    yield _interruptible(syncer.apply(plan), interrupts)
+                    yield _interruptible(
+                        compile_latex(proj_path, proj_path.build_dir), interrupts
+                    )
+                    # the closures run outside of this generator, so an interrupt
+                    # while compiling is raised again here
+                    if len(interrupts) > 0:
+                        raise interrupts[0]
+                    yield _report_cycle(cycle, len(plan), start)
+                    cycle += 1
+
+                changed, start = _collect(observer, self.debounce)
+                render = self._requires_render(proj_path, changed, linked)
+
+        except KeyboardInterrupt:
+            yield RuntimeClosure(
+                FORMAT_MESSAGE.info(f"Stopped watching after {cycle} build(s)"),
+                *SUCCESS,
+            )
+        finally:
+            observer.close()
+
+
+def _interruptible(
+    closure: RuntimeClosure, interrupts: list[KeyboardInterrupt]
+) -> RuntimeClosure:
+    """Run `closure`, and add a keyboard interrupt during the run to `interrupts`
+    instead of raising it."""
+
+    def _callable() -> RuntimeOutput:
+        try:
+            return closure.run()
+        except KeyboardInterrupt as err:
+            interrupts.append(err)
+            return RuntimeOutput(False, "Interrupted")
+
+    return RuntimeClosure(closure.message(), closure.success(), _callable)
+
+
+def _report_cycle(cycle: int, num_changes: int, start: float) -> RuntimeClosure:
+    def _callable() -> RuntimeOutput:
+        return RuntimeOutput(
+            True,
+            f"Build {cycle} finished {time.monotonic() - start:.2f}s after the first"
+            " observed change",
+        )
+
+    return RuntimeClosure(
+        FORMAT_MESSAGE.info(f"Report latency for build {cycle} ({num_changes} changes)"),
+        True,
+        _callable,
+    )
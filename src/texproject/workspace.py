@@ -0,0 +1,163 @@
+"""Run a command of 'tpr' in each of the projects below a directory. The projects are
+processed in parallel by a pool of worker processes, which are reused between projects,
+so that the modules, the configuration of the data directory and the caches are only
+loaded once per worker.
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from dataclasses import asdict, dataclass
+import io
+import json
+import os
+from pathlib import Path
+import shlex
+import time
+
+import click
+
+from .compress import resolve_threads
+from .control import AtomicIterable, RuntimeClosure, RuntimeOutput
+from .term import FORMAT_MESSAGE
+
+if TYPE_CHECKING:
+    from typing import Final, Iterable, Optional, Sequence
+    from .control import TempDir
+    from .filesystem import ProjectPath, TemplateDict
+
+
+# the number of lines of output reported for each failed project
+_REPORTED_LINES: Final = 10
+
+
+def find_projects(root: Path, data_folder: str) -> list[Path]:
+    """The projects below `root`, which are the directories with a template dictionary
+    in their data folder `data_folder`. Hidden directories and the directories inside
+    of projects are not searched."""
+    projects = []
+    for dirpath, dirnames, _ in os.walk(root):
+        if os.path.isfile(os.path.join(dirpath, data_folder, "template.toml")):
+            projects.append(Path(dirpath))
+            dirnames.clear()
+        else:
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+    return sorted(projects)
+
+
+@dataclass
+class ProjectResult:
+    """The exit code and the output of a command run in the project at `path`."""
+
+    path: str
+    exit_code: int
+    output: str
+    duration: float
+
+    @property
+    def success(self) -> bool:
+        return self.exit_code == 0
+
+
+def run_project(project: Path, args: Sequence[str]) -> ProjectResult:
+    """Run 'tpr' with the arguments `args` in `project`, in the current process."""
+    # imported here, since the commands are defined in terms of this module
+    from .command import cli
+
+    out = io.StringIO()
+    start = time.perf_counter()
+    with redirect_stdout(out), redirect_stderr(out):
+        try:
+            cli.main(["-C", str(project), *args], "tpr", standalone_mode=False)
+            exit_code = 0
+        except click.ClickException as err:
+            err.show(file=out)
+            exit_code = err.exit_code
+        except click.Abort:
+            exit_code = 1
+        except SystemExit as err:
+            exit_code = err.code if isinstance(err.code, int) else 1
+    return ProjectResult(
+        str(project), exit_code, out.getvalue(), time.perf_counter() - start
+    )
+
+
+def _run_project_task(task: tuple[Path, Sequence[str]]) -> ProjectResult:
+    return run_project(*task)
+
+
+@dataclass
+class WorkspaceRunner(AtomicIterable):
+    """Run 'tpr' with the arguments `args` in each project below `root`, with up to
+    `jobs` projects at once. The results are summarized, and written as JSON to
+    `report` if given."""
+
+    root: Path
+    args: list[str]
+    jobs: int = 0
+    report: Optional[Path] = None
+
+    def __call__(
+        self,
+        proj_path: ProjectPath,
+        _template_dict: TemplateDict,
+        _state: dict,
+        _temp_dir: TempDir,
+    ) -> Iterable[RuntimeClosure]:
+        projects = find_projects(
+            self.root, proj_path.config.render["project_data_folder"]
+        )
+        jobs = max(1, min(resolve_threads(self.jobs), len(projects)))
+        command = shlex.join(["tpr", *self.args])
+
+        def _callable() -> RuntimeOutput:
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(
+                    pool.map(
+                        _run_project_task,
+                        [(project, self.args) for project in projects],
+                    )
+                )
+            duration = time.perf_counter() - start
+            if self.report is not None:
+                self.report.write_text(
+                    json.dumps(
+                        {
+                            "root": str(self.root),
+                            "args": self.args,
+                            "duration": duration,
+                            "projects": [
+                                asdict(result) | {"success": result.success}
+                                for result in results
+                            ],
+                        },
+                        indent=2,
+                    )
+                )
+
+            failed = [result for result in results if not result.success]
+            messages = [
+                f"{len(results) - len(failed)} of {len(results)} projects succeeded"
+                f" ({duration:.2f}s)"
+            ]
+            for result in failed:
+                messages.append(
+                    FORMAT_MESSAGE.error(
+                        f"'{command}' failed in '{result.path}' with exit code"
+                        f" {result.exit_code}"
+                    )
+                )
+                lines = click.unstyle(result.output).rstrip().splitlines()
+                messages.extend(f"  {line}" for line in lines[-_REPORTED_LINES:])
+            return RuntimeOutput(len(failed) == 0, "\n".join(messages))
+
+        yield RuntimeClosure(
+            FORMAT_MESSAGE.info(
+                f"Run '{command}' in {len(projects)} projects below '{self.root}',"
+                f" {jobs} at once"
+            ),
+            True,
+            _callable,
+        )
@@ -0,0 +1,184 @@
+from pathlib import Path, PurePosixPath
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+
+import pytest
+
+from texproject.archive import (
+    ArchiveStats,
+    ExportOverlay,
+    iter_tree,
+    parse_size,
+    write_archive,
+)
+from texproject.compress import ZSTD_AVAILABLE, CompressionPolicy
+
+
+@pytest.fixture
+def project(tmp_path: Path) -> Path:
+    root = tmp_path / "proj"
+    (root / ".data" / "macros").mkdir(parents=True)
+    (root / "main.tex").write_text("main")
+    (root / "main.aux").write_text("aux")
+    (root / ".data" / "classinfo.tex").write_text("classinfo")
+    (root / ".data" / "macros" / "local-a.sty").write_text("a")
+    return root
+
+
+def _entries(root: Path, overlay: ExportOverlay):
+    return overlay.apply(iter_tree(root, shutil.ignore_patterns("*.aux")))
+
+
+def _extract(tf: tarfile.TarFile, name: str) -> bytes:
+    fileobj = tf.extractfile(name)
+    assert fileobj is not None
+    return fileobj.read()
+
+
+@pytest.mark.parametrize("compression", ["tar", "gztar", "zip"])
+def test_overlay_archive(project: Path, tmp_path: Path, compression: str) -> None:
+    overlay = ExportOverlay()
+    for closure in [
+        overlay.rename(PurePosixPath(".data"), PurePosixPath("data")),
+        overlay.remove(PurePosixPath("data/classinfo.tex")),
+        overlay.add_text(PurePosixPath("main.tex"), lambda: "rewritten"),
+        overlay.add_text(PurePosixPath("new/README"), lambda: "readme"),
+    ]:
+        assert closure.run().success
+
+    target = write_archive(
+        _entries(project, overlay), tmp_path / "out", compression
+    ).path
+    if compression == "zip":
+        with zipfile.ZipFile(target) as zf:
+            names = {name.rstrip("/") for name in zf.namelist()}
+            main = zf.read("main.tex")
+    else:
+        with tarfile.open(target) as tf:
+            names = set(tf.getnames())
+            main = _extract(tf, "main.tex")
+
+    assert names == {
+        "main.tex",
+        "data",
+        "data/macros",
+        "data/macros/local-a.sty",
+        "new",
+        "new/README",
+    }
+    assert main == b"rewritten"
+    # the project itself is never modified
+    assert (project / "main.tex").read_text() == "main"
+
+
+def test_overlay_rewrite(project: Path, tmp_path: Path) -> None:
+    overlay = ExportOverlay()
+    for closure in [
+        overlay.rename(PurePosixPath(".data"), PurePosixPath("data")),
+        overlay.rewrite(PurePosixPath("data/classinfo.tex"), str.upper),
+        overlay.rewrite(PurePosixPath("data/classinfo.tex"), lambda s: s + "!"),
+    ]:
+        assert closure.run().success
+
+    target = write_archive(_entries(project, overlay), tmp_path / "out", "gztar").path
+    with tarfile.open(target) as tf:
+        assert _extract(tf, "data/classinfo.tex") == b"CLASSINFO!"
+        assert _extract(tf, "main.tex") == b"main"
+
+
+@pytest.mark.parametrize("compression", ["gztar", "bztar", "xztar", "zip"])
+def test_parallel_archive(project: Path, tmp_path: Path, compression: str) -> None:
+    large = b"".join(b"line %d of a large file\n" % i for i in range(120_000))
+    (project / "large.dat").write_bytes(large)
+
+    target = write_archive(
+        _entries(project, ExportOverlay()),
+        tmp_path / "out",
+        compression,
+        threads=4,
+        level=1,
+    ).path
+    if compression == "zip":
+        with zipfile.ZipFile(target) as zf:
+            assert zf.testzip() is None
+            assert zf.read("large.dat") == large
+    else:
+        with tarfile.open(target) as tf:
+            assert _extract(tf, "large.dat") == large
+            assert _extract(tf, "main.tex") == b"main"
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+@pytest.mark.parametrize("compression", ["gztar", "zip"])
+def test_store_policy(
+    project: Path, tmp_path: Path, compression: str, threads: int
+) -> None:
+    image = os.urandom(1 << 14)
+    (project / "figure.png").write_bytes(image)
+    (project / "random.dat").write_bytes(os.urandom(1 << 14))
+
+    policy = CompressionPolicy(["*.png"], entropy_threshold=7.5)
+    stats = write_archive(
+        _entries(project, ExportOverlay()),
+        tmp_path / "out",
+        compression,
+        threads=threads,
+        policy=policy,
+    )
+    assert stats.stored_entries == 2
+    assert stats.stored_size == 2 * len(image)
+    assert stats.saved_size == stats.input_size - stats.path.stat().st_size
+    if compression == "zip":
+        with zipfile.ZipFile(stats.path) as zf:
+            assert zf.getinfo("figure.png").compress_type == zipfile.ZIP_STORED
+            assert zf.getinfo("random.dat").compress_type == zipfile.ZIP_STORED
+            assert zf.getinfo("main.tex").compress_type == zipfile.ZIP_DEFLATED
+            assert zf.read("figure.png") == image
+    else:
+        with tarfile.open(stats.path) as tf:
+            assert _extract(tf, "figure.png") == image
+            assert _extract(tf, "main.tex") == b"main"
+
+
+@pytest.mark.skipif(not ZSTD_AVAILABLE, reason="zstd is not available")
+@pytest.mark.parametrize("threads", [1, 4])
+def test_zstd_archive(project: Path, tmp_path: Path, threads: int) -> None:
+    stats = write_archive(
+        _entries(project, ExportOverlay()), tmp_path / "out", "zstdtar", threads=threads
+    )
+    assert stats.path.name == "out.tar.zst"
+    try:
+        from compression import zstd  # type: ignore[import-not-found]
+
+        data = zstd.decompress(stats.path.read_bytes())
+    except ImportError:
+        import zstandard  # type: ignore[import-not-found]
+
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            stats.path.read_bytes(), read_across_frames=True
+        )
+        data = reader.read()
+    with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+        assert _extract(tf, "main.tex") == b"main"
+
+
+def test_parse_size() -> None:
+    assert parse_size("800") == 800
+    assert parse_size("50M") == 50 * 1024**2
+    assert parse_size("1.5 GiB") == 3 * 1024**3 // 2
+    assert parse_size("64kB") == 64 * 1024
+    with pytest.raises(ValueError):
+        parse_size("5Q")
+
+
+def test_archive_summary(tmp_path: Path) -> None:
+    stats = ArchiveStats(tmp_path, 3, 4096, 1, 1024, 2048, 0.5)
+    assert stats.summary() == (
+        "Wrote 2.0 KiB from 4.0 KiB in 3 entries, saved 2.0 KiB (0.50s); 1 entries"
+        " (1.0 KiB) were stored without compression"
+    )
+    stats.output_size = 5120
+    assert ", added 1.0 KiB (" in stats.summary()
@@ -0,0 +1,60 @@
+from pathlib import Path, PurePosixPath
+import sys
+
+from texproject.assets import AssetCache, AssetConverter, asset_sources
+from texproject.ignore import IgnoreMatcher
+from texproject.snapshot import TreeSnapshot
+
+# copies the input to the output, unless the input contains 'fail'
+FAKE_CONVERTER = """
+import shutil, sys
+if b"fail" in open(sys.argv[1], "rb").read():
+    sys.exit(1)
+shutil.copyfile(sys.argv[1], sys.argv[2])
+"""
+
+
+def _project(tmp_path: Path) -> TreeSnapshot:
+    root = tmp_path / "project"
+    (root / "fig").mkdir(parents=True, exist_ok=True)
+    (root / "fig" / "a.svg").write_text("a")
+    (root / "fig" / "b.svg").write_text("a")
+    (root / "fig" / "c.eps").write_text("fail")
+    (root / "fig" / "d.svg").write_text("d")
+    (root / "fig" / "d.pdf").write_text("d")
+    return TreeSnapshot(root, IgnoreMatcher(["*.svg"], root))
+
+
+def test_asset_sources(tmp_path: Path) -> None:
+    snapshot = _project(tmp_path)
+    assert {
+        str(rel): str(target)
+        for rel, target in asset_sources(snapshot, ["svg", "eps"]).items()
+    } == {"fig/a.svg": "fig/a.pdf", "fig/b.svg": "fig/b.pdf", "fig/c.eps": "fig/c.pdf"}
+
+
+def test_asset_converter(tmp_path: Path) -> None:
+    script = tmp_path / "convert.py"
+    script.write_text(FAKE_CONVERTER)
+    command = [sys.executable, str(script), "{input}", "{output}"]
+
+    def _run() -> tuple[AssetConverter, str]:
+        converter = AssetConverter(
+            _project(tmp_path),
+            AssetCache(tmp_path / "cache"),
+            {"svg": command, "eps": command},
+        )
+        return converter, str(converter.run().message())
+
+    converter, message = _run()
+    assert message.startswith("Converted 2 of 3 figures, 0 from the cache")
+    assert "Could not convert 'fig/c.eps'" in message
+    assert sorted(map(str, converter.converted)) == ["fig/a.pdf", "fig/b.pdf"]
+    # identical figures are converted once
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    converter, message = _run()
+    assert message.startswith("Converted 2 of 3 figures, 2 from the cache")
+    converter.copy_to(tmp_path / "build").run()
+    assert (tmp_path / "build" / "fig" / "a.pdf").read_text() == "a"
+    assert not (tmp_path / "project" / "fig" / "a.pdf").exists()
@@ -0,0 +1,153 @@
+from pathlib import Path, PurePosixPath
+from typing import Optional
+
+from texproject.bibtex import (
+    BibliographyCache,
+    BibliographyPruner,
+    bibliography_key,
+    entry_fields,
+    iter_entries,
+    read_aux,
+    scan_citations,
+    unscanned_citations,
+)
+
+BIB = """\
+@string{jams = "J. Amer. Math. Soc."}
+
+Free text is a comment.
+@comment{ignored, title = {@article{fake,}}}
+
+@article{First,
+  title = {A {nested} title},
+  journal = jams,
+}
+
+@book(second,
+  title = "Parens",
+)
+
+@inproceedings{third,
+  crossref = {proc},
+}
+
+@proceedings{proc,
+  title = {Proceedings},
+}
+"""
+
+
+def test_iter_entries() -> None:
+    entries = list(iter_entries(BIB))
+    assert [(e.entry_type, e.key) for e in entries] == [
+        ("string", ""),
+        ("article", "First"),
+        ("book", "second"),
+        ("inproceedings", "third"),
+        ("proceedings", "proc"),
+    ]
+    assert BIB[entries[2].start : entries[2].end].endswith('"Parens",\n)')
+    assert entries[3].dependencies(BIB) == ["proc"]
+    assert entry_fields(BIB, entries[1]) == {
+        "title": "A {nested} title",
+        "journal": "jams",
+    }
+    assert entry_fields(BIB, entries[2]) == {"title": "Parens"}
+
+
+def test_scan_citations() -> None:
+    source = r"""
+\cite{first, second}
+\citep[p.~3][]{third}
+% \cite{commented}
+\nocite{*}
+"""
+    assert scan_citations(source) == {"first", "second", "third", "*"}
+    assert unscanned_citations(source) == set()
+
+    source = r"""
+\newcommand{\mycite}[1]{\cite{#1}}
+\citestyle{plain} \mycite{a} \cites{d}{e} \citeA{f} \footfullcite{g}
+% \citealpx{commented}
+"""
+    assert unscanned_citations(source) == {
+        "\\cite{#1}",
+        "\\mycite",
+        "\\cites",
+        "\\citeA",
+        "\\footfullcite",
+    }
+
+
+def test_prune() -> None:
+    pruner = BibliographyPruner()
+    pruner.add_citations({"first", "third"})
+    pruner.add_database(BIB)
+    pruned = pruner.prune(BIB)
+
+    keys = [entry.key for entry in iter_entries(pruned)]
+    # keys are compared without case, and cross-references are kept
+    assert keys == ["", "First", "third", "proc"]
+    assert "Free text" not in pruned
+    assert pruner.summary(1) == "Kept 3 of 4 entries in 1 bibliography files"
+
+    pruner.add_citations({"*"})
+    assert pruner.prune(BIB) == BIB
+
+
+def test_read_aux(tmp_path: Path) -> None:
+    (tmp_path / "main.aux").write_text(
+        "\\relax\n\\citation{a,b}\n\\@input{chapter.aux}\n"
+    )
+    (tmp_path / "chapter.aux").write_text("\\abx@aux@cite{0}{c}\n")
+    assert read_aux(tmp_path / "main.aux") == {"a", "b", "c"}
+    assert read_aux(tmp_path / "missing.aux") == set()
+
+
+def test_bibliography_key(tmp_path: Path) -> None:
+    files = {
+        "main.tex": "\\input{body}\n\\bibliographystyle{plain}\n\\bibliography{refs}\n",
+        "body.tex": "\\cite{a} \\cite{b}\n",
+        "refs.bib": "@article{a,}\n@article{b,}\n",
+    }
+
+    def key() -> Optional[str]:
+        return bibliography_key(
+            lambda rel: files.get(str(rel)),
+            PurePosixPath("main.tex"),
+            tmp_path / "main.aux",
+        )
+
+    original = key()
+    assert original is not None and key() == original
+
+    # the order of the citations matters for unsorted styles
+    files["body.tex"] = "\\cite{b} \\cite{a}\n"
+    reordered = key()
+    assert reordered != original
+
+    files["refs.bib"] += "@article{c,}\n"
+    assert key() not in (original, reordered)
+
+    (tmp_path / "main.aux").write_text("\\citation{d}\n")
+    assert key() != reordered
+
+    # citations which are not understood are never cached
+    files["body.tex"] = "\\citeA{a} \\cite{b}\n"
+    assert key() is None
+
+    files["main.tex"] = "\\input{body}\n"
+    assert key() is None
+
+
+def test_bibliography_cache(tmp_path: Path) -> None:
+    cache = BibliographyCache(tmp_path / "cache")
+    target = tmp_path / "build" / "main.bbl"
+    assert not cache.restore("key", target)
+    assert not target.exists()
+
+    (tmp_path / "main.bbl").write_text("bbl")
+    assert cache.store("key", tmp_path / "main.bbl")
+    assert not cache.store("other", tmp_path / "missing.bbl")
+    assert cache.restore("key", target)
+    assert target.read_text() == "bbl"
@@ -0,0 +1,65 @@
+from pathlib import Path, PurePosixPath
+import json
+
+from texproject.check import ScanCache, check_document
+
+FILES = {
+    "main.tex": "\n".join(
+        [
+            r"\input{intro}",
+            r"\include{chapter}",
+            r"\newcommand{\fig}[1]{\ref{#1}}",
+            r"\bibliography{refs,missing}",
+        ]
+    ),
+    "intro.tex": "\\label{sec:intro}\nSee \\cref{sec:intro,sec:other}.\n",
+    "chapter.tex": "\\label{sec:intro}\n\\cite{Knuth,lamport}\n\\cite{undefined}\n",
+    "refs.bib": "@book{knuth,}\n\n@book{unused,}\n\n@book{Lamport,}\n@book{lamport,}\n",
+}
+
+
+def _check(cache: ScanCache, files: dict[str, str] = FILES):
+    return check_document(
+        lambda rel: files.get(str(rel)), PurePosixPath("main.tex"), cache
+    )
+
+
+def test_check_document(tmp_path: Path) -> None:
+    report = _check(ScanCache(tmp_path / "check.json"))
+    assert report.files == 3
+    assert report.errors == [
+        "Duplicate label 'sec:intro' in chapter.tex:1, intro.tex:1",
+        "Undefined reference 'sec:other' in intro.tex:2",
+        "Missing bibliography file 'missing.bib'",
+        "Duplicate bibliography entry 'lamport' in refs.bib:5, refs.bib:6",
+        "Undefined citation 'undefined' in chapter.tex:3",
+    ]
+    assert report.warnings == ["Unused bibliography entry 'unused' in refs.bib:3"]
+
+
+def test_external_labels(tmp_path: Path) -> None:
+    files = {"main.tex": "\\pageref{LastPage} \\ref{thm:a} \\ref{thm:b} \\ref{lem:c}\n"}
+    report = check_document(
+        lambda rel: files.get(str(rel)),
+        PurePosixPath("main.tex"),
+        ScanCache(tmp_path / "check.json"),
+        ["LastPage", "thm:*"],
+    )
+    assert report.errors == ["Undefined reference 'lem:c' in main.tex:1"]
+
+
+def test_scan_cache(tmp_path: Path) -> None:
+    cache = ScanCache(tmp_path / "check.json")
+    report = _check(cache)
+    cache.save()
+    stored = json.loads((tmp_path / "check.json").read_text())
+    assert len(stored["scans"]) == 4
+
+    # scans are reused, and the scans of changed files are replaced
+    files = FILES | {"intro.tex": "\\label{sec:other}\n"}
+    cache = ScanCache(tmp_path / "check.json")
+    assert _check(cache, files).errors == [
+        error for error in report.errors if "sec:" not in error
+    ]
+    cache.save()
+    assert len(json.loads((tmp_path / "check.json").read_text())["scans"]) == 4
@@ -0,0 +1,55 @@
+from pathlib import Path
+import os
+
+from texproject.citeindex import CitationIndex
+
+
+def _write(path: Path, text: str, mtime: int) -> None:
+    path.write_text(text)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_citation_index(tmp_path: Path) -> None:
+    source = tmp_path / "citations"
+    source.mkdir()
+    _write(
+        source / "books.bib",
+        "% books\n"
+        "@book{Knuth84,\n"
+        "  author = {Knuth, Donald E.},\n"
+        "  title = {The {\\TeX}book},\n"
+        "  year = 1984,\n"
+        "}\n"
+        "@book{lamport,\n"
+        '  author = "Lamport, Leslie",\n'
+        "  title = {{\\LaTeX}: A Document Preparation System},\n"
+        "  year = {1986},\n"
+        "}\n",
+        1,
+    )
+    _write(source / "other.bib", "@article{knuth84, title = {Another}}\n", 1)
+
+    index = CitationIndex(source, tmp_path / "index")
+    assert index.update()
+    assert not index.update()
+
+    entries = index.where("KNUTH84")
+    assert [(e.name, e.key) for e in entries] == [
+        ("books", "Knuth84"),
+        ("other", "knuth84"),
+    ]
+    assert index.line_number(entries[0]) == 2
+    assert index.line_number(index.where("lamport")[0]) == 7
+    assert index.where("knuth") == []
+
+    assert [e.key for e in index.search("texbook")] == ["Knuth84"]
+    assert [e.key for e in index.search("lamp doc 1986")] == ["lamport"]
+    assert [e.key for e in index.search("19")] == ["Knuth84", "lamport"]
+    assert index.search("knuth 1986") == []
+
+    # only changed files are indexed again
+    _write(source / "other.bib", "@article{euler, title = {Another}}\n", 2)
+    (source / "books.bib").unlink()
+    assert index.update()
+    assert index.where("knuth84") == []
+    assert [e.key for e in index.search("another")] == ["euler"]
@@ -0,0 +1,77 @@
+from pathlib import Path, PurePosixPath
+
+from texproject.deps import DependencyScanner
+from texproject.ignore import IgnoreMatcher
+from texproject.snapshot import TreeSnapshot
+from texproject.tex import iter_commands, tokenize
+
+SOURCE = r"""\documentclass[a4paper]{article}
+\usepackage{amsmath, local}% \input{commented}
+\graphicspath{{figures/}}
+\begin{document}
+\input{sections/intro}
+\include{chapter}
+\input appendix
+\verb|\input{verbatim}|
+\begin{verbatim}
+\input{verbatim}
+\end{verbatim}
+\includegraphics[width=\linewidth]{plot}
+\includegraphics{missing}
+\bibliographystyle{plain}
+\bibliography{refs}
+\end{document}
+"""
+
+
+def test_tokenize() -> None:
+    assert "".join(tok.text for tok in tokenize(SOURCE)) == SOURCE
+    commands = list(
+        iter_commands(SOURCE, {"documentclass": 1, "input": 1, "includegraphics": 1})
+    )
+    assert [(cmd.name, cmd.options, cmd.arguments) for cmd in commands] == [
+        ("documentclass", ("a4paper",), ("article",)),
+        ("input", (), ("sections/intro",)),
+        ("input", (), ("appendix",)),
+        ("includegraphics", ("width=\\linewidth",), ("plot",)),
+        ("includegraphics", (), ("missing",)),
+    ]
+
+
+def test_scan_dependencies(tmp_path: Path) -> None:
+    files = {
+        "main.tex": SOURCE,
+        "local.sty": r"\RequirePackage{helper}",
+        "helper.sty": "",
+        "sections/intro.tex": r"\input{sections/part}",
+        "sections/part.tex": "",
+        "chapter.tex": "",
+        "appendix.tex": "",
+        "figures/plot.pdf": "",
+        "figures/plot.eps": "",
+        "figures/unused.png": "",
+        "refs.bib": "",
+        "draft.tex": "",
+        "main.aux": "",
+    }
+    for name, text in files.items():
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(text)
+
+    snapshot = TreeSnapshot(tmp_path, IgnoreMatcher(["*.aux"], tmp_path))
+    deps = DependencyScanner(snapshot).scan(PurePosixPath("main.tex"))
+    assert {rel.as_posix() for rel in deps.files} == {
+        "main.tex",
+        "local.sty",
+        "helper.sty",
+        "sections/intro.tex",
+        "sections/part.tex",
+        "chapter.tex",
+        "appendix.tex",
+        "figures/plot.pdf",
+        "refs.bib",
+    }
+    assert [(ref.command, ref.name) for ref in deps.missing] == [
+        ("includegraphics", "missing")
+    ]
+    assert PurePosixPath("figures") in deps.with_parents()
@@ -0,0 +1,77 @@
+from pathlib import Path, PurePosixPath
+import sys
+
+from texproject.externalize import Externalizer, FigureCache, iter_pictures
+
+# writes the output of a successful compilation, unless the document contains 'fail'
+FAKE_LATEX = """
+import sys
+jobname = sys.argv[1].removeprefix("-jobname=")
+if "fail" in open(sys.argv[2]).read():
+    sys.exit(1)
+open(jobname + ".pdf", "w").write("%PDF")
+open(jobname + ".log", "w").write("texproject-depth=1.5pt\\n")
+"""
+
+PICTURE = r"\begin{tikzpicture}\draw (0,0) -- (1,1);\end{tikzpicture}"
+
+
+def test_iter_pictures() -> None:
+    source = "\n".join(
+        [
+            r"\begin{tikzpicture}[scale=2]",
+            r"\begin{tikzpicture}\end{tikzpicture}",
+            r"\end{tikzpicture}",
+            r"\begin{tikzpicture}[remember picture, overlay]\end{tikzpicture}",
+            r"\begin{tikzpicture}\node {\ref{fig}};\end{tikzpicture}",
+            PICTURE,
+        ]
+    )
+    pictures = list(iter_pictures(source))
+    assert [picture.text(source) for picture in pictures] == [
+        "\n".join(source.splitlines()[:3]),
+        PICTURE,
+    ]
+    assert list(iter_pictures(source, pictures[1].start + 1)) == []
+
+
+def test_externalizer(tmp_path: Path) -> None:
+    script = tmp_path / "latex.py"
+    script.write_text(FAKE_LATEX)
+    build_dir = tmp_path / "build"
+    build_dir.mkdir()
+    main = "\n".join(
+        [
+            r"\documentclass{article}",
+            r"\usepackage{tikz}",
+            PICTURE,
+            r"\begin{document}",
+            PICTURE,
+            r"\input{fig}",
+            r"\end{document}",
+        ]
+    )
+    fig = "\n".join([PICTURE.replace("1,1", "2,2"), PICTURE.replace("1,1", "fail")])
+
+    def _run() -> tuple[str, str]:
+        (build_dir / "main.tex").write_text(main)
+        (build_dir / "fig.tex").write_text(fig)
+        output = Externalizer(
+            build_dir,
+            PurePosixPath("main.tex"),
+            FigureCache(tmp_path / "cache"),
+            [sys.executable, str(script)],
+        ).run()
+        assert output.success
+        return str(output.message()), (build_dir / "main.tex").read_text()
+
+    message, text = _run()
+    assert message == "Externalized 2 of 3 pictures, compiling 2 (1 failed)"
+    assert text.count(PICTURE) == 1
+    assert r"\raisebox{-1.5pt}{\pgfimage{tpr-figures/" in text
+    assert "fail" in (build_dir / "fig.tex").read_text()
+    assert len(list((build_dir / "tpr-figures").iterdir())) == 2
+
+    # the figures which compiled are taken from the cache
+    message, _ = _run()
+    assert message == "Externalized 2 of 3 pictures, compiling 0 (1 failed)"
@@ -0,0 +1,79 @@
+from pathlib import Path, PurePosixPath
+
+import pytest
+
+from texproject.error import AbortRunner
+from texproject.flatten import Flattener, snapshot_reader, write_flattened
+from texproject.ignore import IgnoreMatcher
+from texproject.snapshot import TreeSnapshot
+
+MAIN = r"""\documentclass{article}
+\includeonly{one,three}
+\begin{document}
+\input{sections/a}
+\input{sections/b} after
+% \input{sections/a}
+\include{one}
+\include{two}
+\input{amsfonts.sty}
+\end{document}
+"""
+
+FLATTENED = r"""\documentclass{article}
+\includeonly{one,three}
+\begin{document}
+A
+B % comment
+ after
+% \input{sections/a}
+\clearpage
+one
+ trailing
+\clearpage
+\clearpage
+\input{amsfonts.sty}
+\end{document}
+"""
+
+
+def _flatten(root: Path, files: dict[str, str]) -> tuple[str, Flattener]:
+    for name, text in files.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(text)
+    flattener = Flattener(snapshot_reader(TreeSnapshot(root, IgnoreMatcher([], root))))
+    return "".join(flattener.flatten(PurePosixPath("main.tex"))), flattener
+
+
+def test_flatten(tmp_path: Path) -> None:
+    text, flattener = _flatten(
+        tmp_path,
+        {
+            "main.tex": MAIN,
+            "sections/a.tex": "A\n",
+            "sections/b.tex": "B % comment",
+            "one.tex": "one\n\\endinput trailing\nnot read\n",
+            "two.tex": "two\n",
+        },
+    )
+    assert text == FLATTENED
+    assert {rel.as_posix() for rel in flattener.inlined} == {
+        "sections/a.tex",
+        "sections/b.tex",
+        "one.tex",
+    }
+
+
+def test_flatten_cycle(tmp_path: Path) -> None:
+    with pytest.raises(AbortRunner, match="Cyclic input"):
+        _flatten(tmp_path, {"main.tex": r"\input{a}", "a.tex": r"\input{main}"})
+
+
+def test_write_flattened_latin1(tmp_path: Path) -> None:
+    (tmp_path / "main.tex").write_text("\\input{a}\n")
+    (tmp_path / "a.tex").write_bytes("caf\xe9\n".encode("latin-1"))
+    flattener = Flattener(
+        snapshot_reader(TreeSnapshot(tmp_path, IgnoreMatcher([], tmp_path)))
+    )
+    target = tmp_path / "out" / "main.tex"
+    assert write_flattened(flattener, PurePosixPath("main.tex"), target).success
+    assert target.read_bytes() == "caf\xe9\n".encode("latin-1")
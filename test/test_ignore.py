@@ -0,0 +1,82 @@
+from pathlib import Path
+import shutil
+import subprocess
+
+import pytest
+
+from texproject.filesystem import TOMLLoader
+from texproject.ignore import IgnoreMatcher
+from texproject.utils import walk_tree
+
+PATTERNS = TOMLLoader.default_config()["process"]["ignore_patterns"] + [
+    "build/",
+    "/figures/*.eps",
+    "docs/**/draft.tex",
+    "[Nn]otes?.txt",
+    "*.log",
+]
+FILES = [
+    "main.tex",
+    "main.aux",
+    "main.synctex.gz",
+    "main.run.xml",
+    "out.tar.gz",
+    "keep.log",
+    "other.log",
+    ".DS_Store",
+    "tmp/a.tex",
+    "build/a.tex",
+    "sub/build",
+    "sub/tmp/a.tex",
+    "figures/a.eps",
+    "figures/a.pdf",
+    "sub/figures/a.eps",
+    "docs/draft.tex",
+    "docs/a/b/draft.tex",
+    "note.txt",
+    "Notes.txt",
+    "notes.tex",
+]
+
+
+def _walk(matcher: IgnoreMatcher, root: Path) -> set[str]:
+    return {
+        Path(entry.path).relative_to(root).as_posix()
+        for _, entry in walk_tree(root, matcher)
+        if entry.is_file()
+    }
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not available")
+@pytest.mark.parametrize("extra", [[], ["!keep.log"]])
+def test_matches_gitignore(tmp_path: Path, extra: list[str]) -> None:
+    patterns = PATTERNS + extra
+    for name in FILES:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("")
+    (tmp_path / ".gitignore").write_text("\n".join(patterns) + "\n")
+    subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+
+    proc = subprocess.run(
+        ["git", "ls-files", "--others", "--exclude-standard"],
+        cwd=tmp_path,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    expected = set(proc.stdout.split()) - {".gitignore"}
+
+    matcher = IgnoreMatcher(patterns, tmp_path)
+    assert _walk(matcher, tmp_path) - {".gitignore"} == expected
+    assert "sub/build" in expected
+    assert ("keep.log" in expected) == (len(extra) > 0)
+
+
+def test_shutil_compatible(tmp_path: Path) -> None:
+    (tmp_path / "a" / "tmp").mkdir(parents=True)
+    (tmp_path / "a" / "main.aux").write_text("")
+    (tmp_path / "a" / "main.tex").write_text("")
+    matcher = IgnoreMatcher(["*.aux", "tmp/"], tmp_path)
+    names = ["tmp", "main.aux", "main.tex"]
+    assert matcher(str(tmp_path / "a"), names) == {"tmp", "main.aux"}
+    assert matcher.match("a/b.aux") and not matcher.match("tmp")
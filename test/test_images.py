@@ -0,0 +1,74 @@
+from pathlib import Path, PurePosixPath
+import io
+
+import pytest
+
+from texproject.archive import ArchiveEntry
+from texproject.images import (
+    PILLOW_AVAILABLE,
+    ImageCache,
+    ImageRecompressor,
+    ImageSettings,
+    recompress_image,
+)
+
+
+def _noise(size: int, fmt: str) -> bytes:
+    from PIL import Image
+
+    image = Image.effect_noise((size, size), 64).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, fmt, dpi=(600, 600))
+    return out.getvalue()
+
+
+def test_image_settings() -> None:
+    settings = ImageSettings(dpi=200, width=5, quality=90)
+    assert settings.max_pixels == 1000
+    assert [(s.dpi, s.quality) for s in settings.fallbacks()] == [
+        (200, 90),
+        (150, 75),
+        (100, 70),
+    ]
+
+
+@pytest.mark.skipif(not PILLOW_AVAILABLE, reason="Pillow is not available")
+def test_recompress_image() -> None:
+    from PIL import Image
+
+    data = _noise(400, "PNG")
+    result = recompress_image(data, ".png", ImageSettings(dpi=100, width=2))
+    with Image.open(io.BytesIO(result)) as image:
+        assert image.size == (200, 200)
+        # the natural size of the image is unchanged
+        assert [round(dpi) for dpi in image.info["dpi"]] == [300, 300]
+
+    # images which are not made smaller are kept
+    out = io.BytesIO()
+    Image.open(io.BytesIO(_noise(64, "PNG"))).save(out, "JPEG", quality=10)
+    small = out.getvalue()
+    assert recompress_image(small, ".jpg", ImageSettings()) == small
+
+
+@pytest.mark.skipif(not PILLOW_AVAILABLE, reason="Pillow is not available")
+def test_image_recompressor(tmp_path: Path) -> None:
+    entries = [
+        ArchiveEntry.from_bytes(PurePosixPath("main.tex"), b"x" * 1000),
+        ArchiveEntry.from_bytes(PurePosixPath("fig/a.jpg"), _noise(1000, "JPEG")),
+    ]
+    original = entries[1].size()
+
+    # smaller settings are tried until the files fit
+    recompressor = ImageRecompressor(
+        ImageCache(tmp_path), ImageSettings(width=4), max_size=original // 4, jobs=2
+    )
+    message = str(recompressor.run(lambda: entries).message())
+    assert "Recompressed 1 of 1 images with 100 dpi" in message
+    assert message.splitlines()[-1].endswith("main.tex")
+    path = recompressor.replaced[PurePosixPath("fig/a.jpg")]
+    assert path.stat().st_size + 1000 <= original // 4
+
+    # the results are cached
+    mtime = path.stat().st_mtime_ns
+    ImageRecompressor(ImageCache(tmp_path), ImageSettings(width=4)).run(lambda: entries)
+    assert path.stat().st_mtime_ns == mtime
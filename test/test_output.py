@@ -0,0 +1,181 @@
+from pathlib import Path
+import os
+import sys
+
+from texproject.control import TempDir
+from texproject.filesystem import ProjectPath, TemplateDict
+from texproject.ignore import IgnoreMatcher
+from texproject.output import (
+    ExportContext,
+    FlattenMain,
+    StripComments,
+    compile_documents,
+    compile_latex,
+    copy_output,
+    document_output,
+    output_targets,
+    write_variant_info,
+)
+from texproject.snapshot import TreeSnapshot
+from texproject.variants import Variant
+
+# writes the output of the root file into the output directory, unless it contains
+# 'fail'
+FAKE_LATEXMK = f"""#!{sys.executable}
+import os, sys
+outdir = "."
+for arg in sys.argv[1:]:
+    if arg.startswith("-outdir="):
+        outdir = arg.removeprefix("-outdir=")
+if "fail" in open(sys.argv[-1]).read():
+    sys.exit(1)
+name = os.path.basename(sys.argv[-1]).removesuffix(".tex")
+open(os.path.join(outdir, name + ".pdf"), "w").write(sys.argv[-1])
+"""
+
+
+def _project(tmp_path: Path) -> ProjectPath:
+    (tmp_path / "config.toml").write_text(
+        "[render]\ndocuments = ['supplement', 'slides/talk.tex', 'main']\n"
+    )
+    return ProjectPath(tmp_path)
+
+
+def test_documents(tmp_path: Path) -> None:
+    proj_path = _project(tmp_path)
+    assert proj_path.documents == ["main", "supplement", "slides/talk"]
+
+    build_dir = tmp_path / "build"
+    assert document_output(proj_path, build_dir, "main", ".pdf") == (
+        build_dir / "main.pdf"
+    )
+    assert document_output(proj_path, build_dir, "slides/talk", ".pdf") == (
+        build_dir / "tpr-documents" / "slides" / "talk" / "talk.pdf"
+    )
+
+    assert output_targets(proj_path, tmp_path / "out.pdf", ".pdf") == {
+        "main": tmp_path / "out.pdf",
+        "supplement": tmp_path / "out-supplement.pdf",
+        "slides/talk": tmp_path / "out-talk.pdf",
+    }
+    assert output_targets(proj_path, tmp_path, ".pdf")["slides/talk"] == (
+        tmp_path / "talk.pdf"
+    )
+    assert output_targets(
+        proj_path, tmp_path / "out.pdf", ".pdf", Variant("review")
+    ) == {
+        "main": tmp_path / "out-review.pdf",
+        "supplement": tmp_path / "out-supplement-review.pdf",
+        "slides/talk": tmp_path / "out-talk-review.pdf",
+    }
+
+
+def test_compile_documents(tmp_path: Path, monkeypatch) -> None:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "latexmk").write_text(FAKE_LATEXMK)
+    (bin_dir / "latexmk").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    proj_path = _project(tmp_path)
+    build_dir = tmp_path / "build"
+    (build_dir / "slides").mkdir(parents=True)
+    (build_dir / "chapters").mkdir()
+    for name in proj_path.documents:
+        (build_dir / (name + ".tex")).write_text(name)
+
+    def _compile() -> bool:
+        return (
+            compile_documents(
+                proj_path,
+                {
+                    name: compile_latex(proj_path, build_dir, document=name)
+                    for name in proj_path.documents
+                },
+            )
+            .run()
+            .success
+        )
+
+    assert _compile()
+    # the directories of the project are created in the output directories
+    assert (build_dir / "tpr-documents" / "supplement" / "chapters").is_dir()
+
+    copy_output(
+        proj_path,
+        build_dir,
+        {".pdf": tmp_path / "out.pdf"},
+        documents=proj_path.documents,
+    ).run()
+    assert (tmp_path / "out.pdf").read_text() == "main.tex"
+    assert (tmp_path / "out-talk.pdf").read_text() == "slides/talk.tex"
+
+    (build_dir / "supplement.tex").write_text("fail")
+    assert not _compile()
+
+
+def test_write_variant_info(tmp_path: Path) -> None:
+    proj_path = ProjectPath(tmp_path)
+    template_dict = TemplateDict()
+    template_dict["class_options"] = ["11pt"]
+    variant = Variant("draft", ["draft"], {"status": "Draft"})
+    write_variant_info(proj_path, template_dict, variant, tmp_path / "build").run()
+    text = (tmp_path / "build" / ".texproject" / "classinfo.tex").read_text()
+    assert text.startswith("\\documentclass[draft]{article}")
+    assert "\\AtBeginDocument{\\def\\status{Draft}}" in text
+
+
+def test_flatten_main(tmp_path: Path) -> None:
+    (tmp_path / "config.toml").write_text("[render]\ndocuments = ['supplement']\n")
+    proj_path = ProjectPath(tmp_path)
+    (tmp_path / "main.tex").write_text(
+        "\\input{sections/intro}\n\\input{parts/a/b}\n\\input{chapters/c/d}\n"
+    )
+    (tmp_path / "supplement.tex").write_text("\\input{parts/a/b}\n")
+    (tmp_path / "sections").mkdir()
+    (tmp_path / "sections" / "intro.tex").write_text("intro\n")
+    (tmp_path / "sections" / "figure.pdf").write_text("figure")
+    for rel in ["parts/a/b.tex", "chapters/c/d.tex"]:
+        (tmp_path / rel).parent.mkdir(parents=True)
+        (tmp_path / rel).write_text("text\n")
+
+    export = ExportContext(
+        TreeSnapshot(tmp_path, IgnoreMatcher([], tmp_path), tmp_path / "tmp"),
+        ".texproject",
+    )
+    (tmp_path / "tmp").mkdir()
+    for closure in FlattenMain()(
+        proj_path, TemplateDict(), {"export": export}, TempDir(str(tmp_path / "tmp"))
+    ):
+        assert closure.run().success
+
+    # directories which only contained inlined files are removed, and the files used
+    # by the other documents are kept
+    assert {entry.arcname.as_posix() for entry in export.entries()} == {
+        "config.toml",
+        "main.tex",
+        "supplement.tex",
+        "sections",
+        "sections/figure.pdf",
+        "parts",
+        "parts/a",
+        "parts/a/b.tex",
+    }
+
+
+def test_strip_comments_latin1(tmp_path: Path) -> None:
+    proj_path = ProjectPath(tmp_path)
+    (tmp_path / "main.tex").write_bytes("caf\xe9 % comment\n".encode("latin-1"))
+    export = ExportContext(
+        TreeSnapshot(tmp_path, IgnoreMatcher([], tmp_path), tmp_path / "tmp"),
+        ".texproject",
+    )
+    for closure in StripComments()(
+        proj_path, TemplateDict(), {"export": export}, TempDir(str(tmp_path / "tmp"))
+    ):
+        assert closure.run().success
+
+    # sources which are not UTF-8 are kept byte for byte
+    (entry,) = export.entries()
+    with entry.open() as fileobj:
+        assert fileobj.read() == "caf\xe9 %\n".encode("latin-1")
@@ -0,0 +1,54 @@
+from texproject.packages import find_unused_packages, scan_package
+
+
+def test_scan_package() -> None:
+    scan = scan_package(
+        "\n".join(
+            [
+                r"\ProvidesPackage{local-general}",
+                r"\newcommand{\R}{\mathbb{R}}",
+                r"\DeclareMathOperator{\tr}{tr}",
+                r"\newtheorem{lemma}{Lemma}[section]",
+                r"\newenvironment{proofsketch}{\begin{proof}}{\end{proof}}",
+                "% \\setlength{\\parindent}{0pt}",
+            ]
+        )
+    )
+    assert scan.commands == {"R", "tr"}
+    assert scan.environments == {"lemma", "proofsketch"}
+    assert {"mathbb", "R"} <= scan.used_commands
+    assert scan.used_environments == {"proof"}
+    assert not scan.side_effects
+
+    for source in [
+        r"\RequirePackage{amsmath}",
+        r"\renewcommand{\vec}[1]{\mathbf{#1}}",
+        "\\newcommand{\\R}{\\mathbb{R}}\n\\setlength{\\parindent}{0pt}",
+    ]:
+        assert scan_package(source).side_effects
+
+
+def test_find_unused_packages() -> None:
+    packages = {
+        "general": r"\newcommand{\R}{\mathbb{R}}",
+        "helpers": r"\newcommand{\norm}[1]{\lVert #1 \rVert}",
+        "analysis": r"\newcommand{\normR}[1]{\norm{#1}_{\R}}",
+        "unused": r"\newcommand{\unused}{} \newenvironment{box}{}{}",
+        "layout": r"\ProvidesPackage{local-layout}",
+        "patches": r"\newcommand{\patched}{} \renewcommand{\maketitle}{}",
+    }
+    unused = find_unused_packages(packages, [r"\begin{document} $\normR{x}$"])
+    # 'helpers' and 'general' are used by 'analysis', which is used by the document
+    assert list(unused) == ["patches", "unused"]
+    assert unused["patches"].side_effects
+    assert unused["unused"].definitions == 2
+
+    # the usage of the document is also followed when every package has definitions
+    del packages["layout"]
+    assert list(find_unused_packages(packages, [r"\normR{x}"])) == ["patches", "unused"]
+    assert list(find_unused_packages(packages, [r"\R"])) == [
+        "analysis",
+        "helpers",
+        "patches",
+        "unused",
+    ]
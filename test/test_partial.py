@@ -0,0 +1,52 @@
+from pathlib import Path, PurePosixPath
+
+from texproject.partial import (
+    PartialBuildState,
+    chapter_name,
+    find_chapters,
+    plan_build,
+)
+
+
+def test_find_chapters() -> None:
+    files = {
+        "main.tex": "\\input{front}\n\\include{chapters/intro}\n% \\include{old}\n",
+        "front.tex": "\\include{chapters/./proof}\\include{chapters/intro}",
+    }
+    assert find_chapters(
+        lambda rel: files.get(str(rel)), PurePosixPath("main.tex")
+    ) == [
+        "chapters/intro",
+        "chapters/proof",
+    ]
+    assert chapter_name("chapters/intro.tex") == "chapters/intro"
+    assert chapter_name("../intro") is None
+
+
+def test_plan_build(tmp_path: Path) -> None:
+    chapters = {"intro": "a", "proof": "b"}
+
+    # the first build is a full build
+    plan = plan_build(PartialBuildState(), "m", chapters, None, 2)
+    assert plan.included is None and plan.options() == []
+    state = PartialBuildState("m", dict(chapters), 0)
+    state.save(tmp_path / "partial.json")
+    assert PartialBuildState.load(tmp_path / "partial.json") == state
+
+    plan = plan_build(state, "m", {"intro": "a", "proof": "c"}, None, 2)
+    assert plan.included == ["proof"]
+    assert plan.options() == ["-usepretex=\\includeonly{proof}"]
+    assert plan_build(state, "m", chapters, None, 2).included == []
+    assert plan_build(state, "m", chapters, ["intro"], 2).included == ["intro"]
+
+    # changes outside of the chapters, and many partial builds, need a full build
+    assert plan_build(state, "n", chapters, None, 2).included is None
+    state.partial_builds = 2
+    assert plan_build(state, "m", chapters, None, 2).included is None
+    assert plan_build(state, "m", chapters, None, 0).included == []
+
+    # partial builds only record the chapters which were compiled
+    state.record(plan_build(state, "n", chapters, ["intro"], 2), "n", {"intro": "d"})
+    assert state == PartialBuildState("m", {"intro": "d"}, 3)
+    state.record(plan_build(state, "n", chapters, None, 2), "n", chapters)
+    assert state == PartialBuildState("n", chapters, 0)
@@ -0,0 +1,50 @@
+from pathlib import Path, PurePosixPath
+import shutil
+import subprocess
+
+import pytest
+
+from texproject.archive import iter_snapshot
+from texproject.filesystem import ProjectPath
+from texproject.revision import RevisionSnapshot
+
+
+def _git(root: Path, *args: str) -> None:
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=root,
+        check=True,
+        capture_output=True,
+    )
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not available")
+def test_revision_snapshot(tmp_path: Path) -> None:
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "main.tex").write_text("main")
+    (tmp_path / "main.aux").write_text("aux")
+    (tmp_path / "sub" / "chapter.tex").write_text("chapter")
+    (tmp_path / "link.tex").symlink_to("sub/chapter.tex")
+    _git(tmp_path, "init", "-q")
+    _git(tmp_path, "add", "-A")
+    _git(tmp_path, "commit", "-q", "-m", "init")
+    _git(tmp_path, "tag", "v1")
+
+    (tmp_path / "main.tex").write_text("changed")
+    (tmp_path / "new.tex").write_text("new")
+    (tmp_path / "sub" / "chapter.tex").unlink()
+
+    snapshot = RevisionSnapshot(ProjectPath(tmp_path), "v1")
+    contents = {
+        entry.arcname: entry.open().read()
+        for entry in iter_snapshot(snapshot)
+        if not entry.is_dir
+    }
+    assert contents == {
+        PurePosixPath("main.tex"): b"main",
+        PurePosixPath("link.tex"): b"chapter",
+        PurePosixPath("sub/chapter.tex"): b"chapter",
+    }
+    assert snapshot.read_text(tmp_path / "main.tex") == "main"
+    assert not snapshot.exists(tmp_path / "new.tex")
+    assert (tmp_path / "main.tex").read_text() == "changed"
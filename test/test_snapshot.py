@@ -0,0 +1,81 @@
+from pathlib import Path
+
+from texproject.control import RuntimeClosure, RuntimeOutput
+from texproject.ignore import IgnoreMatcher
+from texproject.snapshot import TreeSnapshot
+from texproject.utils import remove_path
+
+
+def test_tree_snapshot(tmp_path: Path) -> None:
+    (tmp_path / "macros").mkdir()
+    (tmp_path / "tmp").mkdir()
+    (tmp_path / "main.tex").write_text("main")
+    (tmp_path / "main.aux").write_text("aux")
+    (tmp_path / "macros" / "local-a.sty").write_text("a")
+    (tmp_path / "macros" / "local-b.sty").write_text("b")
+
+    snapshot = TreeSnapshot(
+        tmp_path, IgnoreMatcher(["*.aux"], tmp_path), tmp_path / "tmp"
+    )
+    assert {rel.as_posix() for rel, _ in snapshot.entries()} == {
+        "main.tex",
+        "macros",
+        "macros/local-a.sty",
+        "macros/local-b.sty",
+    }
+    stat = snapshot.stat(tmp_path / "main.tex")
+    assert stat is not None and stat.size == 4
+    assert sorted(snapshot.listdir(tmp_path / "macros")) == [
+        "local-a.sty",
+        "local-b.sty",
+    ]
+
+    # ignored and skipped paths are looked up in the filesystem
+    assert snapshot.is_ignored(tmp_path / "main.aux")
+    assert snapshot.exists(tmp_path / "main.aux")
+    (tmp_path / "tmp" / "file").write_text("")
+    assert snapshot.exists(tmp_path / "tmp" / "file")
+
+    # changes made outside of tracked closures are not seen
+    (tmp_path / "new.tex").write_text("new")
+    assert not snapshot.exists(tmp_path / "new.tex")
+
+    snapshot.track(
+        remove_path(tmp_path / "macros" / "local-a.sty"),
+        tmp_path / "macros" / "local-a.sty",
+    ).run()
+    assert [p.name for p in snapshot.glob(tmp_path / "macros", "local-*")] == [
+        "local-b.sty"
+    ]
+
+    def _write() -> RuntimeOutput:
+        (tmp_path / "sub" / "dir").mkdir(parents=True)
+        (tmp_path / "sub" / "dir" / "file.tex").write_text("file")
+        return RuntimeOutput(True)
+
+    snapshot.track(
+        RuntimeClosure("", True, _write), tmp_path / "sub" / "dir" / "file.tex"
+    ).run()
+    assert snapshot.exists(tmp_path / "sub" / "dir" / "file.tex")
+    assert snapshot.listdir(tmp_path / "sub") == ["dir"]
+
+
+def test_listed_snapshot(tmp_path: Path) -> None:
+    (tmp_path / "sub" / "dir").mkdir(parents=True)
+    (tmp_path / "main.tex").write_text("main")
+    (tmp_path / "main.aux").write_text("aux")
+    (tmp_path / "untracked.tex").write_text("untracked")
+    (tmp_path / "sub" / "dir" / "file.tex").write_text("file")
+
+    snapshot = TreeSnapshot(
+        tmp_path,
+        IgnoreMatcher(["*.aux"], tmp_path),
+        list_files=lambda: ["main.tex", "main.aux", "sub/dir/file.tex", "deleted.tex"],
+    )
+    assert [rel.as_posix() for rel, _ in snapshot.entries()] == [
+        "main.tex",
+        "sub",
+        "sub/dir",
+        "sub/dir/file.tex",
+    ]
+    assert not snapshot.exists(tmp_path / "untracked.tex")
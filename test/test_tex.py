@@ -0,0 +1,84 @@
+from collections import Counter
+
+from texproject.tex import (
+    command_usage,
+    csname_prefixes,
+    drop_definitions,
+    iter_definitions,
+    strip_comments,
+)
+
+
+def test_strip_comments() -> None:
+    source = "\n".join(
+        [
+            "% header",
+            r"\documentclass{article} % trailing",
+            "   % indented",
+            "foo%",
+            r"bar 50\% \url{a%20b}",
+            r"\begin{verbatim}",
+            "% kept",
+            r"\end{verbatim}",
+            r"\iffalse",
+            r"dead \iftrue x\fi",
+            r"\fi",
+            r"a \iffalse b\fi c",
+            r"\iffalse x\else y\fi",
+            r"\begin{comment}",
+            "gone",
+            r"\end{comment}",
+            "end % last",
+        ]
+    )
+    assert strip_comments(source) == "\n".join(
+        [
+            r"\documentclass{article} %",
+            "foo%",
+            r"bar 50\% \url{a%20b}",
+            r"\begin{verbatim}",
+            "% kept",
+            r"\end{verbatim}",
+            "a c",
+            r"\iffalse x\else y\fi",
+            "end %",
+        ]
+    )
+
+
+def test_drop_definitions() -> None:
+    source = "\n".join(
+        [
+            r"\newcommand{\used}{u}",
+            r"\newcommand\unused[1]{x #1}%",
+            r"\renewcommand{\baselinestretch}{1.5}",
+            r"\DeclareMathOperator{\Tr}{Tr} \newcommand{\inline}{i}",
+            r"\newcommand{\multi}{a",
+            "b}",
+            r"\used",
+        ]
+    )
+    usage = command_usage(source)
+    definitions = Counter(definition.name for definition in iter_definitions(source))
+    unused = {name for name in definitions if usage[name] <= definitions[name]}
+    assert unused == {"unused", "baselinestretch", "Tr", "inline", "multi"}
+    assert drop_definitions(source, unused) == "\n".join(
+        [
+            r"\newcommand{\used}{u}",
+            r"\renewcommand{\baselinestretch}{1.5}",
+            r"\DeclareMathOperator{\Tr}{Tr} \newcommand{\inline}{i}",
+            r"\used",
+        ]
+    )
+
+
+def test_csname_prefixes() -> None:
+    source = "\n".join(
+        [
+            r"\csname used\endcsname",
+            r"\expandafter\def\csname thm#1\endcsname{x}",
+            r"\@nameuse{other}",
+            r"\csname\string\endcsname",
+        ]
+    )
+    assert csname_prefixes(source) == {"used", "thm", "other", ""}
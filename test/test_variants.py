@@ -0,0 +1,36 @@
+import pytest
+
+from texproject.filesystem import TemplateDict
+from texproject.variants import Variant, select_variants, variant_matrix
+
+
+def test_variant_matrix() -> None:
+    template_dict = TemplateDict()
+    assert variant_matrix(template_dict) == {}
+    with pytest.raises(ValueError, match="defines no variants"):
+        select_variants(template_dict, None)
+
+    template_dict["class_options"] = ["11pt"]
+    template_dict["variants"] = {
+        "review": {"class_options": ["anonymous"], "metadata": {"anonymous": True}},
+        "draft": {"constants": {"status": "Draft"}},
+    }
+    review, draft = select_variants(template_dict, None)
+    assert review == Variant("review", ["anonymous"], {}, {"anonymous": True})
+    assert review.apply(template_dict)["class_options"] == ["anonymous"]
+    # the class options are kept unless the variant replaces them
+    assert draft.apply(template_dict)["class_options"] == ["11pt"]
+    assert select_variants(template_dict, ["draft"]) == [draft]
+    with pytest.raises(ValueError, match="unknown variant 'final'"):
+        select_variants(template_dict, ["final"])
+
+    template_dict["variants"] = {"draft": {"constants": ["status"]}}
+    with pytest.raises(ValueError, match="'constants' of variant 'draft'"):
+        variant_matrix(template_dict)
+    template_dict["variants"] = {"draft": {"options": []}}
+    with pytest.raises(ValueError, match="unknown keys 'options'"):
+        variant_matrix(template_dict)
+    for constant in ["review-mode", "2col", "caf\u00e9"]:
+        template_dict["variants"] = {"draft": {"constants": {constant: "x"}}}
+        with pytest.raises(ValueError, match="may only contain letters"):
+            variant_matrix(template_dict)
@@ -0,0 +1,76 @@
+from pathlib import Path
+import shutil
+
+import click
+
+from texproject.control import RuntimeClosure, TempDir
+from texproject.filesystem import ProjectPath, TemplateDict
+from texproject.watch import BuildDirSync, ProjectWatcher, _PollingObserver
+
+
+def _ignore():
+    return shutil.ignore_patterns("*.aux", "tmp")
+
+
+def test_build_dir_sync(tmp_path: Path) -> None:
+    source = tmp_path / "proj"
+    target = source / "tmp" / "build"
+    (source / "sub").mkdir(parents=True)
+    (source / "main.tex").write_text("main")
+    (source / "sub" / "chapter.tex").write_text("chapter")
+    (source / "main.aux").write_text("ignored")
+
+    syncer = BuildDirSync(source, target, _ignore())
+    plan = syncer.plan()
+    assert set(plan.copies) == {Path("main.tex"), Path("sub/chapter.tex")}
+    syncer.apply(plan).run()
+    assert (target / "sub" / "chapter.tex").read_text() == "chapter"
+    assert not (target / "main.aux").exists()
+    assert len(syncer.plan()) == 0
+
+    (source / "sub" / "chapter.tex").write_text("new chapter")
+    plan = syncer.plan([source / "sub" / "chapter.tex"])
+    assert list(plan.copies) == [Path("sub/chapter.tex")]
+    syncer.apply(plan).run()
+    assert (target / "sub" / "chapter.tex").read_text() == "new chapter"
+
+    shutil.rmtree(source / "sub")
+    plan = syncer.plan([source / "sub"])
+    assert plan.removals == [Path("sub/chapter.tex")]
+    syncer.apply(plan).run()
+    assert not (target / "sub" / "chapter.tex").exists()
+
+    # a new session reuses the existing copies
+    assert len(BuildDirSync(source, target, _ignore()).plan()) == 0
+
+
+def test_polling_observer(tmp_path: Path) -> None:
+    (tmp_path / "main.tex").write_text("main")
+    observer = _PollingObserver(tmp_path, _ignore(), tmp_path / "tmp", interval=0.01)
+    assert observer.poll(0.02) == set()
+
+    (tmp_path / "main.aux").write_text("ignored")
+    (tmp_path / "other.tex").write_text("other")
+    assert observer.poll(0.02) == {tmp_path / "other.tex"}
+
+
+def test_interrupt_while_compiling(tmp_path: Path, monkeypatch) -> None:
+    (tmp_path / "main.tex").write_text("main")
+
+    def _compile(*_args, **_kwargs) -> RuntimeClosure:
+        def _interrupt():
+            raise KeyboardInterrupt
+
+        return RuntimeClosure("Compiling", True, _interrupt)
+
+    monkeypatch.setattr("texproject.watch.compile_latex", _compile)
+    closures = ProjectWatcher()(
+        ProjectPath(tmp_path), TemplateDict(), {}, TempDir(str(tmp_path / "tmp"))
+    )
+    messages = []
+    for closure in closures:
+        closure.run()
+        messages.append(click.unstyle(closure.message()))
+    assert messages[-1].endswith("Stopped watching after 0 build(s)")
+    # the build directory is synchronized before compiling
+    assert (tmp_path / ".texproject" / "tmp" / "build" / "main.tex").exists()
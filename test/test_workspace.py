@@ -0,0 +1,44 @@
+from pathlib import Path
+import json
+
+from texproject.control import TempDir
+from texproject.filesystem import ProjectPath, TemplateDict
+from texproject.workspace import WorkspaceRunner, find_projects
+
+
+def _project(path: Path, main: str) -> None:
+    (path / ".texproject").mkdir(parents=True)
+    (path / ".texproject" / "template.toml").write_text("")
+    (path / "main.tex").write_text(main)
+
+
+def test_workspace(tmp_path: Path) -> None:
+    _project(tmp_path / "a", "\\input{a}")
+    (tmp_path / "a" / "a.tex").write_text("")
+    _project(tmp_path / "group" / "b", "\\input{missing}")
+    # hidden directories and the directories inside of projects are not searched
+    _project(tmp_path / ".hidden", "")
+    _project(tmp_path / "a" / "nested", "")
+    (tmp_path / "other").mkdir()
+
+    assert find_projects(tmp_path, ".texproject") == [
+        tmp_path / "a",
+        tmp_path / "group" / "b",
+    ]
+
+    report = tmp_path / "report.json"
+    (closure,) = WorkspaceRunner(tmp_path, ["deps"], jobs=2, report=report)(
+        ProjectPath(tmp_path), TemplateDict(), {}, TempDir(str(tmp_path / "tmp"))
+    )
+    output = closure.run()
+    assert not output.success
+    message = str(output.message())
+    assert message.startswith("1 of 2 projects succeeded")
+    assert "Missing file for '\\input{missing}'" in message
+
+    projects = json.loads(report.read_text())["projects"]
+    assert [(project["path"], project["success"]) for project in projects] == [
+        (str(tmp_path / "a"), True),
+        (str(tmp_path / "group" / "b"), False),
+    ]
+    assert "a.tex" in projects[0]["output"]